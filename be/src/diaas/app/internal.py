@@ -4,10 +4,11 @@ import traceback
 from pprint import pformat
 
 import psycopg2
-from flask import Blueprint, request
+from flask import Blueprint, Response, request
 
 from diaas.app.utils import NotFoundError, as_json
 from diaas.config import CONFIG
+from diaas.metrics import REGISTRY
 
 internal_api = Blueprint("internal_api", __name__, static_folder=None)
 
@@ -97,3 +98,10 @@ def health():
 @as_json
 def echo():
     return dict(ok=True)
+
+
+@internal_api.route("/metrics")
+def metrics():
+    if request.args.get("token") != CONFIG.INTERNAL_API_TOKEN:
+        raise NotFoundError("route", request.url)
+    return Response(REGISTRY.render(), content_type="text/plain; version=0.0.4")
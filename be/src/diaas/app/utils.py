@@ -1,5 +1,6 @@
 import decimal
 import math
+import time
 import traceback
 from collections.abc import Mapping, Sequence
 from functools import wraps
@@ -13,7 +14,9 @@ from werkzeug.exceptions import HTTPException
 
 from diaas.db import db
 from diaas.libds import LibDSException
+from diaas.metrics import HTTP_REQUEST_SECONDS, REGISTRY
 from diaas.model import User
+from diaas.tracing import end_request_span, start_request_span
 
 
 def _dict_without_none_values(d):
@@ -128,6 +131,41 @@ def register_error_handlers(app):
     return app
 
 
+def _route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else "-unmatched-"
+
+
+def _start_request_timer():
+    g.request_started_at = time.perf_counter()
+    start_request_span(f"{request.method} {_route()}")
+
+
+def _observe_request(response):
+    started_at = g.get("request_started_at")
+    if started_at is not None:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started_at,
+            method=request.method,
+            route=_route(),
+            status=response.status_code,
+        )
+        end_request_span(status=response.status_code)
+    return response
+
+
+def _start_flushing_metrics():
+    REGISTRY.start_flushing()
+
+
+def register_metrics(app):
+    app.before_request(_start_flushing_metrics)
+    app.before_request(_start_request_timer)
+    app.after_request(_observe_request)
+
+    return app
+
+
 flask_json = FlaskJSON()
 
 EIGHT_PLACES = decimal.Decimal(10) ** -8
@@ -1,14 +1,54 @@
-from flask import Blueprint, g, request, session
+import os
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Blueprint, g, request, send_file, session
 
 from diaas.app.login import login
-from diaas.app.utils import Request, as_json, login_required
+from diaas.app.utils import (
+    NotFoundError,
+    Request,
+    ValidationError,
+    as_json,
+    error_json,
+    login_required,
+)
+from diaas.libds import LibDSError, LibDSException, LibDSTimeout
 from diaas.model import User
+from diaas.tracing import with_request_trace
 
 api_v1 = Blueprint("api_v1", __name__)
 
-
-def _data_stack_as_json(ds):
-    info = ds.libds.info()
+EXPORT_MIMETYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+    "csv": "text/csv",
+}
+
+# Seconds a single data stack's `ds info` gets while building the
+# session. A stack which takes longer is reported with an error
+# instead of holding up the whole response.
+DATA_STACK_INFO_TIMEOUT = 20
+
+
+def _data_stack_as_json(ds, timeout=None):
+    try:
+        info = ds.libds.info(timeout=timeout)
+    except LibDSTimeout as e:
+        return dict(error=error_json(504, e.code(), details=e.details()))
+    except LibDSException as e:
+        return dict(
+            error=error_json(400, e.code(), source=e.source(), details=e.details())
+        )
+    except Exception as e:
+        return dict(
+            error=error_json(
+                500,
+                e.__class__.__module__ + "." + e.__class__.__name__,
+                details=traceback.format_exc(),
+            )
+        )
     tasks = info.get("data", {}).get("tasks", None)
     if tasks is not None:
         for task in tasks:
@@ -20,14 +60,25 @@ def _data_stack_as_json(ds):
     return info
 
 
+def _data_stacks_as_json(data_stacks):
+    if len(data_stacks) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(data_stacks)) as pool:
+        futures = {
+            ds.id: pool.submit(
+                with_request_trace(_data_stack_as_json), ds, DATA_STACK_INFO_TIMEOUT
+            )
+            for ds in data_stacks
+        }
+        return {id: future.result() for id, future in futures.items()}
+
+
 def _session_json(user):
     return {
         "uid": user.code,
         "display_name": user.display_name,
         "email": user.email,
-        "data_stacks": {
-            ds.id: _data_stack_as_json(ds) for ds in user.data_stacks.values()
-        },
+        "data_stacks": _data_stacks_as_json(list(user.data_stacks.values())),
     }
 
 
@@ -66,12 +117,12 @@ def session_delete():
 @login_required
 @as_json
 def source_info(sid):
-    info = g.user.current_data_stack.libds.info()
-    for source in info.get("sources", []):
-        if source.get("id") == sid:
-            return source
-    else:
-        return None
+    try:
+        return g.user.current_data_stack.libds.source_info(sid)
+    except LibDSError as e:
+        if e.does_not_exist():
+            return None
+        raise e
 
 
 @api_v1.route("/sources/<path:id>/inspect", methods=["GET"])
@@ -107,12 +158,12 @@ def delete_file(file):
 @login_required
 @as_json
 def model_info(mid):
-    info = g.user.current_data_stack.libds.info()
-    for m in info.get("models", []):
-        if m.get("id") == mid:
-            return m
-    else:
-        return None
+    try:
+        return g.user.current_data_stack.libds.model_info(mid)
+    except LibDSError as e:
+        if e.does_not_exist():
+            return None
+        raise e
 
 
 @api_v1.route("/model/<path:id>", methods=["POST"])
@@ -154,6 +205,35 @@ def execute():
     )
 
 
+@api_v1.route("/store/export/<path:table>", methods=["GET"])
+@login_required
+def export_table(table):
+    format = request.args.get("format", "parquet")
+    if format not in EXPORT_MIMETYPES:
+        raise ValidationError(f"Unknown export format {format}")
+    schema = request.args.get("schema", "public")
+    libds = g.user.current_data_stack.libds
+    fd, path = tempfile.mkstemp(suffix="." + format)
+    os.close(fd)
+    try:
+        libds.export(table, format, path, schema=schema)
+        # NOTE still readable once unlinked, send_file streams it from
+        # the open file and closing it frees the space.
+        file = open(path, "rb")
+    except LibDSError as e:
+        if e.does_not_exist():
+            raise NotFoundError(entity_type="table", entity_id=f"{schema}.{table}")
+        raise e
+    finally:
+        os.unlink(path)
+    return send_file(
+        file,
+        mimetype=EXPORT_MIMETYPES[format],
+        as_attachment=True,
+        download_name=f"{table}.{format}",
+    )
+
+
 @api_v1.route("/data-nodes/<path:nid>/update", methods=["POST"])
 @login_required
 @as_json
@@ -176,9 +256,9 @@ def data_node_delete(nid):
 @login_required
 @as_json
 def task_info(tid):
-    info = g.user.current_data_stack.libds.info()
-    for task in info.get("data", {}).get("tasks", []):
-        if task.get("id") == tid:
-            return task
-    else:
-        return None
+    try:
+        return g.user.current_data_stack.libds.task_info(tid)
+    except LibDSError as e:
+        if e.does_not_exist():
+            return None
+        raise e
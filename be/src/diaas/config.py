@@ -49,6 +49,7 @@ class Config:
         self.configurable("DS_STORE", type=Path)
         self.configurable("ENABLE_SENTRY", type=bool)
         self.configurable("INTERNAL_API_TOKEN")
+        self.configurable("METRICS_DIR", type=Path)
         self.configurable("PG_HASHIDS_SALT")
         self.configurable("SESSION_COOKIE_IS_SECURE", type=bool)
         self.configurable("SESSION_SECRET_KEY")
@@ -57,7 +58,7 @@ class Config:
         if self.ENABLE_SENTRY:
             self.configurable("SENTRY_DSN")
 
-        for path in [self.WORKBENCH_STORE, self.DS_STORE]:
+        for path in [self.WORKBENCH_STORE, self.DS_STORE, self.METRICS_DIR]:
             path.mkdir(parents=True, exist_ok=True)
 
         return self
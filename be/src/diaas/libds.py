@@ -1,9 +1,32 @@
+import datetime
 import json
+import os
+import re
+import signal
 import subprocess
+import threading
+import time
+from decimal import Decimal
 
+import msgpack
 import semver
 
 from diaas.config import CONFIG
+from diaas.metrics import (
+    LIBDS_CALL_SECONDS,
+    LIBDS_FAILURES,
+    LIBDS_PAYLOAD_BYTES,
+)
+from diaas.tracing import (
+    TRACE_FILENAME,
+    TRACE_ID_ENV,
+    TRACE_PARENT_ENV,
+    add_trace_file,
+    end_span,
+    new_span,
+    request_span,
+    write_span,
+)
 
 
 class LibDSException(Exception):
@@ -17,7 +40,16 @@ class LibDSException(Exception):
         return self.__class__.__module__ + "." + self.__class__.__name__
 
     def __str__(self):
-        return "<" + " ".join[self.code(), self.details(), self.source()] + ">"
+        parts = [self.code(), self.details(), self.source()]
+        return "<" + " ".join(str(p) for p in parts if p is not None) + ">"
+
+
+# NOTE only ds's own -f/--format rejecting msgpack (worded as by click 7
+# and 8), not a subcommand's --format, eg ds export.
+UNKNOWN_FORMAT = re.compile(
+    r"Invalid value for ['\"]-f['\"] / ['\"]--format['\"]: "
+    r"(invalid choice: msgpack\.|'msgpack' is not one of)"
+)
 
 
 class LibDSRuntimeError(LibDSException):
@@ -32,6 +64,10 @@ class LibDSRuntimeError(LibDSException):
             f"ds failed: {self.cmd} => {self.returncode}: {self.stderr}; {self.stdout}"
         )
 
+    def unknown_format(self):
+        # NOTE click's usage errors exit with 2
+        return self.returncode == 2 and UNKNOWN_FORMAT.search(self.stderr) is not None
+
 
 class LibDSOutputParseError(LibDSException):
     def __init__(self, cmd, out, err):
@@ -40,13 +76,22 @@ class LibDSOutputParseError(LibDSException):
         self.err = err
 
     def details(self):
-        return f"{self.err} while parsing ds response json: {self.cmd} => {self.out}"
+        return f"{self.err} while parsing ds response: {self.cmd} => {self.out}"
 
 
 class LibDSVersionMismatch(LibDSException):
     pass
 
 
+class LibDSTimeout(LibDSException):
+    def __init__(self, cmd, timeout):
+        self.cmd = cmd
+        self.timeout = timeout
+
+    def details(self):
+        return f"ds did not respond within {self.timeout}s: {self.cmd}"
+
+
 class LibDSError(LibDSException):
     def __init__(self, cmd, error):
         self.cmd = cmd
@@ -55,6 +100,9 @@ class LibDSError(LibDSException):
     def code(self):
         return self.error["code"] + "(" + super().code() + ")"
 
+    def does_not_exist(self):
+        return self.error["code"].endswith("-does-not-exist")
+
     def details(self):
         return self.error.get("details", None)
 
@@ -62,13 +110,83 @@ class LibDSError(LibDSException):
         return self.error.get("source", None)
 
 
+# NOTE these have to match libds.msgpack_format
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_DECIMAL = 3
+EXT_STREAM = 4
+
+
+class _Stream(list):
+    pass
+
+
+def unpack_response(data):
+    """Decodes the output of `ds -f msgpack`: a response frame in which
+    streamed values are EXT_STREAM placeholders, followed by each
+    stream's chunks, in placeholder order, each ended by an empty
+    chunk."""
+    streams = []
+
+    def ext_hook(code, value):
+        value = value.decode("utf-8")
+        if code == EXT_DATETIME:
+            return datetime.datetime.fromisoformat(value)
+        if code == EXT_DATE:
+            return datetime.date.fromisoformat(value)
+        if code == EXT_DECIMAL:
+            return Decimal(value)
+        if code == EXT_STREAM:
+            stream = _Stream()
+            streams.append((int(value), stream))
+            return stream
+        raise ValueError(f"Unknown msgpack ext type {code}")
+
+    unpacker = msgpack.Unpacker(ext_hook=ext_hook, raw=False, strict_map_key=False)
+    unpacker.feed(data)
+    response = unpacker.unpack()
+    for _, stream in sorted(streams, key=lambda s: s[0]):
+        while True:
+            chunk = unpacker.unpack()
+            if isinstance(chunk, dict):
+                # NOTE ds failed after it started writing the response
+                response.pop("data", None)
+                response["error"] = chunk["error"]
+                return response
+            if not chunk:
+                break
+            stream.extend(chunk)
+    return response
+
+
+# NOTE data stacks whose ds predates -f msgpack, they're bootstrapped
+# with their own libds so can lag behind the be. Shared by every LibDS
+# (there's one per request) and every request thread.
+_JSON_ONLY = set()
+_JSON_ONLY_LOCK = threading.Lock()
+
+
+def _json_only(path):
+    with _JSON_ONLY_LOCK:
+        return path in _JSON_ONLY
+
+
+def _set_json_only(path):
+    with _JSON_ONLY_LOCK:
+        _JSON_ONLY.add(path)
+
+
 class LibDS:
     MIN_VERSION = semver.VersionInfo.parse("0.2.0")
 
     def __init__(self, path):
         self.path = path
 
-    def call_ds(self, cmd, input=None):
+    @property
+    def format(self):
+        return "json" if _json_only(self.path) else "msgpack"
+
+    def call_ds(self, cmd, input=None, timeout=None):
         run = self.path / "run"
         venv = self.path / ".venv"
         if not (run.exists() and venv.exists()):
@@ -81,26 +199,86 @@ class LibDS:
                 real_args.append(a)
             else:
                 real_args.extend(a)
-        cmd = [str(run), "ds", "-f", "json"] + real_args
+        command = real_args[0] if real_args else ""
+
+        env = None
+        parent = request_span()
+        if parent is not None:
+            span = new_span(
+                "LibDS.call_ds",
+                trace_id=parent["trace_id"],
+                parent_id=parent["span_id"],
+                command=command,
+            )
+            env = os.environ.copy()
+            env[TRACE_ID_ENV] = span["trace_id"]
+            env[TRACE_PARENT_ENV] = span["span_id"]
+
+        error = None
+        try:
+            try:
+                return self._call_ds(command, real_args, input, timeout, env)
+            except LibDSRuntimeError as e:
+                if not (self.format == "msgpack" and e.unknown_format()):
+                    raise e
+                _set_json_only(self.path)
+                return self._call_ds(command, real_args, input, timeout, env)
+        except LibDSException as e:
+            LIBDS_FAILURES.inc(command=command, reason=e.__class__.__name__)
+            error = e
+            raise e
+        finally:
+            if parent is not None:
+                trace_file = self.path / TRACE_FILENAME
+                write_span(trace_file, end_span(span, error))
+                add_trace_file(trace_file)
+
+    def _call_ds(self, command, args, input, timeout, env):
+        format = self.format
+        cmd = [str(self.path / "run"), "ds", "-f", format] + args
+        started_at = time.perf_counter()
         proc = subprocess.Popen(
             cmd,
-            text=True,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             cwd=self.path,
+            env=env,
+            start_new_session=True,
         )
         if input is not None and not isinstance(input, str):
             raise ValueError(f"Can only send strings to process, not {input}")
-        out, err = proc.communicate(input=input)
+        if input is not None:
+            input = input.encode("utf-8")
+        try:
+            # NOTE ds streams its msgpack output in chunks, we still wait
+            # for all of it here since every caller wants the whole
+            # response anyway (and the timeout has to cover the lot).
+            out, err = proc.communicate(input=input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.communicate()
+            raise LibDSTimeout(cmd=cmd, timeout=timeout)
+        finally:
+            LIBDS_CALL_SECONDS.observe(
+                time.perf_counter() - started_at, command=command
+            )
+        err = err.decode("utf-8", errors="replace")
         if proc.returncode > 0:
             raise LibDSRuntimeError(
-                cmd=cmd, stdout=out, stderr=err, returncode=proc.returncode
+                cmd=cmd,
+                stdout=out.decode("utf-8", errors="replace"),
+                stderr=err,
+                returncode=proc.returncode,
             )
         try:
-            response = json.loads(out)
+            if format == "msgpack":
+                response = unpack_response(out)
+            else:
+                response = json.loads(out)
         except Exception as e:
             raise LibDSOutputParseError(cmd=cmd, out=out, err=e)
+        LIBDS_PAYLOAD_BYTES.observe(len(out), command=command)
         meta = response.get("meta", {})
         meta_version = meta.get("version", "0.0.0")
         if self.MIN_VERSION > meta_version:
@@ -111,8 +289,17 @@ class LibDS:
         else:
             return response["data"]
 
-    def info(self):
-        return self.call_ds(cmd=["info"])
+    def info(self, timeout=None):
+        return self.call_ds(cmd=["info"], timeout=timeout)
+
+    def source_info(self, id):
+        return self.call_ds(cmd=["source-info", id])
+
+    def model_info(self, id):
+        return self.call_ds(cmd=["model-info", id])
+
+    def task_info(self, tid):
+        return self.call_ds(cmd=["task-info", tid])
 
     def inspect(self, type, id):
         return self.call_ds(cmd=["inspect", type, id])
@@ -135,6 +322,10 @@ class LibDS:
             cmd = ["execute", "--limit", str(limit), "-"]
         return self.call_ds(cmd=cmd, input=statement)
 
+    def export(self, table, format, out, schema="public"):
+        cmd = ["export", table, "--schema", schema, "--format", format]
+        return self.call_ds(cmd=cmd + ["--out", str(out)])
+
     def data_node_update(self, nid):
         return self.call_ds(cmd=["data-node-update", nid])
 
@@ -0,0 +1,261 @@
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from diaas.config import CONFIG
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+# NOTE in seconds, how far behind a scrape can be on the other workers
+FLUSH_INTERVAL = 5
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {labels}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def snapshot(self):
+        raise NotImplementedError()
+
+    def merge(self, values, more):
+        raise NotImplementedError()
+
+    def samples(self, values):
+        raise NotImplementedError()
+
+    def render(self, values=None):
+        if values is None:
+            values = self.snapshot()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for name, labels, value in self.samples(values):
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, values, more):
+        for key, value in more.items():
+            values[key] = values.get(key, 0) + value
+
+    def samples(self, values):
+        for key, value in values.items():
+            yield self.name, list(zip(self.labels, key)), value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._values:
+                # NOTE per bucket (not cumulative) counts, then sum, then count
+                self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            counts = self._values[key]
+            counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: [list(v[0]), v[1], v[2]] for key, v in self._values.items()}
+
+    def merge(self, values, more):
+        for key, (counts, sum, count) in more.items():
+            if key not in values:
+                values[key] = [[0] * len(counts), 0, 0]
+            merged = values[key]
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += sum
+            merged[2] += count
+
+    def samples(self, values):
+        for key, (counts, sum, count) in values.items():
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for le, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                bucket_labels = labels + [("le", _format_value(le))]
+                yield self.name + "_bucket", bucket_labels, cumulative
+            yield self.name + "_sum", labels, sum
+            yield self.name + "_count", labels, count
+
+
+class Registry:
+    """The metrics of this process.
+
+    With a directory every process (gunicorn worker) flushes its values
+    to a file of its own in there, and render sums the files of all of
+    them, so a scrape sees the whole server whichever worker answers
+    it. Files of exited workers are kept, their counts still belong in
+    the totals; the directory is cleared when the server starts.
+
+    Flushing every flush_interval seconds, not every request, is up to
+    start_flushing."""
+
+    def __init__(self, directory=None, name=None, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.name = name
+        self.flush_interval = flush_interval
+        self.metrics = []
+        self._flushed = None
+        self._flush_lock = threading.Lock()
+        self._flushing_pid = None
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def _path(self):
+        # NOTE the pid is only known after gunicorn forked the worker
+        name = self.name if self.name is not None else str(os.getpid())
+        return self.directory / (name + ".json")
+
+    def flush(self):
+        if self.directory is None:
+            return
+        values = {
+            metric.name: [
+                [list(key), value] for key, value in metric.snapshot().items()
+            ]
+            for metric in self.metrics
+        }
+        data = json.dumps(values)
+        with self._flush_lock:
+            if data == self._flushed:
+                return
+            path = self._path()
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(data)
+            os.replace(tmp, path)
+            self._flushed = data
+
+    def start_flushing(self):
+        """Flushes every flush_interval seconds, and at exit, from a
+        thread of this process's own. Cheap to call again, eg on every
+        request: gunicorn can import this before it forks its workers
+        so the thread is only started once a worker uses it."""
+        if self.directory is None:
+            return
+        pid = os.getpid()
+        with self._flush_lock:
+            if self._flushing_pid == pid:
+                return
+            self._flushing_pid = pid
+            # NOTE a forked worker hasn't written the master's values
+            self._flushed = None
+        atexit.register(self.flush)
+        threading.Thread(
+            target=self._flush_every_interval, name="metrics flush", daemon=True
+        ).start()
+
+    def _flush_every_interval(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _merged_values(self):
+        self.flush()
+        merged = {metric.name: {} for metric in self.metrics}
+        for path in sorted(self.directory.glob("*.json")):
+            values = json.loads(path.read_text())
+            for metric in self.metrics:
+                more = {tuple(key): value for key, value in values.get(metric.name, [])}
+                metric.merge(merged[metric.name], more)
+        return merged
+
+    def render(self):
+        if self.directory is None:
+            merged = {metric.name: metric.snapshot() for metric in self.metrics}
+        else:
+            merged = self._merged_values()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(merged[metric.name]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry(CONFIG.METRICS_DIR)
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "diaas_http_request_duration_seconds",
+    "Time spent handling a request, by route.",
+    labels=("method", "route", "status"),
+)
+LIBDS_CALL_SECONDS = REGISTRY.histogram(
+    "diaas_libds_call_duration_seconds",
+    "Time spent waiting on a ds subprocess, by ds command.",
+    labels=("command",),
+)
+LIBDS_FAILURES = REGISTRY.counter(
+    "diaas_libds_failures_total",
+    "ds subprocess calls which failed, by ds command and reason.",
+    labels=("command", "reason"),
+)
+LIBDS_PAYLOAD_BYTES = REGISTRY.histogram(
+    "diaas_libds_payload_bytes",
+    "Size of the output parsed from ds (msgpack, json for old ds), by ds command.",
+    labels=("command",),
+    buckets=SIZE_BUCKETS,
+)
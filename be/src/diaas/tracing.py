@@ -0,0 +1,98 @@
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+from flask import g, has_request_context
+
+# NOTE these, and the span format, have to match libds.trace
+TRACE_ID_ENV = "DS_TRACE_ID"
+TRACE_PARENT_ENV = "DS_TRACE_PARENT_ID"
+TRACE_FILENAME = "traces.jsonl"
+
+# NOTE the request's span and trace files, in threads working for it
+# (which don't have its request context).
+_REQUEST_TRACE = threading.local()
+
+
+def new_span(name, trace_id, parent_id=None, **attrs):
+    span = dict(
+        trace_id=trace_id,
+        span_id=uuid.uuid4().hex[:16],
+        parent_id=parent_id,
+        name=name,
+        pid=os.getpid(),
+        start=time.time(),
+        _started_at=time.perf_counter(),
+    )
+    if attrs:
+        span["attrs"] = attrs
+    return span
+
+
+def end_span(span, error=None):
+    span = span.copy()
+    span["duration_s"] = time.perf_counter() - span.pop("_started_at")
+    if error is not None:
+        span["error"] = str(error)
+    return span
+
+
+def write_span(path, span):
+    line = (json.dumps(span) + "\n").encode("utf-8")
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def start_request_span(name):
+    g.trace_span = new_span(name, trace_id=uuid.uuid4().hex)
+    g.trace_files = set()
+
+
+def request_span():
+    if has_request_context():
+        return g.get("trace_span")
+    return getattr(_REQUEST_TRACE, "span", None)
+
+
+def add_trace_file(path):
+    if has_request_context():
+        g.trace_files.add(path)
+    else:
+        _REQUEST_TRACE.files.add(path)
+
+
+def with_request_trace(f):
+    """Wraps f, to be run in another thread, so that ds calls it makes
+    are traced as part of the current request."""
+    span = request_span()
+    files = g.get("trace_files") if has_request_context() else None
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if span is None:
+            return f(*args, **kwargs)
+        _REQUEST_TRACE.span, _REQUEST_TRACE.files = span, files
+        try:
+            return f(*args, **kwargs)
+        finally:
+            del _REQUEST_TRACE.span, _REQUEST_TRACE.files
+
+    return wrapper
+
+
+def end_request_span(**attrs):
+    span = g.get("trace_span")
+    # NOTE only requests which went through ds are written, to the
+    # trace files of the data stacks they touched.
+    if span is None or not g.trace_files:
+        return
+    span = end_span(span)
+    span.setdefault("attrs", {}).update(attrs)
+    for path in g.trace_files:
+        write_span(path, span)
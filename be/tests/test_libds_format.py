@@ -0,0 +1,41 @@
+import pytest
+
+from diaas.libds import LibDS, LibDSRuntimeError
+
+
+def _libds(tmp_path, monkeypatch, stderr):
+    (tmp_path / "run").touch()
+    (tmp_path / ".venv").mkdir()
+    formats = []
+
+    def _call_ds(self, command, args, input, timeout, env):
+        formats.append(self.format)
+        if self.format == "msgpack":
+            raise LibDSRuntimeError(cmd=args, stdout="", stderr=stderr, returncode=2)
+        return {}
+
+    monkeypatch.setattr(LibDS, "_call_ds", _call_ds)
+    return LibDS(tmp_path), formats
+
+
+@pytest.mark.parametrize(
+    "stderr",
+    [
+        "Error: Invalid value for '-f' / '--format': 'msgpack' is not one of 'yaml', 'json'.",
+        "Error: Invalid value for '-f' / '--format': invalid choice: msgpack. (choose from yaml, json)",
+    ],
+)
+def test_old_ds_falls_back_to_json(tmp_path, monkeypatch, stderr):
+    libds, formats = _libds(tmp_path, monkeypatch, stderr)
+    assert libds.call_ds(["info"]) == {}
+    assert LibDS(tmp_path).call_ds(["info"]) == {}
+    assert formats == ["msgpack", "json", "json"]
+
+
+def test_a_subcommands_format_isnt_the_ds_format(tmp_path, monkeypatch):
+    stderr = "Error: Invalid value for '--format': 'xlsx' is not one of 'csv', 'parquet'."
+    libds, formats = _libds(tmp_path, monkeypatch, stderr)
+    with pytest.raises(LibDSRuntimeError):
+        libds.call_ds(["export", "--format", "xlsx"])
+    assert formats == ["msgpack"]
+    assert LibDS(tmp_path).format == "msgpack"
@@ -0,0 +1,50 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from diaas.libds import LibDS, LibDSError
+from diaas.tracing import (
+    TRACE_FILENAME,
+    end_request_span,
+    start_request_span,
+    with_request_trace,
+)
+
+
+def test_libds_error_propagates_when_traced(app, tmp_path, monkeypatch):
+    (tmp_path / "run").touch()
+    (tmp_path / ".venv").mkdir()
+    error = LibDSError(cmd=["ds", "source-info", "nope"], error=dict(code="source-does-not-exist"))
+
+    def _call_ds(*args):
+        raise error
+
+    libds = LibDS(tmp_path)
+    monkeypatch.setattr(libds, "_call_ds", _call_ds)
+    with app.test_request_context("/api/1/sources/nope"):
+        start_request_span("GET /api/1/sources/nope")
+        with pytest.raises(LibDSError) as e:
+            libds.source_info("nope")
+        assert e.value is error
+        assert e.value.does_not_exist()
+        end_request_span(status=404)
+
+    assert '"error": "<source-does-not-exist(diaas.libds.LibDSError)>"' in (tmp_path / TRACE_FILENAME).read_text()
+
+
+def test_threads_are_traced_as_part_of_the_request(app, tmp_path, monkeypatch):
+    (tmp_path / "run").touch()
+    (tmp_path / ".venv").mkdir()
+    libds = LibDS(tmp_path)
+    monkeypatch.setattr(libds, "_call_ds", lambda *args: {})
+
+    with app.test_request_context("/api/1/session"):
+        start_request_span("GET /api/1/session")
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pool.submit(with_request_trace(libds.info)).result()
+        end_request_span(status=200)
+
+    spans = [json.loads(line) for line in (tmp_path / TRACE_FILENAME).read_text().splitlines()]
+    assert [s["name"] for s in spans] == ["LibDS.call_ds", "GET /api/1/session"]
+    assert spans[0]["parent_id"] == spans[1]["span_id"]
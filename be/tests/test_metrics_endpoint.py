@@ -0,0 +1,80 @@
+import json
+import time
+
+from diaas.config import CONFIG
+from diaas.metrics import Registry
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram("test_seconds", "Test.", labels=("route",), buckets=(1, 10))
+    histogram.observe(0.5, route="/a")
+    histogram.observe(5, route="/a")
+    histogram.observe(50, route="/a")
+
+    text = registry.render()
+    assert 'test_seconds_bucket{route="/a",le="1"} 1\n' in text
+    assert 'test_seconds_bucket{route="/a",le="10"} 2\n' in text
+    assert 'test_seconds_bucket{route="/a",le="+Inf"} 3\n' in text
+    assert 'test_seconds_count{route="/a"} 3\n' in text
+
+
+def test_workers_are_summed(tmp_path):
+    def worker(name):
+        registry = Registry(tmp_path, name=name)
+        counter = registry.counter("test_total", "Test.", labels=("command",))
+        histogram = registry.histogram("test_seconds", "Test.", buckets=(1,))
+        return registry, counter, histogram
+
+    registry_1, counter_1, histogram_1 = worker("1")
+    registry_2, counter_2, histogram_2 = worker("2")
+    counter_1.inc(command="info")
+    histogram_1.observe(0.5)
+    registry_1.flush()
+    counter_2.inc(2, command="info")
+    counter_2.inc(command="load")
+    histogram_2.observe(5)
+
+    text = registry_2.render()
+    assert 'test_total{command="info"} 3\n' in text
+    assert 'test_total{command="load"} 1\n' in text
+    assert 'test_seconds_bucket{le="1"} 1\n' in text
+    assert 'test_seconds_bucket{le="+Inf"} 2\n' in text
+    assert registry_1.render() == text
+
+
+def test_workers_flush_on_an_interval(tmp_path):
+    registry = Registry(tmp_path, name="1", flush_interval=0.01)
+    counter = registry.counter("test_total", "Test.")
+    counter.inc()
+    registry.start_flushing()
+    registry.start_flushing()
+
+    def flushed():
+        path = tmp_path / "1.json"
+        for _ in range(200):
+            if path.exists():
+                values = json.loads(path.read_text())
+                if values == {"test_total": [[[], counter.snapshot()[()]]]}:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    assert flushed()
+    counter.inc(2)
+    assert flushed()
+
+
+def test_metrics_endpoint(client):
+    client.get("/api/_/echo")
+    res = client.get("/api/_/metrics?token=" + CONFIG.INTERNAL_API_TOKEN)
+    assert res.status_code == 200
+    assert res.content_type.startswith("text/plain")
+    text = res.get_data(as_text=True)
+    assert "# TYPE diaas_http_request_duration_seconds histogram" in text
+    assert 'route="/api/_/echo"' in text
+    assert "# TYPE diaas_libds_failures_total counter" in text
+
+
+def test_metrics_need_the_token(client):
+    assert client.get("/api/_/metrics").status_code == 404
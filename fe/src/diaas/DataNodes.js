@@ -47,6 +47,7 @@ const Graph = observer(() => {
     STALE: "#666666",
     REFRESHING: "orange",
     REFRESHING_STALE: "orange",
+    FAILED: "red",
     ORPHAN: "red",
 
     MISSING: "black",
@@ -12,6 +12,7 @@ extras_require = {
     "postgresql":["psycopg2"],
     "clickhouse":["clickhouse-driver"],
     "mysql":["mysqlclient"],
+    "export":["pyarrow"],
 }
 
 all = set()
@@ -26,11 +27,21 @@ setup(
     python_requires=">=3.7.0",
     package_dir={'': "src"},
     packages=find_packages('src'),
-    entry_points=dict(
-        console_scripts=[
+    entry_points={
+        'console_scripts': [
             'ds = libds.cli:cli'
-        ]
-    ),
+        ],
+        'libds.sources': [
+            'libds.source.static.StaticTable = libds.source.static:StaticTable',
+            'libds.source.file.CSVFile = libds.source.file:CSVFile',
+            'libds.source.google.GoogleSheet = libds.source.google:GoogleSheet',
+            'libds.source.mysql.MySQL = libds.source.mysql:MySQL',
+        ],
+        'libds.stores': [
+            'libds.store.sqlite.SQLite = libds.store.sqlite:SQLite',
+            'libds.store.clickhouse.ClickHouse = libds.store.clickhouse:ClickHouse',
+        ],
+    },
     install_requires=install_requires,
     extras_require=extras_require,
     include_package_data=True,
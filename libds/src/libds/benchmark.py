@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import click
+import psutil
+
+from libds.__version__ import __version__
+from libds.data_node import DataNodeState
+from libds.data_stack import DataStack
+from libds.model import data_type as dt
+from libds.source import Record
+
+SHAPES = ["wide", "deep", "diamond"]
+INGESTION_STORES = ["sqlite-file", "sqlite-memory", "clickhouse"]
+INGESTION_PATHS = ["raw", "unpacked"]
+
+
+def source_id(i):
+    return f"s_{i}"
+
+
+def model_id(i):
+    return f"m_{i}"
+
+
+def _source_node(i):
+    return f"public.{source_id(i)}_raw"
+
+
+def _model_node(i):
+    return f"public.{model_id(i)}"
+
+
+def dag_dependencies(shape, num_sources, num_models):
+    """Returns, for each model, the list of node ids it depends on."""
+    deps = []
+    for i in range(num_models):
+        if shape == "wide":
+            deps.append([_source_node(i % num_sources)])
+        elif shape == "deep":
+            if i == 0:
+                deps.append([_source_node(s) for s in range(num_sources)])
+            else:
+                deps.append([_model_node(i - 1)])
+        elif shape == "diamond":
+            # m_0 is the top, then repeating pairs which both depend on
+            # the previous bottom followed by a bottom joining the pair.
+            if i == 0:
+                deps.append([_source_node(s) for s in range(num_sources)])
+            elif i % 3 == 1:
+                deps.append([_model_node(i - 1)])
+            elif i % 3 == 2:
+                deps.append([_model_node(i - 2)])
+            else:
+                deps.append([_model_node(i - 2), _model_node(i - 1)])
+        else:
+            raise ValueError(f"Unknown dag shape {shape}")
+    return deps
+
+
+def generate_data_stack(
+    directory, num_sources, num_models, shape="wide", store="file", num_rows=10
+):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / "data_stack.yaml").write_text(
+        f"created_at: {datetime.utcnow().isoformat()}\n"
+    )
+
+    stores = directory / "stores"
+    stores.mkdir(exist_ok=True)
+    path = "./store.sqlite3" if store == "file" else ":memory:"
+    (stores / "store.yaml").write_text(
+        f"type: libds.store.sqlite.SQLite\npath: '{path}'\n"
+    )
+
+    sources = directory / "sources"
+    sources.mkdir(exist_ok=True)
+    rows = "\n".join(f"  {r} value_{r}" for r in range(num_rows))
+    for i in range(num_sources):
+        (sources / f"{source_id(i)}.yaml").write_text(
+            f"type: libds.source.static.StaticTable\ndata: |\n  id value\n{rows}\n"
+        )
+
+    models = directory / "models"
+    models.mkdir(exist_ok=True)
+    for i, deps in enumerate(dag_dependencies(shape, num_sources, num_models)):
+        selects = [f'SELECT * FROM {{{{ depends_on("{dep}") }}}}' for dep in deps]
+        (models / f"{model_id(i)}.sql").write_text("\nUNION ALL\n".join(selects) + "\n")
+
+    return directory
+
+
+def _timed(fn, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return dict(min=min(timings), median=statistics.median(timings)), result
+
+
+def _node_states(directory):
+    ds = DataStack.from_dir(directory)
+    return {n.id: n.state for n in ds.data_orchestrator.data_nodes.values()}
+
+
+def tick_until_fresh(directory, timeout=600, interval=0.1):
+    """Runs `ds dot`, as separate processes just like the real thing,
+    until every node is FRESH. Returns the number of ticks it took."""
+    ticks = 0
+    deadline = time.time() + timeout
+    while True:
+        states = _node_states(directory).values()
+        if all(state == DataNodeState.FRESH for state in states):
+            return ticks
+        if time.time() > deadline:
+            raise TimeoutError(f"{directory} not fresh after {timeout}s")
+        if not any(
+            state in (DataNodeState.REFRESHING, DataNodeState.REFRESHING_STALE)
+            for state in states
+        ):
+            subprocess.run(
+                [sys.executable, "-m", "libds.cli", "-d", str(directory), "dot"],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            ticks += 1
+        time.sleep(interval)
+
+
+def benchmark_data_stack(
+    directory, num_sources, num_models, shape, store="file", repeat=3, tick=True
+):
+    generate_data_stack(directory, num_sources, num_models, shape, store)
+
+    from_dir, ds = _timed(lambda: DataStack.from_dir(directory), repeat)
+    orchestrator = ds.data_orchestrator
+    info, _ = _timed(orchestrator.info, repeat)
+    set_node_stale, _ = _timed(
+        lambda: orchestrator.set_node_stale(_source_node(0)), repeat
+    )
+
+    result = dict(
+        shape=shape,
+        store=store,
+        sources=num_sources,
+        models=num_models,
+        nodes=len(orchestrator.data_nodes),
+        from_dir_s=from_dir,
+        info_s=info,
+        set_node_stale_s=set_node_stale,
+    )
+
+    if tick:
+        if store != "file":
+            raise ValueError("Ticking needs a store which outlives the process.")
+        start = time.perf_counter()
+        result["ticks"] = tick_until_fresh(directory)
+        result["tick_until_fresh_s"] = time.perf_counter() - start
+
+    return result
+
+
+def _column(c):
+    # NOTE alternate integer and text columns, each value has a fixed
+    # width so every row has the same encoded size.
+    if c % 2 == 0:
+        return f"c{c}", dt.Integer(width=64), lambda i: 1_000_000_000 + i
+    else:
+        return f"c{c}", dt.Text(), lambda i: f"value_{i:010d}"
+
+
+def generate_records(num_rows, width):
+    columns = [_column(c) for c in range(width)]
+    extracted_at = datetime.utcnow()
+    for i in range(num_rows):
+        yield Record(
+            data={name: value(i) for name, _, value in columns},
+            extracted_at=extracted_at,
+        )
+
+
+def record_size(width):
+    return len(next(generate_records(1, width)).data_str)
+
+
+def _ingestion_data_stack(directory, store, clickhouse_host, clickhouse_port):
+    directory = Path(directory)
+    (directory / "data_stack.yaml").write_text("created_at: benchmark\n")
+    stores = directory / "stores"
+    stores.mkdir(exist_ok=True)
+    if store == "sqlite-file":
+        spec = "type: libds.store.sqlite.SQLite\npath: ./store.sqlite3\n"
+    elif store == "sqlite-memory":
+        spec = "type: libds.store.sqlite.SQLite\npath: ':memory:'\n"
+    elif store == "clickhouse":
+        spec = f"type: libds.store.clickhouse.ClickHouse\nhost: {clickhouse_host}\nport: {clickhouse_port}\n"
+    else:
+        raise ValueError(f"Unknown store {store}")
+    (stores / "store.yaml").write_text(spec)
+    return DataStack.from_dir(directory)
+
+
+def _load(store, path, num_rows, width, schema_name, table_name):
+    records = generate_records(num_rows, width)
+    if path == "raw":
+        return store.load_raw_from_records(
+            schema_name=schema_name, table_name=table_name, records=records
+        )
+    else:
+        return store.load_unpacked_from_records(
+            schema_name=schema_name,
+            table_name=table_name,
+            columns=[[name, type] for name, type, _ in map(_column, range(width))],
+            records=records,
+        )
+
+
+def benchmark_ingestion(
+    directory,
+    store,
+    path,
+    num_rows,
+    width,
+    tracemalloc_rows=1000,
+    clickhouse_host="localhost",
+    clickhouse_port=9000,
+):
+    result = dict(store=store, path=path, rows=num_rows, width=width)
+    ds = _ingestion_data_stack(directory, store, clickhouse_host, clickhouse_port)
+    if path == "unpacked" and not hasattr(ds.store, "load_unpacked_from_records"):
+        result["skipped"] = f"{ds.store.type} has no load_unpacked_from_records"
+        return result
+
+    schema_name, table_name = "libds_benchmark", f"ingestion_{path}"
+    rss_before = psutil.Process().memory_info().rss
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cpu_start, start = time.process_time(), time.perf_counter()
+        _load(ds.store, path, num_rows, width, schema_name, table_name)
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        # NOTE before the traced load, whose own allocations (and
+        # tracemalloc's) would count too. The kernel only updates maxrss
+        # now and then, it can lag behind the current rss.
+        peak_rss = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            psutil.Process().memory_info().rss,
+        )
+
+        # NOTE a second, smaller, load with tracemalloc on since it
+        # slows everything down too much to be part of the timing.
+        traced_rows = min(num_rows, tracemalloc_rows)
+        tracemalloc.start()
+        _load(ds.store, path, traced_rows, width, schema_name, table_name)
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    num_bytes = num_rows * record_size(width)
+    result.update(
+        wall_s=wall,
+        cpu_s=cpu,
+        rows_per_s=num_rows / wall,
+        bytes_per_s=num_bytes / wall,
+        cpu_us_per_row=1e6 * cpu / num_rows,
+        rss_before=rss_before,
+        peak_rss=peak_rss,
+        traced_peak_bytes_per_row=traced_peak / traced_rows,
+    )
+    return result
+
+
+TUNED_SQLITE = """journal_mode: wal
+synchronous: normal
+cache_size: -65536
+mmap_size: 268435456
+"""
+
+
+def _model_queries_data_stack(directory, tuned):
+    directory = Path(directory)
+    (directory / "data_stack.yaml").write_text("created_at: benchmark\n")
+    (directory / "stores").mkdir(exist_ok=True)
+    spec = "type: libds.store.sqlite.SQLite\npath: ./store.sqlite3\n"
+    if tuned:
+        spec += TUNED_SQLITE
+    (directory / "stores" / "store.yaml").write_text(spec)
+    # NOTE both models have the generated column, so the queries are
+    # the same, only the tuned one has it indexed.
+    (directory / "models").mkdir(exist_ok=True)
+    (directory / "models" / "lookup.sql").write_text(
+        '{{ json_column("key", "c0", type="INTEGER") }}\n'
+        + ('{{ index("key") }}\n' if tuned else "")
+        + 'SELECT * FROM {{ depends_on("public.events_raw") }}\n'
+    )
+    return DataStack.from_dir(directory)
+
+
+def benchmark_model_queries(directory, num_rows, tuned, width=4, num_queries=200):
+    result = dict(rows=num_rows, width=width, tuned=tuned, queries=num_queries)
+    ds = _model_queries_data_stack(directory, tuned)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        ds.store.load_raw_from_records(
+            schema_name="public",
+            table_name="events_raw",
+            records=generate_records(num_rows, width),
+        )
+        start = time.perf_counter()
+        ds.get_model("lookup").load_data()
+        result["refresh_s"] = time.perf_counter() - start
+
+    keys = [1_000_000_000 + (i * 7919) % num_rows for i in range(num_queries)]
+    timings = []
+    for key in keys:
+        start = time.perf_counter()
+        rows = list(ds.store.execute_sql(f"SELECT * FROM lookup WHERE key = {key}"))
+        timings.append(time.perf_counter() - start)
+        assert len(rows) == 1
+    result.update(
+        query_s=dict(min=min(timings), median=statistics.median(timings)),
+        queries_per_s=num_queries / sum(timings),
+    )
+    return result
+
+
+def _clickhouse_available(host, port):
+    try:
+        from clickhouse_driver import Client
+
+        Client(host=host, port=port, connect_timeout=2).execute("SELECT 1")
+        return True
+    except Exception:
+        return False
+
+
+def _run_in_fresh_process(fn, *args, **kwargs):
+    # NOTE every case gets its own process so peak rss is that of the
+    # case and not of everything which ran before it.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(fn, *args, **kwargs).result()
+
+
+def results_json(results, **parameters):
+    return dict(
+        meta=dict(
+            version=__version__,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            created_at=datetime.utcnow().isoformat() + "Z",
+            parameters=parameters,
+        ),
+        results=results,
+    )
+
+
+def _dump(data, out):
+    if out is None:
+        json.dump(data, sys.stdout, indent=2)
+        print("")
+    else:
+        with open(out, "w") as file:
+            json.dump(data, file, indent=2)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("-n", "--sources", "num_sources", type=int, multiple=True, default=[10])
+@click.option("-m", "--models", "num_models", type=int, multiple=True, default=[50])
+@click.option(
+    "--shape", "shapes", type=click.Choice(SHAPES), multiple=True, default=SHAPES
+)
+@click.option("--store", type=click.Choice(["file", "memory"]), default="file")
+@click.option("--repeat", type=int, default=3)
+@click.option("--tick/--no-tick", default=True)
+@click.option("-o", "--out", type=click.Path(dir_okay=False), default=None)
+def data_stack(num_sources, num_models, shapes, store, repeat, tick, out):
+    results = []
+    for shape in shapes:
+        for n in num_sources:
+            for m in num_models:
+                with tempfile.TemporaryDirectory(prefix="ds-bench-") as directory:
+                    results.append(
+                        benchmark_data_stack(
+                            directory,
+                            n,
+                            m,
+                            shape,
+                            store,
+                            repeat=repeat,
+                            tick=tick and store == "file",
+                        )
+                    )
+    _dump(
+        results_json(
+            results,
+            benchmark="data-stack",
+            sources=num_sources,
+            models=num_models,
+            shapes=shapes,
+            store=store,
+            repeat=repeat,
+        ),
+        out,
+    )
+
+
+@cli.command()
+@click.option("-r", "--rows", "num_rows", type=int, multiple=True, default=[100_000])
+@click.option("-w", "--width", "widths", type=int, multiple=True, default=[4, 32])
+@click.option(
+    "--store",
+    "stores",
+    type=click.Choice(INGESTION_STORES),
+    multiple=True,
+    default=INGESTION_STORES,
+)
+@click.option(
+    "--path",
+    "paths",
+    type=click.Choice(INGESTION_PATHS),
+    multiple=True,
+    default=INGESTION_PATHS,
+)
+@click.option("--clickhouse-host", default="localhost")
+@click.option("--clickhouse-port", type=int, default=9000)
+@click.option("-o", "--out", type=click.Path(dir_okay=False), default=None)
+def ingestion(num_rows, widths, stores, paths, clickhouse_host, clickhouse_port, out):
+    if "clickhouse" in stores and not _clickhouse_available(
+        clickhouse_host, clickhouse_port
+    ):
+        print(
+            f"No clickhouse at {clickhouse_host}:{clickhouse_port}, skipping it.",
+            file=sys.stderr,
+        )
+        stores = [s for s in stores if s != "clickhouse"]
+
+    results = []
+    for store in stores:
+        for path in paths:
+            for width in widths:
+                for n in num_rows:
+                    with tempfile.TemporaryDirectory(prefix="ds-bench-") as directory:
+                        results.append(
+                            _run_in_fresh_process(
+                                benchmark_ingestion,
+                                directory,
+                                store,
+                                path,
+                                n,
+                                width,
+                                clickhouse_host=clickhouse_host,
+                                clickhouse_port=clickhouse_port,
+                            )
+                        )
+    _dump(
+        results_json(
+            results,
+            benchmark="ingestion",
+            rows=num_rows,
+            widths=widths,
+            stores=stores,
+            paths=paths,
+        ),
+        out,
+    )
+
+
+@cli.command()
+@click.option("-r", "--rows", "num_rows", type=int, multiple=True, default=[100_000])
+@click.option("--queries", "num_queries", type=int, default=200)
+@click.option("-o", "--out", type=click.Path(dir_okay=False), default=None)
+def model_queries(num_rows, num_queries, out):
+    results = []
+    for n in num_rows:
+        for tuned in [False, True]:
+            with tempfile.TemporaryDirectory(prefix="ds-bench-") as directory:
+                results.append(
+                    _run_in_fresh_process(
+                        benchmark_model_queries,
+                        directory,
+                        n,
+                        tuned,
+                        num_queries=num_queries,
+                    )
+                )
+    _dump(
+        results_json(
+            results, benchmark="model-queries", rows=num_rows, queries=num_queries
+        ),
+        out,
+    )
+
+
+if __name__ == "__main__":
+    cli()
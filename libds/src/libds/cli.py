@@ -1,21 +1,29 @@
 #!/usr/bin/env python
 import functools
+import itertools
 import json
+import subprocess
 import sys
 import time
 import traceback
 import types
+import uuid
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 
-import arrow
 import click
 
 from libds.__version__ import __version__
 from libds.data_node import DataNodeState
-from libds.data_stack import DataStack
-from libds.model import PythonModel, SQLCodeModel, SQLQueryModel
+from libds.trace import (
+    TRACE_FILENAME,
+    TRACER,
+    read_spans,
+    span,
+    summarize_trace,
+    trace_ids,
+)
 from libds.utils import DoesNotExist, DSException, yaml_dump
 
 
@@ -25,7 +33,10 @@ class OutputEncoder(json.JSONEncoder):
             return obj.isoformat()
         if isinstance(obj, Path):
             return str(obj)
-        if isinstance(obj, arrow.Arrow):
+        # NOTE arrow is only ever imported along with a data stack,
+        # which we don't want to pull in just to encode the output.
+        arrow = sys.modules.get("arrow")
+        if arrow is not None and isinstance(obj, arrow.Arrow):
             return obj.isoformat()
         if isinstance(obj, types.GeneratorType):
             return list(obj)
@@ -36,19 +47,29 @@ class OutputEncoder(json.JSONEncoder):
 class Command:
     directory = None
     format = None
-    ds = None
+    _ds = None
 
     def __init__(self, directory, format):
-        directory = Path(directory)
-        self.directory = directory
+        self.directory = Path(directory)
         self.format = format
-        self.ds = None
-        if directory is not None:
-            self.ds = DataStack.from_dir(directory)
+        self._ds = None
+
+    @property
+    def ds(self):
+        if self._ds is None:
+            self.reload_data_stack()
+        return self._ds
 
     def reload_data_stack(self):
-        self.ds = DataStack.from_dir(self.ds.directory)
-        return self.ds
+        from libds.data_stack import DataStack
+
+        self._ds = DataStack.from_dir(self.directory)
+        return self._ds
+
+    def unloaded_data_stack(self):
+        from libds.data_stack import DataStack
+
+        return DataStack.from_dir(self.directory, load=False)
 
     def results(self, data):
         result = dict(meta=dict(version=__version__))
@@ -63,6 +84,11 @@ class Command:
         elif self.format == "json":
             json.dump(result, sys.stdout, cls=OutputEncoder)
             print("")
+        elif self.format == "msgpack":
+            from libds.msgpack_format import StreamingPacker
+
+            sys.stdout.flush()
+            StreamingPacker(sys.stdout.buffer).dump(result)
         else:
             raise ValueError(f"Unknown format {self.format}")
 
@@ -78,6 +104,45 @@ def _arg_json(arg):
     return json.loads(_arg_str(arg))
 
 
+def parse_importtime(stderr):
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line.replace("import time:", "", 1).split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        modules.append(
+            dict(
+                module=name.strip(),
+                self_us=int(parts[0]),
+                cumulative_us=int(parts[1]),
+                depth=(len(name) - len(name.lstrip()) - 1) // 2,
+            )
+        )
+    return modules
+
+
+def _profile_startup(args):
+    # NOTE by the time we get here libds.cli, and all it imports, are
+    # already loaded, so the command is profiled in a fresh interpreter.
+    cmd = [sys.executable, "-X", "importtime", "-m", "libds.cli"] + args
+    started_at = time.perf_counter()
+    proc = subprocess.run(
+        cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    wall_s = time.perf_counter() - started_at
+    modules = parse_importtime(proc.stderr)
+    return dict(
+        command=args,
+        returncode=proc.returncode,
+        wall_s=wall_s,
+        import_us=sum(m["self_us"] for m in modules),
+        modules=sorted(modules, key=lambda m: m["cumulative_us"], reverse=True),
+    )
+
+
 COMMAND = None
 
 
@@ -122,12 +187,31 @@ class ClickGroup(click.Group):
 @click.option(
     "-f",
     "--format",
-    type=click.Choice(["yaml", "json"], case_sensitive=False),
+    type=click.Choice(["yaml", "json", "msgpack"], case_sensitive=False),
     default="json",
 )
-def cli(directory, format):
+@click.option(
+    "--trace/--no-trace",
+    default=False,
+    help=f"Record spans in {TRACE_FILENAME}, implied when DS_TRACE_ID is set.",
+)
+@click.option(
+    "--profile-startup",
+    is_flag=True,
+    default=False,
+    help="Run the command under python -X importtime and report the time spent importing each module.",
+)
+@click.pass_context
+def cli(ctx, directory, format, trace, profile_startup):
     global COMMAND
     COMMAND = Command(directory, format)
+    if profile_startup:
+        args = [a for a in sys.argv[1:] if a != "--profile-startup"]
+        COMMAND.results(_profile_startup(args))
+        ctx.exit(0)
+    TRACER.configure(directory, trace_id=uuid.uuid4().hex if trace else None)
+    if TRACER.enabled:
+        ctx.with_resource(span(f"ds {ctx.invoked_subcommand}"))
 
 
 def command(**kwargs):
@@ -150,6 +234,37 @@ def info():
     return COMMAND.ds.info()
 
 
+@command()
+@click.argument("id")
+def source_info(id):
+    try:
+        return COMMAND.unloaded_data_stack().load_single_source(id).info()
+    except DoesNotExist:
+        return {"error": {"code": "source-does-not-exist", "id": id}}
+
+
+@command()
+@click.argument("id")
+def model_info(id):
+    ds = COMMAND.unloaded_data_stack()
+    try:
+        model = ds.load_single_model(id)
+    except DoesNotExist:
+        return {"error": {"code": "model-does-not-exist", "id": id}}
+    info = model.info()
+    info["data_nodes"] = {node.id: node.info() for node in model.data_nodes}
+    return info
+
+
+@command()
+@click.argument("tid")
+def task_info(tid):
+    try:
+        return COMMAND.unloaded_data_stack().load_single_task(tid).info()
+    except DoesNotExist:
+        return {"error": {"code": "task-does-not-exist", "id": tid}}
+
+
 @command()
 @click.argument("type", type=click.Choice(["source"], case_sensitive=False))
 @click.argument("id")
@@ -193,6 +308,8 @@ def model_update(model_id, type, if_exists, if_does_not_exist, current_id, sourc
         if if_does_not_exist == "error":
             return {"error": {"code": "model-does-not-exist", "id": current_id}}
 
+        from libds.model import PythonModel, SQLCodeModel, SQLQueryModel
+
         if type == "select":
             cls = SQLQueryModel
         elif type == "sql":
@@ -253,7 +370,15 @@ def execute(statement, limit):
     statement = _arg_str(statement)
     try:
         rows, sql = COMMAND.ds.execute_sql(statement, limit)
-        return dict(rows=list(rows), sql=sql)
+        if COMMAND.format == "msgpack":
+            # NOTE the stores run the query on the first next(), doing
+            # that here gets its errors reported as errors, the rest of
+            # the rows are streamed out as they're encoded.
+            first = list(itertools.islice(rows, 1))
+            rows = (row for row in itertools.chain(first, rows))
+        else:
+            rows = list(rows)
+        return dict(rows=rows, sql=sql)
     except DSException as e:
         return {"error": e.as_json()}
     except Exception as e:
@@ -279,6 +404,26 @@ def data_orchestrator_tick(loop):
         return COMMAND.ds.data_orchestrator.tick()
 
 
+@command()
+@click.option(
+    "--exit-when-idle",
+    is_flag=True,
+    default=False,
+    help="Exit once there's nothing to refresh and no other worker is refreshing anything.",
+)
+@click.option("--poll-interval", type=float, default=1.0)
+@click.option("--max-tasks", type=int, default=None)
+def worker(exit_when_idle, poll_interval, max_tasks):
+    from libds.worker import Worker
+
+    return Worker(
+        COMMAND.directory,
+        poll_interval=poll_interval,
+        exit_when_idle=exit_when_idle,
+        max_tasks=max_tasks,
+    ).run()
+
+
 @command(other_names=["dnu"])
 @click.option(
     "--state",
@@ -327,18 +472,67 @@ def data_node_refresh(node_id):
     return dict(node=node.info(), task=task.info())
 
 
+@command()
+@click.argument("table", required=False)
+@click.option("-s", "--schema", type=str, default="public")
+@click.option(
+    "--max-age",
+    type=str,
+    default=None,
+    help="Also drop tombstones, and working tables of no task, older than this, eg. 12h (default 1d).",
+)
+@click.option(
+    "--scan/--no-scan",
+    default=False,
+    help="Also look through the schema for tagged tables which aren't in the ledger.",
+)
+def cleanup(table, schema, max_age, scan):
+    store = COMMAND.ds.store
+    res = store.cleanup_tables(schema_name=schema, table_name=table, max_age=max_age)
+    if scan and table is not None:
+        for tag in ["working", "tombstone"]:
+            tables, reclaimed_bytes = store.drop_tables_by_tag(schema, table, tag)
+            res["tables_dropped"][tag].extend(tables)
+            res["reclaimed_bytes"] += reclaimed_bytes
+    return dict(table_name=table, schema_name=schema, **res)
+
+
 @command()
 @click.argument("table")
 @click.option("-s", "--schema", type=str, default="public")
-def cleanup(table, schema):
-    ds = COMMAND.ds
-    working = ds.store.drop_tables_by_tag(schema, table, "working")
-    tombstone = ds.store.drop_tables_by_tag(schema, table, "tombstone")
-    return dict(
-        table_name=table,
-        schema_name=schema,
-        tables_dropped=dict(working=working, tombstone=tombstone),
-    )
+@click.option(
+    "--format",
+    "export_format",
+    type=click.Choice(["parquet", "arrow", "csv"], case_sensitive=False),
+    default="parquet",
+)
+@click.option("-o", "--out", type=click.Path(dir_okay=False), required=True)
+@click.option("--row-group-size", type=int, default=100_000)
+def export(table, schema, export_format, out, row_group_size):
+    try:
+        return COMMAND.ds.export_table(
+            table,
+            export_format.lower(),
+            Path(out).resolve(),
+            schema_name=schema,
+            row_group_size=row_group_size,
+        )
+    except DoesNotExist:
+        return {"error": {"code": "table-does-not-exist", "id": f"{schema}.{table}"}}
+    except DSException as e:
+        return {"error": e.as_json()}
+
+
+@command()
+@click.argument("trace_id", required=False)
+@click.option("--last", type=int, default=1, help="Summarize the last N traces.")
+def trace(trace_id, last):
+    spans = read_spans(TRACER.path or COMMAND.directory / TRACE_FILENAME)
+    if trace_id is not None:
+        ids = [trace_id]
+    else:
+        ids = trace_ids(spans)[-last:]
+    return dict(traces=[summarize_trace(spans, id) for id in ids])
 
 
 @command()
@@ -1,7 +1,10 @@
 import json
 import os
-import sqlite3
+import random
+import resource
+import socket
 import sys
+import threading
 import time
 import traceback
 import uuid
@@ -13,11 +16,19 @@ from pathlib import Path
 from pprint import pformat, pprint  # noqa: F401
 from typing import Callable, Optional, Sequence, Union
 
-import arrow
-import psutil
-import setproctitle
+from libds.state_db import TASK_METRICS_COLUMNS, _fetch_one_value, state_db
+from libds.trace import span
+from libds.utils import DoesNotExist, ThreadLocalValue, parse_timedelta
 
-from libds.utils import parse_timedelta
+# NOTE how long a task, and its claim on a node, lasts without a
+# heartbeat, running tasks beat every third of that.
+LEASE = "1m"
+
+# NOTE a node whose refresh fails is retried after backoff, doubled on
+# every attempt up to max_backoff, until it has failed max_attempts
+# times in a row, then it is FAILED until it is set stale or refreshed
+# by hand.
+RETRY = dict(max_attempts=5, backoff="30s", max_backoff="1h")
 
 
 class DataNodeState(Enum):
@@ -26,88 +37,31 @@ class DataNodeState(Enum):
     EXPIRED = "EXPIRED"
     REFRESHING = "REFRESHING"
     REFRESHING_STALE = "REFRESHING_STALE"
+    FAILED = "FAILED"
 
     ORPHAN = "ORPHAN"
 
 
-def _fetch_one_value(cursor, query, *args):
-    return cursor.execute(query, *args).fetchone()[0]
-
-
 class DataOrchestrator:
     def __init__(self, data_stack):
         self.data_stack = data_stack
         self.data_nodes = {}
-
-    def _ensure_schema(self, conn):
-        count = _fetch_one_value(
-            conn.cursor(),
-            "select count(*) from sqlite_master where type = 'table' and tbl_name = 'settings'",
-        )
-        if count == 0:
-            cur = conn.cursor()
-            cur.execute("begin")
-            cur.execute("create table settings (key text, value text);")
-            cur.execute("insert into settings (key, value) values ('version', '0')")
-            conn.commit()
-
-        cur = conn.cursor()
-        version = _fetch_one_value(
-            cur, "select value from settings where key = 'version'"
-        )
-
-        if version == "2":
-            pass
-
-        elif version == "1":
-            cur = conn.cursor()
-            cur.execute("begin")
-            cur.execute("alter table tasks add column nid text;")
-            cur.execute("alter table tasks add column started_at text;")
-            cur.execute("alter table tasks add column completed_at text;")
-            cur.execute(
-                f"""
-                update tasks set
-                started_at = {SQLITE_TIMESTAMP("json_extract(info, '$.started_at')")},
-                completed_at = {SQLITE_TIMESTAMP("json_extract(info, '$.completed_at')")},
-                nid = json_extract(info, '$.nid');
-            """
-            )
-            cur.execute("alter table data_nodes add column stale_after text;")
-            cur.execute("update settings set value = '2' where key = 'version';")
-            conn.commit()
-
-        elif version == "0":
-            cur = conn.cursor()
-            cur.execute("begin")
-            cur.execute(
-                "create table tasks (tid text primary key, state text, info text)"
-            )
-            cur.execute(
-                "create table data_nodes (nid text primary key, state text not null, current_tid text references tasks(tid) default null)"
-            )
-            cur.execute("update settings set value = '1' where key = 'version'")
-            conn.commit()
-
-        else:
-            raise Exception(f"Version {version} in orchestrator db.")
-
-    def _connect(self):
-        db_filename = self.data_stack.directory / "orchestrator.sqlite3"
-        db_filename = db_filename.resolve()
-        return sqlite3.connect(db_filename, timeout=10)
+        config = (data_stack.config or {}).get("orchestrator") or {}
+        self.db = state_db(data_stack)
+        self.lease_s = parse_timedelta(config.get("lease", LEASE)).total_seconds()
+        # NOTE pool name => slots, nodes in a pool which isn't listed get
+        # one slot, the safe choice for a source database.
+        self.pools = config.get("pools") or {}
+        self.retry = config.get("retry") or {}
+        self._checked = False
 
     def connect(self):
-        conn = self._connect()
-        conn.execute("PRAGMA foreign_keys = ON")
-        conn.commit()
-        foreign_keys = conn.execute("pragma foreign_keys;").fetchone()[0]
-        if foreign_keys != 1:
-            raise Exception("sqlite3 doesn't support foreign_keys. this is bad.")
-        self._ensure_schema(conn)
-        conn.close
-
-        return self._connect()
+        if not self._checked:
+            conn = self.db.connect()
+            self.db.check(conn)
+            conn.close()
+            self._checked = True
+        return self.db.connect()
 
     def collect_nodes(self, nodes):
         for node in nodes:
@@ -123,10 +77,6 @@ class DataOrchestrator:
         for n in list(self.data_nodes.values()):
             n.backpatch_upstream()
 
-    def check_tasks(self):
-        # TODO need to go and look for tasks whose pid is in the db but they don't exist, these are zombies and should be killed 20210408:mb
-        return
-
     def load_node_state(self, node):
         conn = self.connect()
         res = conn.execute("SELECT state FROM data_nodes WHERE nid = ?", [node.id])
@@ -138,49 +88,238 @@ class DataOrchestrator:
         else:
             return OrphanDataNode(node.id)
 
-    def load_node_states(self):
+    def load_node_states(self, nids=None):
+        with span("orchestrator.load_node_states"):
+            self._load_node_states(nids)
+
+    def _load_node_states(self, nids):
         conn = self.connect()
         nodes = self.data_nodes
 
         conn.execute("begin;")
-        res = conn.execute("SELECT nid, state FROM data_nodes").fetchall()
+        if nids is None:
+            res = conn.execute(
+                "SELECT nid, state, retry_after FROM data_nodes"
+            ).fetchall()
+        else:
+            res = conn.execute(
+                f"SELECT nid, state, retry_after FROM data_nodes WHERE nid in ({ ','.join(['?'] * len(nids)) })",
+                nids,
+            ).fetchall()
 
-        for id, state in res:
+        for id, state, retry_after in res:
             if id in nodes:
                 nodes[id].state = DataNodeState(state)
+                nodes[id].retry_after = retry_after
             else:
                 nodes[id] = OrphanDataNode(id)
 
         for node in nodes.values():
             if node.state is None:
                 node.state = DataNodeState.STALE
+                # NOTE another process may have just inserted it too
                 conn.execute(
-                    "insert into data_nodes (nid, state, current_tid) values (?, ?, null)",
+                    "insert into data_nodes (nid, state, current_tid) values (?, ?, null) on conflict do nothing",
                     [node.id, DataNodeState.STALE.value],
                 )
         conn.commit()
         conn.close()
 
     def tick(self):
+        import arrow
+
         now = arrow.utcnow()
         ts = now.isoformat() + "Z"
         log_dir = self.data_stack.directory / "logs" / f"{ts}-{uuid.uuid4()}"
-        fork_and_check_for_zombies(self, log_dir)
+        self.reap_zombies()
+        for node in self.ready_nodes():
+            fork_and_refresh(self, node, log_dir)
+        self.set_due_nodes_stale()
+
+        return dict(log_dir=log_dir)
+
+    def pool_slots(self, pool):
+        return int(self.pools.get(pool, 1))
+
+    def free_slots(self):
+        """Pool name => the slots not taken by the nodes refreshing now."""
+        free = {}
+        for node in self.data_nodes.values():
+            if node.pool is None:
+                continue
+            free.setdefault(node.pool, self.pool_slots(node.pool))
+            if node.state in (DataNodeState.REFRESHING, DataNodeState.REFRESHING_STALE):
+                free[node.pool] -= 1
+        return free
+
+    def critical_paths(self):
+        """Node id => the number of nodes on the longest chain of
+        downstream nodes starting at it (itself included)."""
+        downstream = {nid: [] for nid in self.data_nodes}
+        upstream = {nid: [] for nid in self.data_nodes}
+        for node in self.data_nodes.values():
+            for up in node.upstream_nodes():
+                downstream.setdefault(up.id, []).append(node.id)
+                upstream.setdefault(node.id, []).append(up.id)
+
+        # NOTE in reverse topological order, a node's length is known
+        # once those of all its downstream nodes are.
+        waiting_on = {nid: len(downs) for nid, downs in downstream.items()}
+        done = [nid for nid, count in waiting_on.items() if count == 0]
+        lengths = {}
+        while done:
+            nid = done.pop()
+            lengths[nid] = 1 + max(
+                (lengths[down] for down in downstream[nid]), default=0
+            )
+            for up in upstream.get(nid, []):
+                waiting_on[up] -= 1
+                if waiting_on[up] == 0:
+                    done.append(up)
+        if len(lengths) < len(downstream):
+            cycle = sorted(set(downstream) - set(lengths))
+            raise Exception(f"Dependency cycle through (or upstream of) {cycle}")
+        return lengths
+
+    def ready_nodes(self):
+        """The STALE nodes, not backing off after a failure, whose
+        upstream nodes are all FRESH, no more per pool than it has free
+        slots. Highest priority first, then longest critical path first,
+        so the nodes holding back the most work start early."""
+        ready = []
+        now = datetime.utcnow().isoformat(timespec="milliseconds")
         for node in self.data_nodes.values():
             if node.state == DataNodeState.STALE:
+                if node.retry_after is not None and node.retry_after > now:
+                    continue
                 if node.upstream is None:
                     raise Exception(f"no upstream list for {node.id}")
+                if all(up.is_fresh() for up in node.upstream_nodes()):
+                    ready.append(node)
+        if not ready:
+            return ready
+
+        critical_paths = self.critical_paths()
+        ready.sort(key=lambda n: (-n.priority, -critical_paths[n.id], n.id))
+        free = self.free_slots()
+        scheduled = []
+        for node in ready:
+            if node.pool is not None:
+                if free[node.pool] <= 0:
+                    continue
+                free[node.pool] -= 1
+            scheduled.append(node)
+        return scheduled
+
+    def set_due_nodes_stale(self):
+        import arrow
 
-                fresh = [node.is_fresh() for node in node.upstream_nodes()]
-
-                if all(fresh):
-                    fork_and_refresh(self, node, log_dir)
-            else:
-                refresh_at = node.next_refresh_at()
-                if refresh_at is not None and refresh_at < arrow.get():
-                    self.set_node_stale(node.id)
+        for node in self.data_nodes.values():
+            if node.state == DataNodeState.STALE:
+                continue
+            refresh_at = node.next_refresh_at()
+            if refresh_at is not None and refresh_at < arrow.get():
+                # NOTE downstream nodes only go stale once this
+                # refresh completes, and only if it changed anything.
+                with self.cursor() as cur:
+                    _set_nodes_stale(cur, [node.id])
+
+    def retry_policy(self, node):
+        return RetryPolicy.from_config(self.retry, None if node is None else node.retry)
+
+    def claim_node(self, nid, tid, info, owner, force=False):
+        """Starts task tid on nid, leased to owner for lease_s seconds,
+        if nid is STALE, not backing off, and its pool has a free slot
+        (or, with force, whatever its state and pool). Raises IsNotStale,
+        IsBackingOff or PoolIsFull, and starts nothing, when it can't."""
+        node = self.data_nodes.get(nid)
+        pool = None if node is None else node.pool
+        with self.cursor() as cur:
+            cur.execute(
+                f"insert into tasks (started_at, heartbeat_at, nid, tid, state, info) values ({self.db.timestamp()}, {self.db.timestamp()}, ?, ?, 'RUNNING', ?)",
+                [nid, tid, json.dumps(info)],
+            )
+            # NOTE the state and pool checks and the update are one
+            # statement, of any number of processes claiming a node only
+            # one gets it, and no more than a pool's slots are taken.
+            where, args = "", []
+            if not force:
+                where = f"and state = 'STALE' and (retry_after is null or retry_after <= {self.db.timestamp()})"
+                if pool is not None:
+                    self.db.lock(cur, "libds.pool." + pool)
+                    where += """ and (select count(*) from data_nodes
+                                      where pool = ? and state in ('REFRESHING', 'REFRESHING_STALE')) < ?"""
+                    args = [pool, self.pool_slots(pool)]
+            cur.execute(
+                f"""update data_nodes
+                    set state = ?, current_tid = ?, lease_owner = ?, lease_expires_at = {self.db.timestamp(self.lease_s)}, pool = ?
+                    where nid = ? {where}""",
+                [DataNodeState.REFRESHING.value, tid, owner, pool, nid] + args,
+            )
+            if cur.rowcount == 0 and not force:
+                row = cur.execute(
+                    f"select state, retry_after, retry_after > {self.db.timestamp()} from data_nodes where nid = ?",
+                    [nid],
+                ).fetchone()
+                if row is None or row[0] != DataNodeState.STALE.value:
+                    raise IsNotStale(row[0] if row else None)
+                if row[2]:
+                    raise IsBackingOff(row[1])
+                raise PoolIsFull(pool)
+
+    def heartbeat(self, nid, tid):
+        """Records that task tid is still running and renews its lease on
+        nid. Returns whether it still holds the lease."""
+        with self.cursor() as cur:
+            cur.execute(
+                f"update tasks set heartbeat_at = {self.db.timestamp()} where tid = ? and state = 'RUNNING'",
+                [tid],
+            )
+            cur.execute(
+                f"update data_nodes set lease_expires_at = {self.db.timestamp(self.lease_s)} where nid = ? and current_tid = ?",
+                [nid, tid],
+            )
+            return cur.rowcount == 1
 
-        return dict(log_dir=log_dir)
+    def reap_zombies(self):
+        """Marks ZOMBIE the running tasks which stopped heartbeating, or
+        whose lease on their node expired, and puts their nodes back to
+        STALE. Returns the ids of those nodes."""
+        now = self.db.timestamp()
+        with self.cursor() as cur:
+            # NOTE tasks started before heartbeats existed have none
+            tids = [
+                row[0]
+                for row in cur.execute(
+                    f"select tid from tasks where state = 'RUNNING' and coalesce(heartbeat_at, started_at) < {self.db.timestamp(-self.lease_s)}"
+                ).fetchall()
+            ]
+            tids += [
+                row[0]
+                for row in cur.execute(
+                    f"select current_tid from data_nodes where state in ('REFRESHING', 'REFRESHING_STALE') and lease_expires_at < {now}"
+                ).fetchall()
+                if row[0] not in tids
+            ]
+            nids = []
+            for tid in tids:
+                cur.execute(
+                    f"update tasks set state = 'ZOMBIE', completed_at = {now} where tid = ? and state = 'RUNNING'",
+                    [tid],
+                )
+                nids += [
+                    row[0]
+                    for row in cur.execute(
+                        "select nid from data_nodes where current_tid = ?", [tid]
+                    ).fetchall()
+                ]
+                cur.execute(
+                    "update data_nodes set state = 'STALE', current_tid = null, lease_owner = null, lease_expires_at = null where current_tid = ?",
+                    [tid],
+                )
+        if tids:
+            print(f"Found {len(tids)} zombie tasks, {nids} set back to stale")
+        return nids
 
     def delete_node(self, node_id):
         node = self.data_nodes[node_id]
@@ -201,39 +340,43 @@ class DataOrchestrator:
     def set_node_stale(self, node_id):
         node = self.data_nodes[node_id]
         downstream = [node] + node.downstream_nodes()
-        downstream = [n.id for n in downstream]
         with self.cursor() as cur:
+            # NOTE asking for a refresh also gives a failing node a fresh
+            # set of attempts
             cur.execute(
-                f"update data_nodes set state = 'STALE' where state = 'FRESH' and nid in ({ ','.join(['?'] * len(downstream)) })",
-                downstream,
+                "update data_nodes set attempts = 0, retry_after = null where nid = ?",
+                [node_id],
             )
             cur.execute(
-                f"update data_nodes set state = 'REFRESHING_STALE' where state = 'REFRESHING' and nid in ({ ','.join(['?'] * len(downstream)) })",
-                downstream,
+                "update data_nodes set state = 'STALE' where nid = ? and state = 'FAILED'",
+                [node_id],
             )
+            _set_nodes_stale(cur, [n.id for n in downstream])
 
     @contextmanager
     def cursor(self):
-        conn = self.connect()
-        cur = conn.cursor()
-        cur.execute("begin;")
+        with span("orchestrator.cursor"):
+            conn = self.connect()
+            cur = conn.cursor()
+            cur.execute("begin;")
 
-        try:
-            yield cur
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+            try:
+                yield cur
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                conn.close()
 
-    def last_task_for_node(self, nid):
+    def last_task_for_node(self, nid, state=None):
+        states = "" if state is None else f"and state = '{state}'"
         with self.cursor() as cur:
             res = cur.execute(
-                """with s as (select max(started_at) as started_at from tasks where nid = ? group by nid)
-                   select tid, state, nid, started_at, completed_at, info
+                f"""with s as (select max(started_at) as started_at from tasks where nid = ? {states} group by nid)
+                   select {TASK_COLUMNS}
                    from tasks
-                   where started_at in (select started_at from s) and nid = ? """,
+                   where started_at in (select started_at from s) and nid = ? {states}""",
                 [nid, nid],
             )
             row = res.fetchone()
@@ -243,7 +386,7 @@ class DataOrchestrator:
                 return self._task_from_row(row)
 
     def _task_from_row(self, row):
-        (tid, state, nid, started_at, completed_at, info_json) = row
+        (tid, state, nid, started_at, completed_at, info_json, heartbeat_at) = row[:7]
         return Task(
             nid=nid,
             id=tid,
@@ -251,21 +394,35 @@ class DataOrchestrator:
             started_at=started_at,
             completed_at=completed_at,
             _info=json.loads(info_json),
+            metrics=TaskMetrics(*row[7:]),
+            heartbeat_at=heartbeat_at,
         )
 
     def load_task(self, tid):
         with self.cursor() as cur:
             res = cur.execute(
-                "select tid, state, nid, started_at, completed_at, info from tasks where tid = ?",
+                f"select {TASK_COLUMNS} from tasks where tid = ?",
                 [tid],
             )
-            return self._task_from_row(res.fetchone())
+            row = res.fetchone()
+            if row is None:
+                raise DoesNotExist(f"Task: {tid}")
+            return self._task_from_row(row)
 
-    def tasks(self):
+    def running_tasks(self, tids):
+        """The ones of tids which are still RUNNING."""
+        if not tids:
+            return set()
         with self.cursor() as cur:
             res = cur.execute(
-                "select tid, state, nid, started_at, completed_at, info from tasks"
+                f"select tid from tasks where state = 'RUNNING' and tid in ({','.join(['?'] * len(tids))})",
+                list(tids),
             )
+            return set(row[0] for row in res.fetchall())
+
+    def tasks(self):
+        with self.cursor() as cur:
+            res = cur.execute(f"select {TASK_COLUMNS} from tasks")
             return [self._task_from_row(row) for row in res.fetchall()]
 
     def info(self):
@@ -287,6 +444,10 @@ class DataNode:
     state: Optional[DataNodeState] = None
     refresher: Optional[Callable] = None
     orchestrator: Optional[DataOrchestrator] = None
+    pool: Optional[str] = None
+    priority: int = 0
+    retry: Optional[dict] = None
+    retry_after: Optional[str] = None
 
     def backpatch_upstream(self):
         nodes = self.orchestrator.data_nodes
@@ -309,6 +470,14 @@ class DataNode:
             raise Exception(f"upstream of {self.id} is None, didn't we call backpatch?")
         return self.upstream
 
+    def dependent_nodes(self):
+        """The nodes with this one in their upstream, not theirs."""
+        return [
+            down
+            for down in self.orchestrator.data_nodes.values()
+            if self in down.upstream_nodes()
+        ]
+
     def downstream_nodes(self):
         nodes = self.orchestrator.data_nodes
         downstream = {}
@@ -339,17 +508,27 @@ class DataNode:
                 "state": last_task.state,
                 "started_at": last_task.started_at,
                 "completed_at": last_task.completed_at,
+                "metrics": last_task.metrics.info(),
             }
         else:
             i["last_task"] = None
 
         i["stale_after"] = self.stale_after
         i["next_refresh_at"] = self.next_refresh_at()
+        i["pool"] = self.pool
+        i["priority"] = self.priority
+        i["retry_after"] = self.retry_after
 
         return i
 
     def refresh(self, orchestrator):
-        self.refresher(orchestrator)
+        return self.refresher(orchestrator)
+
+    def last_refresh_result(self):
+        task = self.orchestrator.last_task_for_node(self.id, state="DONE")
+        if task is None:
+            return None
+        return task._info.get("result")
 
     def is_fresh(self):
         return self.state == DataNodeState.FRESH
@@ -360,6 +539,8 @@ class DataNode:
         if self.stale_after is None:
             return None
         else:
+            import arrow
+
             last_task = self.orchestrator.last_task_for_node(self.id)
             if last_task is None:
                 return arrow.get()
@@ -398,6 +579,82 @@ class OrphanDataNode(DataNode):
         return None
 
 
+TASK_COLUMNS = ", ".join(
+    ["tid", "state", "nid", "started_at", "completed_at", "info", "heartbeat_at"]
+    + [column for column, _ in TASK_METRICS_COLUMNS]
+)
+
+
+@dataclass
+class TaskMetrics:
+    wall_s: Optional[float] = None
+    cpu_s: Optional[float] = None
+    peak_rss: Optional[int] = None
+    rows_read: Optional[int] = None
+    rows_written: Optional[int] = None
+    bytes_written: Optional[int] = None
+
+    def add_io(self, rows_read=None, rows_written=None, bytes_written=None):
+        # NOTE None means the store couldn't tell, so a task which
+        # loads nothing measurable keeps None and not a misleading 0.
+        for name, value in [
+            ("rows_read", rows_read),
+            ("rows_written", rows_written),
+            ("bytes_written", bytes_written),
+        ]:
+            if value is not None:
+                setattr(self, name, (getattr(self, name) or 0) + value)
+
+    def values(self):
+        return [getattr(self, column) for column, _ in TASK_METRICS_COLUMNS]
+
+    def info(self):
+        return {column: getattr(self, column) for column, _ in TASK_METRICS_COLUMNS}
+
+
+CURRENT_TASK_METRICS = ThreadLocalValue()
+# NOTE the task refreshing on this thread, it owns the working tables
+# the store creates for the refresh.
+CURRENT_TASK_ID = ThreadLocalValue()
+
+
+def record_task_io(rows_read=None, rows_written=None, bytes_written=None):
+    metrics = CURRENT_TASK_METRICS.value
+    if metrics is not None:
+        metrics.add_io(
+            rows_read=rows_read, rows_written=rows_written, bytes_written=bytes_written
+        )
+
+
+class TaskMeter:
+    """Measures a refresh. isolated says whether the refresh has a
+    process to itself (eg forked off by tick), only then is the
+    process's peak rss the task's."""
+
+    def __init__(self, isolated=False):
+        self.metrics = TaskMetrics()
+        self.isolated = isolated
+
+    def __enter__(self):
+        CURRENT_TASK_METRICS.value = self.metrics
+        self.started_at = time.perf_counter()
+        # NOTE the refresh runs on this thread, the heartbeat's (and any
+        # other's) cpu isn't the task's.
+        self.cpu_started_at = time.thread_time()
+        return self.metrics
+
+    def __exit__(self, *exc):
+        CURRENT_TASK_METRICS.value = None
+        self.metrics.wall_s = time.perf_counter() - self.started_at
+        self.metrics.cpu_s = time.thread_time() - self.cpu_started_at
+        if self.isolated:
+            # NOTE ru_maxrss is in KiB
+            self.metrics.peak_rss = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            )
+        return False
+
+
 @dataclass
 class Task:
     id: str
@@ -406,6 +663,8 @@ class Task:
     started_at: str
     completed_at: str
     _info: object
+    metrics: TaskMetrics = None
+    heartbeat_at: str = None
 
     def info(self):
         i = dict(
@@ -414,7 +673,9 @@ class Task:
             nid=self.nid,
             started_at=self.started_at,
             completed_at=self.completed_at,
+            heartbeat_at=self.heartbeat_at,
             info=self._info.copy(),
+            metrics=self.metrics.info() if self.metrics else None,
         )
         for stream in ["stdout", "stderr"]:
             filename = i["info"].get(stream)
@@ -449,118 +710,243 @@ class IsNotStale(Exception):
         self.state = state
 
 
-def SQLITE_TIMESTAMP(value=None):
-    if value is None:
-        value = "'now'"
-    return f"strftime('%Y-%m-%dT%H:%M:%f', {value})"
+class PoolIsFull(Exception):
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
 
+class IsBackingOff(Exception):
+    def __init__(self, retry_after):
+        super().__init__()
+        self.retry_after = retry_after
 
-def _state_to_running(orchestrator, nid, tid, info):
-    with orchestrator.cursor() as cur:
-        cur.execute(
-            f"insert into tasks (started_at, nid, tid, state, info) values ({SQLITE_TIMESTAMP()}, ?, ?, 'RUNNING', ?)",
-            [
-                nid,
-                tid,
-                json.dumps(info),
-            ],
-        )
-        cur.execute(
-            "update data_nodes set state = ?, current_tid = ? where nid = ?",
-            [DataNodeState.REFRESHING.value, tid, nid],
-        )
 
+class RetryPolicy:
+    def __init__(self, max_attempts, backoff, max_backoff):
+        self.max_attempts = int(max_attempts)
+        self.backoff_s = parse_timedelta(backoff).total_seconds()
+        self.max_backoff_s = parse_timedelta(max_backoff).total_seconds()
 
-def _state_to_refreshing(orchestrator, nid, tid, info):
-    with orchestrator.cursor() as cur:
-        state = _fetch_one_value(
-            cur, "select state from data_nodes where nid = ?", [nid]
-        )
-    if state == "STALE":
-        _state_to_running(orchestrator, nid, tid, info)
-    else:
-        raise IsNotStale(state)
+    @classmethod
+    def from_config(cls, *configs):
+        settings = dict(RETRY)
+        for config in configs:
+            unknown = set(config or {}) - set(RETRY)
+            if unknown:
+                raise ValueError(
+                    f"Unknown retry settings {sorted(unknown)}, not one of {list(RETRY)}"
+                )
+            settings.update(config or {})
+        return cls(**settings)
+
+    def delay(self, attempts):
+        """Seconds to wait after the attempts-th failure in a row. Half
+        of it is random, nodes which failed together (eg when their
+        source was down) don't all retry at once."""
+        delay = min(self.max_backoff_s, self.backoff_s * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _task_metrics_assignments():
+    return ", ".join(f"{column} = ?" for column, _ in TASK_METRICS_COLUMNS)
+
+
+def _early_cutoff(node, result):
+    # NOTE a refresh which produced the same output as the last one
+    # counts as unchanged, whatever its refresher thinks.
+    if result is None or result.get("fingerprint") is None:
+        return result
+    last_result = node.last_refresh_result() or {}
+    result["unchanged"] = result["fingerprint"] == last_result.get("fingerprint")
+    return result
+
+
+def _set_nodes_stale(cur, nids):
+    placeholders = ",".join(["?"] * len(nids))
+    cur.execute(
+        f"update data_nodes set state = 'STALE' where state = 'FRESH' and nid in ({placeholders})",
+        nids,
+    )
+    cur.execute(
+        f"update data_nodes set state = 'REFRESHING_STALE' where state = 'REFRESHING' and nid in ({placeholders})",
+        nids,
+    )
+
+
+def _set_downstream_stale(cur, node, result):
+    """Once a refresh of node completes, the nodes which depend on it
+    directly are stale, unless the refresh reports its output unchanged.
+    Each of those in turn decides for its own dependents when its
+    refresh completes, so an unchanged output anywhere along a chain
+    stops it there. A node which is merely due (see
+    set_due_nodes_stale) doesn't touch its downstream nodes, its
+    refresh does, when it's done."""
+    if (result or {}).get("unchanged", False):
+        return
+    dependents = [n.id for n in node.dependent_nodes()]
+    if dependents:
+        _set_nodes_stale(cur, dependents)
 
 
-def _task_complete(orchestrator, nid, tid):
+def _task_complete(orchestrator, node, tid, metrics, result):
     with orchestrator.cursor() as cur:
         cur.execute(
-            "update data_nodes set state = ?, current_tid = null where nid = ? and current_tid = ?",
-            [DataNodeState.FRESH.value, nid, tid],
+            "update data_nodes set state = ?, current_tid = null, lease_owner = null, lease_expires_at = null, attempts = 0, retry_after = null where nid = ? and current_tid = ?",
+            [DataNodeState.FRESH.value, node.id, tid],
         )
+        info = _fetch_one_value(cur, "select info from tasks where tid = ?", [tid])
+        info = json.loads(info)
+        if result is not None:
+            info["result"] = result
         cur.execute(
-            f"update tasks set state = 'DONE', completed_at = {SQLITE_TIMESTAMP()} where tid = ?",
-            [tid],
+            f"update tasks set state = 'DONE', completed_at = {orchestrator.db.timestamp()}, info = ?, {_task_metrics_assignments()} where tid = ?",
+            [json.dumps(info)] + metrics.values() + [tid],
         )
+        _set_downstream_stale(cur, node, result)
 
 
-def _task_failed(orchestrator, nid, tid, e, tb):
+def _task_failed(orchestrator, nid, tid, e, tb, metrics):
+    policy = orchestrator.retry_policy(orchestrator.data_nodes.get(nid))
     with orchestrator.cursor() as cur:
+        attempts = 1 + _fetch_one_value(
+            cur, "select attempts from data_nodes where nid = ?", [nid]
+        )
+        if attempts >= policy.max_attempts:
+            state, retry_after = DataNodeState.FAILED, "null"
+            print(f"{nid} failed {attempts} times in a row, giving up.")
+        else:
+            delay = policy.delay(attempts)
+            state, retry_after = DataNodeState.STALE, orchestrator.db.timestamp(delay)
+            print(f"{nid} failed {attempts} times in a row, retrying in {delay:.0f}s.")
+        # NOTE a task whose lease expired no longer owns the node
         cur.execute(
-            "update data_nodes set state = ?, current_tid = null where nid = ?",
-            [DataNodeState.STALE.value, nid],
+            f"update data_nodes set state = ?, current_tid = null, lease_owner = null, lease_expires_at = null, attempts = ?, retry_after = {retry_after} where nid = ? and current_tid = ?",
+            [state.value, attempts, nid, tid],
         )
         info = _fetch_one_value(cur, "select info from tasks where tid = ?", [tid])
         info = json.loads(info)
         info["error"] = e
         info["traceback"] = tb
         cur.execute(
-            f"update tasks set state = 'ERRORED', completed_at = {SQLITE_TIMESTAMP()}, info = ? where tid = ?",
-            [json.dumps(info), tid],
+            f"update tasks set state = 'ERRORED', completed_at = {orchestrator.db.timestamp()}, info = ?, {_task_metrics_assignments()} where tid = ?",
+            [json.dumps(info)] + metrics.values() + [tid],
         )
 
 
-def trigger_refresh(orchestrator, node, info, force=False):
+class TaskHeartbeat:
+    """Beats, from a background thread, for task tid for as long as the
+    refresh runs, which also renews its lease on node nid."""
+
+    def __init__(self, orchestrator, nid, tid):
+        self.orchestrator = orchestrator
+        self.nid = nid
+        self.tid = tid
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.orchestrator.lease_s / 3):
+            try:
+                holds_lease = self.orchestrator.heartbeat(self.nid, self.tid)
+            except self.orchestrator.db.retryable_errors as e:
+                print(f"Failed to heartbeat for {self.tid}: {e}")
+                continue
+            if not holds_lease and not self.lost:
+                # NOTE it expired and someone else may now be refreshing
+                # the node, our result will be ignored. The task itself
+                # is still alive, so keep beating.
+                print(f"Lost the lease on {self.nid} to another task.")
+                self.lost = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+def claim_refresh(orchestrator, node, info, force=False, owner=None):
+    """Claims node for a new task, returns its id or None when the node
+    can't be refreshed now."""
     print(f"Refresh on {node.id} triggered")
     pid = os.getpid()
-    tid = datetime.utcnow().strftime("%Y%m%dT%H:%M:%S") + "-" + str(pid)
+    tid = datetime.utcnow().strftime("%Y%m%dT%H:%M:%S.%f") + "-" + str(pid)
+    if owner is None:
+        owner = f"{socket.gethostname()}:{pid}"
 
     info["pid"] = pid
     info["nid"] = node.id
+    info["owner"] = owner
 
     while True:
         try:
-            _state_to_refreshing(orchestrator, node.id, tid, info)
-            break
-        except sqlite3.OperationalError as oe:
-            print(f"sqllite3.OperationalError: {oe}")
+            orchestrator.claim_node(node.id, tid, info, owner, force=force)
+            return tid
+        except orchestrator.db.retryable_errors as oe:
+            print(f"{type(oe).__name__}: {oe}")
             time.sleep(1)
         except IsNotStale as ins:
-            if force:
-                _state_to_running(orchestrator, node.id, tid, info)
-                break
-            else:
-                print(f"is not stale (is {ins.state}). not refreshing.")
-                return
+            print(f"is not stale (is {ins.state}). not refreshing.")
+            return None
+        except PoolIsFull as pif:
+            print(f"no free slot in pool {pif.pool}. not refreshing.")
+            return None
+        except IsBackingOff as ibo:
+            print(f"backing off until {ibo.retry_after}. not refreshing.")
+            return None
+
 
+def run_refresh(orchestrator, node, tid, isolated=False):
+    """Refreshes node, for the already claimed task tid, and records
+    the outcome. Re raises the refresh's exception."""
+    meter = TaskMeter(isolated=isolated)
+    CURRENT_TASK_ID.value = tid
     try:
-        node.refresh(orchestrator)
+        with meter, span("DataNode.refresh", nid=node.id, tid=tid):
+            result = _early_cutoff(node, node.refresh(orchestrator))
         while True:
             try:
-                _task_complete(orchestrator, node.id, tid)
+                _task_complete(orchestrator, node, tid, meter.metrics, result)
                 break
-            except sqlite3.OperationalError as oe:
+            except orchestrator.db.retryable_errors as oe:
                 print(f"OperationalError: {oe}")
                 time.sleep(1)
     except Exception as e:
-        print(f"{node.id} refresh error {e} setting back to stale")
-        tb = traceback.format_exc()
-        while True:
-            try:
-                _task_failed(orchestrator, node.id, tid, str(e), tb)
-                break
-            except sqlite3.OperationalError as oe:
-                print(f"OperationalError: {oe}")
-                time.sleep(1)
-            except Exception as e:
-                print(f"Exception: this is bad {e}")
-                raise e
-
+        print(f"{node.id} refresh error {e}")
+        _record_task_failed(
+            orchestrator, node.id, tid, str(e), traceback.format_exc(), meter.metrics
+        )
         print("Re raising exception")
         raise e
     finally:
+        CURRENT_TASK_ID.value = None
         print("Exiting trigger_refresh")
 
+
+def _record_task_failed(orchestrator, nid, tid, e, tb, metrics):
+    while True:
+        try:
+            _task_failed(orchestrator, nid, tid, e, tb, metrics)
+            break
+        except orchestrator.db.retryable_errors as oe:
+            print(f"OperationalError: {oe}")
+            time.sleep(1)
+        except Exception as e:
+            print(f"Exception: this is bad {e}")
+            raise e
+
+
+def trigger_refresh(orchestrator, node, info, force=False, owner=None, isolated=False):
+    tid = claim_refresh(orchestrator, node, info, force=force, owner=owner)
+    if tid is None:
+        return None
+    with TaskHeartbeat(orchestrator, node.id, tid):
+        run_refresh(orchestrator, node, tid, isolated=isolated)
     return tid
 
 
@@ -626,6 +1012,8 @@ def fork_and_refresh(orchestrator, node, log_dir):
     if fork() > 0:
         sys.exit()
 
+    import setproctitle
+
     setproctitle.setproctitle(sys.argv[0] + " data-node-refresh " + node.id)
 
     sys.stdout = TaskOutputStream(stdout_file)
@@ -636,82 +1024,7 @@ def fork_and_refresh(orchestrator, node, log_dir):
         print(str(os.getpid()), file=file)
 
     info = dict(stdout=str(stdout_file.resolve()), stderr=str(stderr_file.resolve()))
-    trigger_refresh(orchestrator, node, info)
-
-    if pid_file.exists():
-        pid_file.unlink()
-
-    sys.exit(0)
-
-
-def check_for_zombies(orchestrator):
-    with orchestrator.cursor() as cur:
-        count = 0
-        zombies = 0
-        res = cur.execute("select tid, info from tasks where state = 'RUNNING'")
-        for row in res.fetchall():
-            count += 1
-            tid = row[0]
-            info = json.loads(row[1])
-            pid = info["pid"]
-            if not psutil.pid_exists(pid):
-                zombies += 1
-                cur.execute(
-                    f"update tasks set state = 'ZOMBIE', completed_at = {SQLITE_TIMESTAMP()} where tid = ?",
-                    [tid],
-                )
-
-        if zombies > 0:
-            print(f"Found {zombies} zombie tasks out of {count} running")
-
-            nodes = _fetch_one_value(
-                cur,
-                "select count(*) from data_nodes where current_tid in (select tid from tasks where state = 'ZOMBIE')",
-            )
-            print(f"{nodes} affected.")
-
-            cur.execute(
-                "update data_nodes set state = 'STALE', current_tid = null where current_tid in (select tid from tasks where state = 'ZOMBIE')"
-            )
-
-
-def fork_and_check_for_zombies(orchestrator, log_dir):
-    with orchestrator.cursor() as cur:
-        running = _fetch_one_value(
-            cur, "select count(*) from tasks where state = 'RUNNING'"
-        )
-        if running == 0:
-            return
-
-    def log_file(suffix):
-        return log_dir / ("check_for_zombies." + suffix)
-
-    pid_file = log_file("pid")
-    stdout_file = log_file("stdout")
-    stderr_file = log_file("stderr")
-
-    child_pid = fork()
-    if child_pid > 0:
-        os.waitpid(child_pid, 0)
-        return pid_file
-
-    # NOTE From this point on we're in the child and we never return 20210326:mb
-    os.setsid()
-    os.umask(0)
-
-    if fork() > 0:
-        sys.exit()
-
-    setproctitle.setproctitle(sys.argv[0] + " check-for-zombies")
-
-    sys.stdout = TaskOutputStream(stdout_file)
-    sys.stderr = TaskOutputStream(stderr_file)
-
-    pid_file.parent.mkdir(parents=True, exist_ok=True, mode=0o775)
-    with pid_file.open("w") as file:
-        print(str(os.getpid()), file=file)
-
-    check_for_zombies(orchestrator)
+    trigger_refresh(orchestrator, node, info, isolated=True)
 
     if pid_file.exists():
         pid_file.unlink()
@@ -3,13 +3,12 @@ import traceback
 from itertools import chain
 from pathlib import Path
 
-import pygit2
-from jinja2 import BaseLoader, Environment
-
 from libds.data_node import DataOrchestrator
 from libds.model import BaseModel
+from libds.registry import connectors
 from libds.source import BaseSource, BrokenSource
 from libds.store import BaseStore
+from libds.trace import span
 from libds.utils import (
     DoesNotExist,
     ThreadLocalList,
@@ -35,7 +34,7 @@ class DataStack:
         LOCAL_DATA_STACKS.append(self)
 
     @classmethod
-    def from_dir(self, path):
+    def from_dir(self, path, load=True):
         dir = Path(path)
         if not dir.exists():
             raise ValueError(
@@ -61,10 +60,13 @@ class DataStack:
             raise Exception("No data stack defined.")
 
         ds.directory = dir
-        ds.load()
+        if load:
+            ds.load()
         return ds
 
     def info(self):
+        import pygit2
+
         repo = pygit2.Repository(self.directory)
         head = repo.revparse_single("HEAD")
         return dict(
@@ -80,6 +82,7 @@ class DataStack:
             store=self.store.info(),
             models=[model.info() for model in self.models],
             data=self.data_orchestrator.info(),
+            connectors=connectors(),
         )
 
     def load_data_orchestrator(self):
@@ -102,44 +105,93 @@ class DataStack:
 
         self.data_orchestrator.load_node_states()
 
+    def load_partial_data_orchestrator(self, containers):
+        # Same dance as load_data_orchestrator, but only for the nodes
+        # of `containers`. Upstream nodes which belong to other
+        # containers are backpatched as orphans and only their ids
+        # are meaningful.
+        self.data_orchestrator = DataOrchestrator(self)
+
+        for data in containers:
+            data.data_nodes = data.load_data_nodes()
+            self.data_orchestrator.collect_nodes(data.data_nodes)
+
+        nids = list(self.data_orchestrator.data_nodes.keys())
+        self.data_orchestrator.post_load_backpatch()
+        self.data_orchestrator.load_node_states(nids=nids)
+
     def sources_dir(self):
         dir = self.directory / "sources"
         dir.mkdir(parents=True, exist_ok=True)
         return dir
 
+    def _load_source_py(self, source_py):
+        try:
+            source_py = source_py.resolve()
+            CURRENT_FILENAME.value = source_py
+            LOCAL_SOURCES.reset()
+            runpy.run_path(source_py, run_name="local")
+            return list(LOCAL_SOURCES)
+        except Exception:
+            return [
+                BrokenSource(
+                    data_stack=self,
+                    filename=source_py,
+                    error=traceback.format_exc(),
+                )
+            ]
+
+    def _load_source_yaml(self, file):
+        CURRENT_FILENAME.value = file
+        try:
+            cls = BaseSource.class_from_yaml(self, file)
+            return cls.load_from_yaml(self, file)
+
+        except:  # noqa: E722
+            return BrokenSource(
+                data_stack=self,
+                filename=file,
+                error=traceback.format_exc(),
+            )
+
     def load_sources(self):
         CURRENT_DATA_STACK.value = self
         self.sources = []
         files = list(self.sources_dir().glob("*.py"))
         for source_py in sorted(files, key=lambda p: str(p).lower()):
-            try:
-                source_py = source_py.resolve()
-                CURRENT_FILENAME.value = source_py
-                LOCAL_SOURCES.reset()
-                runpy.run_path(source_py, run_name="local")
-                self.sources.extend(LOCAL_SOURCES)
-            except Exception:
-                self.sources.append(
-                    BrokenSource(
-                        data_stack=self,
-                        filename=source_py,
-                        error=traceback.format_exc(),
-                    )
-                )
+            self.sources.extend(self._load_source_py(source_py))
 
         for file in self.sources_dir().glob("*.yaml"):
-            CURRENT_FILENAME.value = file
-            try:
-                cls = BaseSource.class_from_yaml(self, file)
-                source = cls.load_from_yaml(self, file)
+            self.sources.append(self._load_source_yaml(file))
 
-            except:  # noqa: E722
-                source = BrokenSource(
-                    data_stack=self,
-                    filename=file,
-                    error=traceback.format_exc(),
-                )
-            self.sources.append(source)
+    def load_single_source(self, id):
+        with span("DataStack.load_single_source", id=id):
+            return self._load_single_source(id)
+
+    def _load_single_source(self, id):
+        self.load_store()
+        CURRENT_DATA_STACK.value = self
+        self.sources = []
+        source_yaml = self.sources_dir() / (id + ".yaml")
+        if source_yaml.exists():
+            self.sources.append(self._load_source_yaml(source_yaml))
+        source_py = self.sources_dir() / (id + ".py")
+        if source_py.exists():
+            self.sources.extend(self._load_source_py(source_py))
+
+        source = self.get_source(id)
+        if source is None:
+            # NOTE a source defined in python can have an id which
+            # doesn't match its filename, fall back to loading them
+            # all.
+            self.load_sources()
+            source = self.get_source(id)
+        if source is None:
+            raise DoesNotExist(f"Source: {id}")
+
+        self.models = []
+        self.load_partial_data_orchestrator([source])
+        return source
 
     def update_file(self, filename, source):
         path = self.directory / filename
@@ -200,6 +252,28 @@ class DataStack:
         else:
             raise DoesNotExist(f"Model: {id}")
 
+    def load_single_model(self, id):
+        with span("DataStack.load_single_model", id=id):
+            return self._load_single_model(id)
+
+    def _load_single_model(self, id):
+        self.load_store()
+        CURRENT_DATA_STACK.value = self
+        sqls = self.models_dir().glob(f"**/{id}.sql")
+        pys = self.models_dir().glob(f"**/{id}.py")
+        models = [BaseModel.from_file(self, filename) for filename in chain(sqls, pys)]
+        self.models = list(filter(None, models))
+        CURRENT_DATA_STACK.value = None
+        model = self.get_model(id)
+
+        self.sources = []
+        self.load_partial_data_orchestrator([model])
+        return model
+
+    def load_single_task(self, tid):
+        self.data_orchestrator = DataOrchestrator(self)
+        return self.data_orchestrator.load_task(tid)
+
     def stores_dir(self):
         dir = self.directory / "stores"
         dir.mkdir(parents=True, exist_ok=True)
@@ -233,20 +307,35 @@ class DataStack:
     def load(self):
         # NOTE models can depend on the store, make sure to load that
         # first. 20210528:mb
-        self.load_store()
-        self.load_sources()
-        self.load_models()
-        self.load_data_orchestrator()
+        with span("DataStack.load"):
+            with span("DataStack.load_store"):
+                self.load_store()
+            with span("DataStack.load_sources"):
+                self.load_sources()
+            with span("DataStack.load_models"):
+                self.load_models()
+            with span("DataStack.load_data_orchestrator"):
+                self.load_data_orchestrator()
 
         return self
 
-    def render_model_sql(self, template):
+    def render_model_sql(self, template, partial=False):
+        """Renders a model's template, and collects the config its calls
+        declare. partial renders it for a refresh of only some of its
+        partitions, see partition_filter()."""
         config = dict(
             dependencies=[],
             tests={},
             table_name=None,
             schema_name=None,
             is_query=None,
+            indexes=[],
+            json_columns=[],
+            table_engine={},
+            refresh_partitions=None,
+            pool=None,
+            priority=None,
+            retry={},
         )
 
         def depends_on(model_id, *other_deps):
@@ -269,6 +358,46 @@ class DataStack:
             config["is_query"] = False
             return _pprint_call("is_statement")
 
+        def table_engine(**settings):
+            config["table_engine"].update(settings)
+            return _pprint_call("table_engine", **settings)
+
+        def refresh_partitions(where=None):
+            config["refresh_partitions"] = True if where is None else where
+            return _pprint_call("refresh_partitions", where=where)
+
+        def partition_filter():
+            where = config["refresh_partitions"]
+            if partial and isinstance(where, str):
+                return f"({where})"
+            return "1 = 1"
+
+        def pool(name):
+            config["pool"] = name
+            return _pprint_call("pool", name=name)
+
+        def priority(value):
+            config["priority"] = value
+            return _pprint_call("priority", value=value)
+
+        def retry(**settings):
+            config["retry"].update(settings)
+            return _pprint_call("retry", **settings)
+
+        def index(*columns, unique=False):
+            config["indexes"].append(dict(columns=list(columns), unique=unique))
+            return _pprint_call("index", columns=list(columns), unique=unique)
+
+        def json_column(name, path=None, type=None, source="data"):
+            if path is None:
+                path = name
+            config["json_columns"].append(
+                dict(name=name, path=path, type=type, source=source)
+            )
+            return _pprint_call(
+                "json_column", name=name, path=path, type=type, source=source
+            )
+
         def test(id=None, caller=None):
             test_query = caller()
             if id is None:
@@ -279,13 +408,28 @@ class DataStack:
         sql = template.render(
             depends_on=depends_on,
             table_name=table_name,
+            table_engine=table_engine,
+            refresh_partitions=refresh_partitions,
+            partition_filter=partition_filter,
+            pool=pool,
+            priority=priority,
+            retry=retry,
             is_query=is_query,
             is_statement=is_statement,
+            index=index,
+            json_column=json_column,
             test=test,
         )
         return sql, config
 
     def execute_sql(self, sql, limit=None):
+        from jinja2 import BaseLoader, Environment
+
         template = Environment(loader=BaseLoader()).from_string(sql)
         sql, config = self.render_model_sql(template)
         return self.store.execute_sql(sql, limit), sql
+
+    def export_table(self, table_name, format, out, schema_name="public", **kwargs):
+        from libds.export import export_table
+
+        return export_table(self.store, schema_name, table_name, format, out, **kwargs)
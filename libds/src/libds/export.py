@@ -0,0 +1,139 @@
+import csv
+from pathlib import Path
+
+from libds.trace import span
+from libds.utils import DoesNotExist, DSException
+
+EXPORT_FORMATS = ["parquet", "arrow", "csv"]
+ROW_GROUP_SIZE = 100_000
+
+
+class ExportError(DSException):
+    pass
+
+
+def _pyarrow(format):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ExportError(
+            f"Exporting to {format} needs pyarrow, install libds[export]."
+        )
+    return pyarrow
+
+
+class CSVWriter:
+    def __init__(self, out, columns):
+        self.file = open(out, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter:
+    """Writes each batch as a record batch of an arrow ipc file, or a
+    row group of a parquet file. The schema is built from the store's
+    column types, only the columns the store can't type up front get
+    the type pyarrow infers for them from the first batch."""
+
+    def __init__(self, out, columns, format, types=None):
+        self.pa = _pyarrow(format)
+        self.out = out
+        self.columns = columns
+        self.format = format
+        self.types = [(types or {}).get(column) for column in columns]
+        self.schema = None
+        self.writer = None
+        if all(t is not None for t in self.types):
+            self._open(self.pa.schema(list(zip(self.columns, self.types))))
+
+    def _open(self, schema):
+        self.schema = schema
+        if self.format == "parquet":
+            import pyarrow.parquet
+
+            self.writer = pyarrow.parquet.ParquetWriter(self.out, self.schema)
+        else:
+            import pyarrow.ipc
+
+            self.writer = pyarrow.ipc.new_file(str(self.out), self.schema)
+
+    def _array(self, name, values, type):
+        try:
+            return self.pa.array(values, type=type)
+        except (self.pa.ArrowInvalid, self.pa.ArrowTypeError) as e:
+            if type == self.pa.string():
+                # NOTE a sqlite column can hold both text and numbers
+                return self.pa.array(
+                    [v if v is None or isinstance(v, str) else str(v) for v in values],
+                    type=type,
+                )
+            raise ExportError(f"Column {name} has a value which isn't {type} ({e}).")
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        if self.schema is None:
+            types = self.types
+        else:
+            types = self.schema.types
+        arrays = [
+            self.pa.array(values) if type is None else self._array(name, values, type)
+            for name, values, type in zip(self.columns, columns, types)
+        ]
+        batch = self.pa.RecordBatch.from_arrays(arrays, names=self.columns)
+        if self.writer is None:
+            self._open(batch.schema)
+        if self.format == "parquet":
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+
+    def close(self):
+        if self.writer is None:
+            # NOTE no rows, so nothing to infer the missing types from
+            types = [t or self.pa.null() for t in self.types]
+            self._open(self.pa.schema(list(zip(self.columns, types))))
+        self.writer.close()
+
+
+def export_table(
+    store, schema_name, table_name, format, out, row_group_size=ROW_GROUP_SIZE
+):
+    if format not in EXPORT_FORMATS:
+        raise ExportError(
+            f"Unknown export format {format}, not one of {EXPORT_FORMATS}"
+        )
+    if table_name not in store.list_tables(schema_name):
+        raise DoesNotExist(f"Table: {schema_name}.{table_name}")
+    out = Path(out)
+    with span("export_table", table_name=table_name, format=format):
+        if format != "csv":
+            types = store.arrow_types(_pyarrow(format), schema_name, table_name)
+        columns, batches = store.iter_batches(schema_name, table_name, row_group_size)
+        if format == "csv":
+            writer = CSVWriter(out, columns)
+        else:
+            writer = ArrowWriter(out, columns, format, types)
+        num_rows = 0
+        num_row_groups = 0
+        try:
+            for rows in batches:
+                writer.write(rows)
+                num_rows += len(rows)
+                num_row_groups += 1
+        finally:
+            writer.close()
+    return dict(
+        schema_name=schema_name,
+        table_name=table_name,
+        format=format,
+        path=str(out),
+        num_rows=num_rows,
+        num_row_groups=num_row_groups,
+        bytes=out.stat().st_size,
+    )
@@ -3,8 +3,6 @@ import traceback
 from datetime import datetime
 from pathlib import Path
 
-from jinja2 import Environment, FileSystemLoader
-
 from libds.data_node import DataNode
 
 
@@ -18,6 +16,9 @@ class BaseModel:
         schema_name=None,
         dependencies=None,
         tests=None,
+        pool=None,
+        priority=None,
+        retry=None,
     ):
         if data_stack is None:
             from libds.data_stack import CURRENT_DATA_STACK
@@ -33,6 +34,9 @@ class BaseModel:
         if tests is None:
             tests = {}
         self.tests = tests
+        self.pool = pool
+        self.priority = priority or 0
+        self.retry = retry
 
     @classmethod
     def from_file(cls, data_stack, filename):
@@ -98,6 +102,9 @@ class BaseModel:
                 id=self.schema_name + "." + self.table_name,
                 container=self.fqid(),
                 upstream=self.dependencies,
+                pool=self.pool,
+                priority=self.priority,
+                retry=self.retry,
             )
         ]
 
@@ -123,10 +130,25 @@ class BrokenModel(BaseModel):
 
 
 class SQLModel(BaseModel):
-    def __init__(self, sql=None, type=None, **kwargs):
+    def __init__(
+        self,
+        sql=None,
+        type=None,
+        indexes=None,
+        json_columns=None,
+        table_engine=None,
+        refresh_partitions=None,
+        partial_sql=None,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
         self.sql = sql
         self.type = "sql"
+        self.indexes = indexes or []
+        self.json_columns = json_columns or []
+        self.table_engine = table_engine or {}
+        self.refresh_partitions = refresh_partitions
+        self.partial_sql = partial_sql
 
     def info(self):
         i = super().info()
@@ -141,11 +163,16 @@ class SQLModel(BaseModel):
 
     @classmethod
     def from_file(cls, data_stack, filename):
+        from jinja2 import Environment, FileSystemLoader
+
         models_dir = data_stack.directory / "models"
         env = Environment(loader=FileSystemLoader([str(models_dir)]), autoescape=False)
 
         template = env.get_template(str(filename.relative_to(models_dir)))
         sql, config = data_stack.render_model_sql(template)
+        partial_sql = None
+        if isinstance(config["refresh_partitions"], str):
+            partial_sql, _ = data_stack.render_model_sql(template, partial=True)
         is_query = config["is_query"]
         if is_query is None:
             is_query = not filename.stem.startswith("lib")
@@ -158,6 +185,14 @@ class SQLModel(BaseModel):
             schema_name=config["schema_name"],
             dependencies=list(set(config["dependencies"])),
             tests=config["tests"],
+            indexes=config["indexes"],
+            json_columns=config["json_columns"],
+            table_engine=config["table_engine"],
+            refresh_partitions=config["refresh_partitions"],
+            partial_sql=partial_sql,
+            pool=config["pool"],
+            priority=config["priority"],
+            retry=config["retry"] or None,
         )
 
     def __repr__(self):
@@ -169,9 +204,18 @@ class SQLQueryModel(SQLModel):
         super().__init__(sql, "select", **kwargs)
 
     def load_data(self):
-        self.data_stack.store.create_or_replace_model(
-            table_name=self.table_name, schema_name=self.schema_name, select=self.sql
+        store = self.data_stack.store
+        store.create_or_replace_model(
+            table_name=self.table_name,
+            schema_name=self.schema_name,
+            select=self.sql,
+            indexes=self.indexes,
+            json_columns=self.json_columns,
+            table_engine=self.table_engine,
+            refresh_partitions=self.refresh_partitions,
+            partial_select=self.partial_sql,
         )
+        return dict(fingerprint=store.fingerprint(self.schema_name, self.table_name))
 
     @classmethod
     def create(cls, data_stack, id):
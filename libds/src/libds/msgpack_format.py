@@ -0,0 +1,81 @@
+import datetime
+import sys
+import traceback
+import types
+from decimal import Decimal
+from pathlib import Path
+
+import msgpack
+
+# NOTE these have to match the decoder in diaas.libds
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_DECIMAL = 3
+EXT_STREAM = 4
+
+STREAM_CHUNK_SIZE = 1000
+
+
+class StreamingPacker:
+    """Writes a result as a msgpack frame followed, for every generator
+    in it, by frames holding lists of up to STREAM_CHUNK_SIZE items and
+    an empty list to close it. In the first frame each generator is
+    replaced by an EXT_STREAM placeholder, streams follow in the order
+    of their placeholders.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.streams = []
+        self.streaming = False
+        self.packer = msgpack.Packer(default=self.default, use_bin_type=True)
+
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode("utf-8"))
+        if isinstance(obj, datetime.date):
+            return msgpack.ExtType(EXT_DATE, obj.isoformat().encode("utf-8"))
+        if isinstance(obj, Decimal):
+            return msgpack.ExtType(EXT_DECIMAL, str(obj).encode("utf-8"))
+        if isinstance(obj, Path):
+            return str(obj)
+        arrow = sys.modules.get("arrow")
+        if arrow is not None and isinstance(obj, arrow.Arrow):
+            return obj.datetime
+        if isinstance(obj, types.GeneratorType):
+            if self.streaming:
+                # NOTE a generator inside a streamed item is just inlined
+                return list(obj)
+            self.streams.append(obj)
+            return msgpack.ExtType(EXT_STREAM, str(len(self.streams) - 1).encode())
+        raise TypeError(f"Can not msgpack {obj!r}")
+
+    def _write(self, obj):
+        self.out.write(self.packer.pack(obj))
+
+    def dump(self, result):
+        self._write(result)
+        self.streaming = True
+        for stream in self.streams:
+            chunk = []
+            try:
+                for item in stream:
+                    chunk.append(item)
+                    if len(chunk) >= STREAM_CHUNK_SIZE:
+                        self._write(chunk)
+                        chunk = []
+            except Exception as e:
+                if chunk:
+                    self._write(chunk)
+                self._write(
+                    dict(
+                        error=dict(
+                            code=e.__class__.__name__, details=traceback.format_exc()
+                        )
+                    )
+                )
+                break
+            if chunk:
+                self._write(chunk)
+            self._write([])
+        self.out.flush()
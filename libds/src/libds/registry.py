@@ -0,0 +1,110 @@
+import importlib
+import importlib.util
+import sys
+
+SOURCES_GROUP = "libds.sources"
+STORES_GROUP = "libds.stores"
+
+# NOTE these are also declared as entry points in setup.py, having them
+# here as well means the built in types resolve without scanning every
+# installed distribution (and still work when libds isn't installed).
+BUILTIN_SOURCES = {
+    "libds.source.static.StaticTable": "libds.source.static:StaticTable",
+    "libds.source.file.CSVFile": "libds.source.file:CSVFile",
+    "libds.source.google.GoogleSheet": "libds.source.google:GoogleSheet",
+    "libds.source.mysql.MySQL": "libds.source.mysql:MySQL",
+}
+
+BUILTIN_STORES = {
+    "libds.store.sqlite.SQLite": "libds.store.sqlite:SQLite",
+    "libds.store.clickhouse.ClickHouse": "libds.store.clickhouse:ClickHouse",
+}
+
+# NOTE the drivers each built in connector imports, checked (but not
+# imported) to tell whether the connector can be used.
+BUILTIN_REQUIRES = {
+    "libds.source.google.GoogleSheet": ["googleapiclient", "google.oauth2"],
+    "libds.source.mysql.MySQL": ["MySQLdb"],
+    "libds.store.sqlite.SQLite": ["sqlalchemy"],
+    "libds.store.clickhouse.ClickHouse": ["clickhouse_driver"],
+}
+
+
+def _importable(module_name):
+    try:
+        return importlib.util.find_spec(module_name) is not None
+    except ImportError:
+        return False
+
+
+def _entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return {}
+    try:
+        eps = entry_points(group=group)
+    except TypeError:
+        eps = entry_points().get(group, [])
+    return {ep.name: ep.value for ep in eps}
+
+
+class UnknownType(ValueError):
+    pass
+
+
+class Registry:
+    def __init__(self, group, builtins):
+        self.group = group
+        self.builtins = builtins
+        self._installed = None
+        self._classes = {}
+
+    def installed(self):
+        if self._installed is None:
+            self._installed = _entry_points(self.group)
+        return self._installed
+
+    def target(self, type):
+        target = self.builtins.get(type)
+        if target is None:
+            target = self.installed().get(type)
+        return target
+
+    def resolve(self, type):
+        if type not in self._classes:
+            target = self.target(type)
+            if target is None:
+                raise UnknownType(f"No {self.group} entry point for type {type}")
+            module_name, _, attr = target.partition(":")
+            module = importlib.import_module(module_name)
+            self._classes[type] = getattr(module, attr)
+        return self._classes[type]
+
+    def connectors(self):
+        targets = dict(self.installed())
+        targets.update(self.builtins)
+        connectors = []
+        for type, target in sorted(targets.items()):
+            module_name = target.partition(":")[0]
+            # NOTE find_spec locates a module without running it, so
+            # listing connectors doesn't import any of their drivers.
+            requires = BUILTIN_REQUIRES.get(type, [module_name])
+            connectors.append(
+                dict(
+                    type=type,
+                    target=target,
+                    builtin=type in self.builtins,
+                    available=all(_importable(m) for m in requires),
+                    loaded=module_name in sys.modules,
+                )
+            )
+        return connectors
+
+
+SOURCES = Registry(SOURCES_GROUP, BUILTIN_SOURCES)
+STORES = Registry(STORES_GROUP, BUILTIN_STORES)
+
+
+def connectors():
+    return dict(sources=SOURCES.connectors(), stores=STORES.connectors())
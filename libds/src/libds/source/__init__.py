@@ -2,6 +2,7 @@ import json
 import re
 
 from libds.data_node import DataNode
+from libds.registry import SOURCES, UnknownType
 from libds.utils import yaml_load
 
 
@@ -46,6 +47,12 @@ class BaseSource:
         data_stack=None,
         table=None,
         stale_after=None,
+        typify=False,
+        table_engine=None,
+        refresh_partitions=None,
+        pool=None,
+        priority=None,
+        retry=None,
     ):
         from libds.data_stack import (
             CURRENT_DATA_STACK,
@@ -76,6 +83,14 @@ class BaseSource:
         self.table_name = table_name
 
         self.stale_after = stale_after
+        self.typify = typify
+        self.table_engine = table_engine
+        self.refresh_partitions = refresh_partitions
+        # NOTE the pool limits the concurrent loads from the source
+        # itself, the typed table is built in the store.
+        self.pool = pool
+        self.priority = priority or 0
+        self.retry = retry
 
         LOCAL_SOURCES.append(self)
 
@@ -119,56 +134,78 @@ class BaseSource:
         type = config.pop("type", None)
         if type is None:
             raise ValueError("Missing required property `type`")
-        cls = None
-        if type is not None:
-            if type == "libds.source.static.StaticTable":
-                import libds.source.static
-
-                cls = libds.source.static.StaticTable
-            if type == "libds.source.google.GoogleSheet":
-                import libds.source.google
-
-                cls = libds.source.google.GoogleSheet
-            if type == "libds.source.mysql.MySQL":
-                import libds.source.mysql
-
-                cls = libds.source.mysql.MySQL
-        if cls is None:
+        try:
+            return SOURCES.resolve(type)
+        except UnknownType:
             raise ValueError(
                 f"Don't know which source to use for type {type} in {path}"
             )
 
-        return cls
+    def raw_table_exists(self):
+        store = self.data_stack.store
+        return store.table_exists(self.schema_name, self.table_name + "_raw")
+
+    def fingerprint(self):
+        # NOTE extracted_at changes on every load, only the data counts
+        return self.data_stack.store.fingerprint(
+            self.schema_name, self.table_name + "_raw", columns=["data"]
+        )
 
     def refresh(self):
         self.data_stack.store.load_raw_from_records(
             schema_name=self.schema_name,
             table_name=self.table_name + "_raw",
             records=self.collect_new_records(None),
+            table_engine=self.table_engine,
+            refresh_partitions=self.refresh_partitions,
+        )
+        return dict(fingerprint=self.fingerprint())
+
+    def refresh_typed(self):
+        from libds.typify import typify
+
+        return typify(
+            self.data_stack.store,
+            self.schema_name,
+            self.table_name + "_raw",
+            self.table_name,
+            table_engine=self.table_engine,
+            refresh_partitions=self.refresh_partitions,
         )
 
     def sample(self, limit=None, order_by=None):
-        if order_by == "random":
-            order_by = "random()"
-        elif order_by == "new":
-            order_by = "insid desc"
-        elif order_by == "old":
-            order_by = "insid asc"
-        table = self.data_stack.store.get_table(self.schema_name, self.table_name)
-        return table.sample(limit, order_by)
+        return self.data_stack.store.preview(
+            self.schema_name, self.table_name + "_raw", limit, order_by
+        )
 
 
 class StaticSource(BaseSource):
     def load_data_nodes(self):
-        return [
-            DataNode(
-                id=self.schema_name + "." + self.table_name + "_raw",
-                container=self.fqid(),
-                upstream=[],
-                refresher=lambda o: self.refresh(),
-                stale_after=self.stale_after,
+        raw = DataNode(
+            id=self.schema_name + "." + self.table_name + "_raw",
+            container=self.fqid(),
+            upstream=[],
+            refresher=lambda o: self.refresh(),
+            stale_after=self.stale_after,
+            pool=self.pool,
+            priority=self.priority,
+            retry=self.retry,
+        )
+        nodes = [raw]
+        if self.typify:
+            # NOTE the typed table takes the source's own table name,
+            # next to the _raw one.
+            nodes.append(
+                DataNode(
+                    id=self.schema_name + "." + self.table_name,
+                    container=self.fqid(),
+                    upstream=[raw.id],
+                    refresher=lambda o: self.refresh_typed(),
+                    priority=self.priority,
+                    retry=self.retry,
+                )
             )
-        ]
+        return nodes
 
 
 class BrokenSource(BaseSource):
@@ -0,0 +1,231 @@
+import codecs
+import csv
+import mmap
+import re
+from datetime import datetime
+from pathlib import Path
+
+from libds.model import data_type
+from libds.source import Record, StaticSource
+from libds.utils import column_name, yaml_load
+
+CHUNK_SIZE = 1024 * 1024
+SAMPLE_ROWS = 1000
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, use_mmap=False):
+    with open(path, "rb") as file:
+        if use_mmap:
+            try:
+                view = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # NOTE empty files can't be mapped
+                return
+            with view:
+                for start in range(0, len(view), chunk_size):
+                    end = start + chunk_size
+                    yield view[start:end]
+        else:
+            while True:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+
+def read_lines(chunks, encoding="utf-8"):
+    """Splits a stream of byte chunks into lines, with their line
+    endings, as csv.reader wants them. Only the current chunk and the
+    tail of the previous one are held in memory."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    tail = ""
+    for chunk in chunks:
+        # NOTE only on \n, str.splitlines also splits on characters
+        # (\x0c, \x1e, ...) which csv treats as part of a field.
+        lines = (tail + decoder.decode(chunk)).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def _parse_integer(value):
+    return int(value)
+
+
+def _parse_float(value):
+    return float(value)
+
+
+def _parse_text(value):
+    return value
+
+
+def infer_type(values):
+    # NOTE every column is nullable, a row past the sample may still be
+    # missing the value.
+    present = [v for v in values if v != ""]
+    if len(present) == 0:
+        return data_type.Text(is_nullable=True)
+    if any(re.match(r"[+-]?0[0-9]", v) for v in present):
+        # NOTE zip codes, ids, phone numbers, ... would lose their zeros
+        return data_type.Text(is_nullable=True)
+    for type, parse in [
+        (data_type.Integer(is_nullable=True, width=64), _parse_integer),
+        (data_type.Float(is_nullable=True, width=64), _parse_float),
+    ]:
+        try:
+            for value in present:
+                parse(value)
+            return type
+        except ValueError:
+            pass
+    return data_type.Text(is_nullable=True)
+
+
+def _parser(type):
+    if isinstance(type, data_type.Integer):
+        return _parse_integer
+    if isinstance(type, data_type.Float):
+        return _parse_float
+    return _parse_text
+
+
+class CSVFile(StaticSource):
+    def __init__(
+        self,
+        path,
+        delimiter=None,
+        header=True,
+        encoding="utf-8",
+        unpack=True,
+        sample_rows=SAMPLE_ROWS,
+        chunk_size=CHUNK_SIZE,
+        mmap=False,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        if delimiter is None:
+            delimiter = "\t" if self.path.suffix.lower() == ".tsv" else ","
+        self.delimiter = delimiter
+        self.header = header
+        self.encoding = encoding
+        self.unpack = unpack
+        self.sample_rows = sample_rows
+        self.chunk_size = chunk_size
+        self.mmap = mmap
+
+    @classmethod
+    def load_from_yaml(cls, data_stack, path):
+        data = yaml_load(path)
+        return cls(
+            data_stack=data_stack,
+            table=data.get("table"),
+            stale_after=data.get("stale_after"),
+            path=data["path"],
+            delimiter=data.get("delimiter"),
+            header=data.get("header", True),
+            encoding=data.get("encoding", "utf-8"),
+            unpack=data.get("unpack", True),
+            sample_rows=data.get("sample_rows", SAMPLE_ROWS),
+            chunk_size=data.get("chunk_size", CHUNK_SIZE),
+            mmap=data.get("mmap", False),
+            table_engine=data.get("table_engine"),
+            refresh_partitions=data.get("refresh_partitions"),
+            pool=data.get("pool"),
+            priority=data.get("priority"),
+            retry=data.get("retry"),
+        )
+
+    def file_path(self):
+        # NOTE an absolute path stays as it is
+        return self.data_stack.directory / self.path
+
+    def info(self):
+        return self._info(
+            path=str(self.path),
+            delimiter=self.delimiter,
+            header=self.header,
+            unpack=self.unpack,
+            table_name=self.table_name,
+            schema_name=self.schema_name,
+        )
+
+    def rows(self):
+        lines = read_lines(
+            read_chunks(self.file_path(), self.chunk_size, self.mmap), self.encoding
+        )
+        return csv.reader(lines, delimiter=self.delimiter)
+
+    def infer_columns(self):
+        rows = self.rows()
+        header = next(rows, None)
+        if header is None:
+            return []
+        sample = [header] if not self.header else []
+        for row in rows:
+            if len(sample) >= self.sample_rows:
+                break
+            sample.append(row)
+        columns = []
+        names = set(["_extracted_at"])
+        for i, header_name in enumerate(header):
+            name = column_name(header_name, i) if self.header else f"c{i + 1}"
+            while name in names:
+                name = name + "_"
+            names.add(name)
+            values = [row[i] if i < len(row) else "" for row in sample]
+            columns.append([name, infer_type(values)])
+        return columns
+
+    def records(self, columns, typed):
+        names = [name for name, _ in columns]
+        parsers = [_parser(type) if typed else _parse_text for _, type in columns]
+        rows = self.rows()
+        if self.header:
+            next(rows, None)
+        extracted_at = datetime.utcnow()
+        for row_number, row in enumerate(rows, 1):
+            data = {}
+            for i, (name, parse) in enumerate(zip(names, parsers)):
+                value = row[i] if i < len(row) else ""
+                if value == "":
+                    data[name] = None if typed else value
+                    continue
+                try:
+                    data[name] = parse(value)
+                except ValueError:
+                    raise ValueError(
+                        f"{self.path}: row {row_number}: {value!r} in column {name} does not match the type inferred from the first {self.sample_rows} rows, increase sample_rows or set unpack: false"
+                    )
+            yield Record(data=data, extracted_at=extracted_at)
+
+    def collect_new_records(self, since):
+        return self.records(self.infer_columns(), typed=False)
+
+    def unpacked(self):
+        return self.unpack and hasattr(
+            self.data_stack.store, "load_unpacked_from_records"
+        )
+
+    def refresh(self):
+        if not self.unpacked():
+            return super().refresh()
+        columns = self.infer_columns()
+        self.data_stack.store.load_unpacked_from_records(
+            schema_name=self.schema_name,
+            table_name=self.table_name + "_raw",
+            columns=columns,
+            records=self.records(columns, typed=True),
+            table_engine=self.table_engine,
+            refresh_partitions=self.refresh_partitions,
+        )
+        fingerprint = self.data_stack.store.fingerprint(
+            self.schema_name,
+            self.table_name + "_raw",
+            columns=[name for name, _ in columns],
+        )
+        return dict(fingerprint=fingerprint)
@@ -1,15 +1,36 @@
+import hashlib
 import json
 import os
 import re
 from datetime import datetime
 from urllib.parse import urlparse
+from urllib.request import urlopen
 
 import google.oauth2.service_account
-from googleapiclient.discovery import build
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 
 from libds.source import Record, StaticSource
 from libds.utils import yaml_load
 
+DISCOVERY_PATH = "/$discovery/rest?version=v4"
+
+# NOTE parsed discovery documents by api endpoint, the static one
+# shipped with googleapiclient is used for the real api.
+_DISCOVERY_DOCUMENTS = {}
+
+
+def discovery_document(api_endpoint=None):
+    if api_endpoint not in _DISCOVERY_DOCUMENTS:
+        if api_endpoint is None:
+            document = get_static_doc("sheets", "v4")
+        else:
+            with urlopen(api_endpoint.rstrip("/") + DISCOVERY_PATH) as response:
+                document = response.read().decode("utf-8")
+        _DISCOVERY_DOCUMENTS[api_endpoint] = json.loads(document)
+    return _DISCOVERY_DOCUMENTS[api_endpoint]
+
 
 def lookup_spreadsheet_id(spreadsheet):
     try:
@@ -32,14 +53,18 @@ class GoogleSheet(StaticSource):
         header_row,
         target_table,
         service_account_info,
+        api_endpoint=None,
         **kwargs,
     ):
         super().__init__(**kwargs)
         self.sheet_id = sheet_id
-        self.range = range
+        if isinstance(range, str):
+            range = [range]
+        self.ranges = list(range)
         self.header_row = header_row
         self.target_table = target_table
         self.service_account_info = service_account_info
+        self.api_endpoint = api_endpoint
 
     @classmethod
     def load_from_yaml(cls, data_stack, file):
@@ -50,9 +75,14 @@ class GoogleSheet(StaticSource):
         range = data["range"]
         header_row = data["header_row"]
         stale_after = data.get("stale_after", None)
-        service_account_json_var = data["service_account_json_var"]
-        service_account_json = os.environ.get(service_account_json_var)
-        service_account_info = json.loads(service_account_json)
+        api_endpoint = data.get("api_endpoint", None)
+        service_account_json_var = data.get("service_account_json_var")
+        if service_account_json_var is None and api_endpoint is not None:
+            # NOTE a stub api endpoint, for testing, doesn't need credentials
+            service_account_info = None
+        else:
+            service_account_json = os.environ.get(service_account_json_var)
+            service_account_info = json.loads(service_account_json)
 
         return cls(
             sheet_id=sheet_id,
@@ -61,49 +91,103 @@ class GoogleSheet(StaticSource):
             target_table=target_table,
             stale_after=stale_after,
             service_account_info=service_account_info,
+            api_endpoint=api_endpoint,
+            typify=data.get("typify", False),
+            table_engine=data.get("table_engine"),
+            refresh_partitions=data.get("refresh_partitions"),
+            pool=data.get("pool"),
+            priority=data.get("priority"),
+            retry=data.get("retry"),
         )
 
     def info(self):
         return self._info(
             sheet_id=self.sheet_id,
-            range=self.range,
+            range=self.ranges[0] if len(self.ranges) == 1 else self.ranges,
             header_row=self.header_row,
         )
 
-    def collect_new_records(self, since):
-        credentials = (
-            google.oauth2.service_account.Credentials.from_service_account_info(
-                self.service_account_info
+    def service(self):
+        if self.service_account_info is None:
+            credentials = AnonymousCredentials()
+        else:
+            credentials = (
+                google.oauth2.service_account.Credentials.from_service_account_info(
+                    self.service_account_info
+                )
             )
+        client_options = None
+        if self.api_endpoint is not None:
+            client_options = dict(api_endpoint=self.api_endpoint)
+        return build_from_document(
+            discovery_document(self.api_endpoint),
+            credentials=credentials,
+            client_options=client_options,
         )
 
-        service = build("sheets", "v4", credentials=credentials)
-        sheets = service.spreadsheets()
+    def fetch_value_ranges(self):
         response = (
-            sheets.values()
-            .get(
+            self.service()
+            .spreadsheets()
+            .values()
+            .batchGet(
                 spreadsheetId=self.sheet_id,
-                range=self.range,
+                ranges=self.ranges,
                 majorDimension="ROWS",
                 valueRenderOption="UNFORMATTED_VALUE",
             )
             .execute()
         )
-        values = response["values"]
-        if len(values) == 0:
-            rows = []
-            columns = []
-        else:
-            first_row = values[0]
+        return [
+            value_range.get("values", []) for value_range in response["valueRanges"]
+        ]
+
+    def content_hash(self, value_ranges):
+        content = json.dumps(
+            dict(header_row=self.header_row, ranges=self.ranges, values=value_ranges),
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def records(self, value_ranges):
+        extracted_at = datetime.utcnow()
+        for sheet_range, values in zip(self.ranges, value_ranges):
+            if len(values) == 0:
+                continue
             if self.header_row:
-                columns = first_row
+                columns = values[0]
                 rows = values[1:]
             else:
                 columns = [str(i) for i in range(len(values[0]))]
                 rows = values
+            for row in rows:
+                data = {key: value for key, value in zip(columns, row)}
+                if len(self.ranges) > 1:
+                    data["_range"] = sheet_range
+                yield Record(data=data, extracted_at=extracted_at)
 
-        for row in rows:
-            yield Record(
-                data={key: value for key, value in zip(columns, row)},
-                extracted_at=datetime.utcnow(),
+    def collect_new_records(self, since):
+        return self.records(self.fetch_value_ranges())
+
+    def refresh(self):
+        value_ranges = self.fetch_value_ranges()
+        content_hash = self.content_hash(value_ranges)
+        # NOTE with typify there's the typed table's node too
+        raw_id = self.schema_name + "." + self.table_name + "_raw"
+        (node,) = [n for n in self.data_nodes if n.id == raw_id]
+        last_result = node.last_refresh_result() or {}
+        if last_result.get("content_hash") == content_hash and self.raw_table_exists():
+            return dict(
+                unchanged=True,
+                content_hash=content_hash,
+                fingerprint=last_result.get("fingerprint"),
             )
+
+        self.data_stack.store.load_raw_from_records(
+            schema_name=self.schema_name,
+            table_name=self.table_name + "_raw",
+            records=self.records(value_ranges),
+            table_engine=self.table_engine,
+            refresh_partitions=self.refresh_partitions,
+        )
+        return dict(content_hash=content_hash, fingerprint=self.fingerprint())
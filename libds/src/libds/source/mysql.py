@@ -100,7 +100,7 @@ class MySQL(BaseSource):
         init_args = {}
         for (
             prop
-        ) in "connect_args tables target_schema target_table_name_prefix stale_after".split():
+        ) in "connect_args tables target_schema target_table_name_prefix stale_after table_engine refresh_partitions pool priority retry".split():
             if prop in data:
                 init_args[prop] = data[prop]
 
@@ -213,6 +213,8 @@ class MySQL(BaseSource):
             schema_name=schema_name,
             table_name=self.target_table_name_prefix + table_name + "_raw",
             records=(as_record(row) for row in _fetchall(cur, query)),
+            table_engine=self.table_engine,
+            refresh_partitions=self.refresh_partitions,
         )
 
     def load_table_unpacked(self, schema_name, table_name):
@@ -238,6 +240,8 @@ class MySQL(BaseSource):
             table_name=self.target_table_name_prefix + table_name + "_raw",
             columns=columns,
             records=(as_record(row) for row in _fetchall(cur, query)),
+            table_engine=self.table_engine,
+            refresh_partitions=self.refresh_partitions,
         )
 
     def load_data_nodes(self):
@@ -270,7 +274,12 @@ class MySQLDatabaseNode(DataNode):
             ]
         )
         super().__init__(
-            id=mysql.fqid(), details=details, upstream=[], stale_after=stale_after
+            id=mysql.fqid(),
+            details=details,
+            upstream=[],
+            stale_after=stale_after,
+            priority=mysql.priority,
+            retry=mysql.retry,
         )
 
     def refresh(self, orchestrator):
@@ -280,7 +289,11 @@ class MySQLDatabaseNode(DataNode):
 class MySQLRawTableNode(DataNode):
     def __init__(self, mysql, schema_name, table_name):
         super().__init__(
-            id=schema_name + "." + table_name + "_raw", upstream=mysql.fqid()
+            id=schema_name + "." + table_name + "_raw",
+            upstream=mysql.fqid(),
+            pool=mysql.pool,
+            priority=mysql.priority,
+            retry=mysql.retry,
         )
         self.schema_name = schema_name
         self.table_name = table_name
@@ -55,7 +55,18 @@ class StaticTable(StaticSource):
         else:
             columns = ["c{i + 1}" for i in range(len(rows[0]))]
 
-        return cls(data_stack=data_stack, table=table, rows=rows, columns=columns)
+        return cls(
+            data_stack=data_stack,
+            table=table,
+            rows=rows,
+            columns=columns,
+            typify=data.get("typify", False),
+            table_engine=data.get("table_engine"),
+            refresh_partitions=data.get("refresh_partitions"),
+            pool=data.get("pool"),
+            priority=data.get("priority"),
+            retry=data.get("retry"),
+        )
 
     def info(self):
         return self._info(
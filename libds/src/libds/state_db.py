@@ -0,0 +1,293 @@
+import os
+import sqlite3
+
+from libds.utils import DSException
+
+SCHEMA_VERSION = "7"
+
+TASK_METRICS_COLUMNS = [
+    ("wall_s", "real"),
+    ("cpu_s", "real"),
+    ("peak_rss", "integer"),
+    ("rows_read", "integer"),
+    ("rows_written", "integer"),
+    ("bytes_written", "integer"),
+]
+
+
+class StateDBError(DSException):
+    pass
+
+
+def SQLITE_TIMESTAMP(value=None):
+    if value is None:
+        value = "'now'"
+    return f"strftime('%Y-%m-%dT%H:%M:%f', {value})"
+
+
+def _fetch_one_value(cursor, query, *args):
+    return cursor.execute(query, *args).fetchone()[0]
+
+
+class SQLiteStateDB:
+    """The orchestrator's state in orchestrator.sqlite3 next to the
+    data stack, shared by every process on this host."""
+
+    # NOTE errors which go away if the statement is retried a bit later
+    retryable_errors = (sqlite3.OperationalError,)
+
+    def __init__(self, path):
+        self.path = path
+
+    def info(self):
+        return dict(type="sqlite", path=str(self.path))
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def check(self, conn):
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.commit()
+        foreign_keys = conn.execute("pragma foreign_keys;").fetchone()[0]
+        if foreign_keys != 1:
+            raise Exception("sqlite3 doesn't support foreign_keys. this is bad.")
+        self.ensure_schema(conn)
+
+    def timestamp(self, seconds=None):
+        """The sql for the current utc time, plus `seconds`, as text
+        which sorts in time order."""
+        if seconds is None:
+            return SQLITE_TIMESTAMP()
+        return SQLITE_TIMESTAMP(f"'now', '{float(seconds):+f} seconds'")
+
+    def lock(self, cur, name):
+        # NOTE sqlite already runs one writing transaction at a time
+        pass
+
+    def ensure_schema(self, conn):
+        # NOTE begin immediate takes the write lock before the version is
+        # read, processes starting together migrate one after the other.
+        while True:
+            cur = conn.cursor()
+            cur.execute("begin immediate")
+            try:
+                version = self._version(cur)
+                if version == SCHEMA_VERSION:
+                    conn.commit()
+                    return
+                self._migrate(cur, version)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise e
+
+    def _version(self, cur):
+        count = _fetch_one_value(
+            cur,
+            "select count(*) from sqlite_master where type = 'table' and tbl_name = 'settings'",
+        )
+        if count == 0:
+            cur.execute("create table settings (key text, value text);")
+            cur.execute("insert into settings (key, value) values ('version', '0')")
+        return _fetch_one_value(cur, "select value from settings where key = 'version'")
+
+    def _migrate(self, cur, version):
+        if version == "6":
+            cur.execute(
+                "alter table data_nodes add column attempts integer not null default 0;"
+            )
+            cur.execute("alter table data_nodes add column retry_after text;")
+            cur.execute("update settings set value = '7' where key = 'version';")
+
+        elif version == "5":
+            cur.execute("alter table data_nodes add column pool text;")
+            cur.execute("update settings set value = '6' where key = 'version';")
+
+        elif version == "4":
+            cur.execute("alter table tasks add column heartbeat_at text;")
+            cur.execute("update settings set value = '5' where key = 'version';")
+
+        elif version == "3":
+            cur.execute("alter table data_nodes add column lease_owner text;")
+            cur.execute("alter table data_nodes add column lease_expires_at text;")
+            cur.execute("update settings set value = '4' where key = 'version';")
+
+        elif version == "2":
+            for column, type in TASK_METRICS_COLUMNS:
+                cur.execute(f"alter table tasks add column {column} {type};")
+            cur.execute("update settings set value = '3' where key = 'version';")
+
+        elif version == "1":
+            cur.execute("alter table tasks add column nid text;")
+            cur.execute("alter table tasks add column started_at text;")
+            cur.execute("alter table tasks add column completed_at text;")
+            cur.execute(
+                f"""
+                update tasks set
+                started_at = {SQLITE_TIMESTAMP("json_extract(info, '$.started_at')")},
+                completed_at = {SQLITE_TIMESTAMP("json_extract(info, '$.completed_at')")},
+                nid = json_extract(info, '$.nid');
+            """
+            )
+            cur.execute("alter table data_nodes add column stale_after text;")
+            cur.execute("update settings set value = '2' where key = 'version';")
+
+        elif version == "0":
+            cur.execute(
+                "create table tasks (tid text primary key, state text, info text)"
+            )
+            cur.execute(
+                "create table data_nodes (nid text primary key, state text not null, current_tid text references tasks(tid) default null)"
+            )
+            cur.execute("update settings set value = '1' where key = 'version'")
+
+        else:
+            raise Exception(f"Version {version} in orchestrator db.")
+
+
+class _PostgresCursor:
+    # NOTE the orchestrator's sql is written for sqlite: ? placeholders,
+    # explicit begins and execute returning the cursor.
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, args=None):
+        if query.strip().rstrip(";").lower() == "begin":
+            return self
+        if args:
+            query = query.replace("%", "%%").replace("?", "%s")
+        self.cursor.execute(query, args)
+        return self
+
+    def executemany(self, query, args):
+        self.cursor.executemany(query.replace("%", "%%").replace("?", "%s"), args)
+        return self
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+class _PostgresConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return _PostgresCursor(self.conn.cursor())
+
+    def execute(self, query, args=None):
+        return self.cursor().execute(query, args)
+
+    def __getattr__(self, attr):
+        return getattr(self.conn, attr)
+
+
+class PostgresStateDB:
+    """The orchestrator's state in a postgres database, for workers
+    spread over several hosts."""
+
+    def __init__(self, dsn):
+        try:
+            import psycopg2
+        except ImportError:
+            raise StateDBError(
+                "A postgres orchestrator needs psycopg2, install libds[postgresql]."
+            )
+        self.psycopg2 = psycopg2
+        self.dsn = dsn
+        self.retryable_errors = (
+            psycopg2.extensions.TransactionRollbackError,
+            psycopg2.OperationalError,
+        )
+
+    def info(self):
+        return dict(type="postgres")
+
+    def connect(self):
+        return _PostgresConnection(self.psycopg2.connect(self.dsn))
+
+    def check(self, conn):
+        self.ensure_schema(conn)
+
+    def timestamp(self, seconds=None):
+        now = "(now() at time zone 'utc')"
+        if seconds is not None:
+            now = f"({now} + interval '{float(seconds):f} seconds')"
+        # NOTE the same text sqlite's strftime makes, ms precision
+        return f"""to_char({now}, 'YYYY-MM-DD"T"HH24:MI:SS.MS')"""
+
+    def lock(self, cur, name):
+        """Holds lock name until the end of cur's transaction."""
+        cur.execute("select pg_advisory_xact_lock(hashtext(?))", [name])
+
+    def ensure_schema(self, conn):
+        cur = conn.cursor()
+        try:
+            # NOTE workers starting together would race on the create tables
+            cur.execute("select pg_advisory_xact_lock(hashtext('libds.orchestrator'))")
+            cur.execute(
+                "create table if not exists settings (key text primary key, value text)"
+            )
+            row = cur.execute(
+                "select value from settings where key = 'version'"
+            ).fetchone()
+            # NOTE an older libds mustn't take a newer schema for its own
+            if row is not None and int(row[0]) > int(SCHEMA_VERSION):
+                raise Exception(f"Version {row[0]} in orchestrator db.")
+            if row is None or row[0] != SCHEMA_VERSION:
+                self._migrate(cur)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+
+    def _migrate(self, cur):
+        # NOTE every change since version 4 is an add column if not exists
+        types = dict(real="double precision", integer="bigint")
+        metrics = "".join(
+            f", {column} {types[type]}" for column, type in TASK_METRICS_COLUMNS
+        )
+        cur.execute(
+            f"""create table if not exists tasks (
+                    tid text primary key, state text, info text, nid text,
+                    started_at text, completed_at text{metrics})"""
+        )
+        cur.execute("alter table tasks add column if not exists heartbeat_at text")
+        cur.execute(
+            """create table if not exists data_nodes (
+                   nid text primary key, state text not null,
+                   current_tid text references tasks(tid) default null,
+                   stale_after text, lease_owner text, lease_expires_at text)"""
+        )
+        cur.execute("alter table data_nodes add column if not exists pool text")
+        cur.execute(
+            "alter table data_nodes add column if not exists attempts bigint not null default 0"
+        )
+        cur.execute("alter table data_nodes add column if not exists retry_after text")
+        cur.execute(
+            """insert into settings (key, value) values ('version', ?)
+               on conflict (key) do update set value = excluded.value""",
+            [SCHEMA_VERSION],
+        )
+
+
+def state_db(data_stack):
+    config = (data_stack.config or {}).get("orchestrator") or {}
+    type = config.get("type", "sqlite")
+    if type == "sqlite":
+        path = data_stack.directory / config.get("path", "orchestrator.sqlite3")
+        return SQLiteStateDB(path.resolve())
+    elif type == "postgres":
+        dsn = config.get("dsn")
+        if "dsn_var" in config:
+            dsn = os.environ.get(config["dsn_var"])
+            if dsn is None:
+                raise StateDBError(
+                    f"No postgres dsn for the orchestrator, {config['dsn_var']} isn't set."
+                )
+        if dsn is None:
+            raise StateDBError("A postgres orchestrator needs a dsn or a dsn_var.")
+        return PostgresStateDB(dsn)
+    else:
+        raise StateDBError(
+            f"Unknown orchestrator type {type}, not one of sqlite or postgres."
+        )
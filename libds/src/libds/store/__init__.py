@@ -2,12 +2,27 @@ import datetime
 import re
 import runpy
 import secrets
+import threading
+import time
 from decimal import Decimal
 
-from libds.utils import yaml_load
+from libds.registry import STORES, UnknownType
+from libds.store.ledger import TableLedger
+from libds.store.preview import PREVIEW_SIZE
+from libds.utils import parse_timedelta, yaml_load
+
+# Working tables are dropped once the task which created them is no
+# longer running, ie it was done, failed or reaped as a zombie. Those
+# made outside of a task (or before the ledger knew their task), and
+# any tombstone, which are still in the ledger after this long were
+# left behind by a load which crashed (or was killed) and are swept up
+# by the next cleanup.
+LEDGER_MAX_AGE = "1d"
 
 
 class BaseStore:
+    cleanup_in_background = True
+
     def __init__(self, data_stack=None, id=None, filename=None):
         from libds.data_stack import (
             CURRENT_DATA_STACK,
@@ -24,6 +39,9 @@ class BaseStore:
         elif CURRENT_FILENAME.value is not None:
             self.filename = CURRENT_FILENAME.value
 
+        self._ledger = None
+        self._cleanup_threads = []
+
         LOCAL_STORES.append(self)
 
     @staticmethod
@@ -38,18 +56,13 @@ class BaseStore:
 
         if filename.suffix == ".yaml":
             spec = yaml_load(filename)
-            if spec["type"] == "libds.store.sqlite.SQLite":
-                from libds.store.sqlite import SQLite
-
-                return SQLite.from_yaml(spec)
-            if spec["type"] == "libds.store.clickhouse.ClickHouse":
-                from libds.store.clickhouse import ClickHouse
-
-                return ClickHouse.from_yaml(spec)
-            else:
+            try:
+                cls = STORES.resolve(spec["type"])
+            except UnknownType:
                 raise ValueError(
                     f"Don't know how to build store of type {spec['type']} from {filename}"
                 )
+            return cls.from_yaml(spec)
 
     @property
     def type(self):
@@ -80,11 +93,167 @@ class BaseStore:
     def model_id_to_table_name(self, model_id):
         return model_id
 
+    @property
+    def ledger(self):
+        if self._ledger is None:
+            path = self.data_stack.directory / "store_ledger.sqlite3"
+            self._ledger = TableLedger(path.resolve(), self.id)
+        return self._ledger
+
+    def _tagged_table_name(self, schema_name, table_name, tag):
+        from libds.data_node import CURRENT_TASK_ID
+
+        name = with_random_suffix(table_name, tag)
+        self.ledger.record(schema_name, name, table_name, tag, CURRENT_TASK_ID.value)
+        return name
+
+    def working_table_name(self, schema_name, table_name):
+        return self._tagged_table_name(schema_name, table_name, "working")
+
+    def tombstone_table_name(self, schema_name, table_name):
+        return self._tagged_table_name(schema_name, table_name, "tombstone")
+
+    def swap_in(self, schema_name, working_name, table_name):
+        raise NotImplementedError()
+
+    def get_table(self, schema_name, table_name):
+        raise NotImplementedError()
+
+    def save_preview(self, schema_name, table_name, reservoir=None):
+        if reservoir is None:
+            self.ledger.forget_preview(schema_name, table_name)
+        else:
+            rows = [
+                {k: to_sample_value(v) for k, v in row.items()}
+                for row in reservoir.rows
+            ]
+            self.ledger.save_preview(schema_name, table_name, rows, reservoir.count)
+
+    def preview(self, schema_name, table_name, limit=None, order_by=None):
+        if limit is None:
+            limit = PREVIEW_SIZE
+        if order_by in (None, "random"):
+            preview = self.ledger.load_preview(schema_name, table_name)
+            if preview is not None and (
+                len(preview["rows"]) >= limit or preview["num_rows"] <= limit
+            ):
+                return preview["rows"][:limit]
+        table = self.get_table(schema_name, table_name)
+        return list(table.sample(limit, order_by))
+
+    def drop_tables(self, schema_name, table_names):
+        raise NotImplementedError()
+
+    def list_tables(self, schema_name):
+        raise NotImplementedError()
+
+    def table_exists(self, schema_name, table_name):
+        raise NotImplementedError()
+
+    def create_or_replace_typed(
+        self,
+        schema_name,
+        table_name,
+        raw_table_name,
+        columns,
+        table_engine=None,
+        refresh_partitions=None,
+    ):
+        """Materializes table_name with a column for each of the
+        typify.JSONColumns `columns`, extracted from the json data of
+        raw_table_name in one statement."""
+        raise NotImplementedError()
+
+    def arrow_types(self, pa, schema_name, table_name):
+        """Column name => the pyarrow (the module pa) type of its values,
+        or None where the store can't tell before reading them."""
+        return {}
+
+    def iter_batches(self, schema_name, table_name, batch_size):
+        """Returns the column names of the table and an iterator over
+        its rows, as lists of at most batch_size tuples."""
+        raise NotImplementedError()
+
+    def fingerprint(self, schema_name, table_name, columns=None):
+        """A dict which changes whenever the rows of the table do (but
+        not their order), or None if the store can't tell."""
+        return None
+
+    def drop_tables_by_tag(self, schema_name, table_name, tag):
+        re = random_suffix_regexp(table_name, tag)
+        tables = [name for name in self.list_tables(schema_name) if re.match(name)]
+        return tables, self.drop_tables(schema_name, tables)
+
+    def cleanup_tables(self, schema_name=None, table_name=None, max_age=None):
+        if max_age is None:
+            max_age = LEDGER_MAX_AGE
+        if isinstance(max_age, str):
+            max_age = parse_timedelta(max_age)
+
+        entries = {}
+        for e in self.ledger.entries(
+            schema_name=schema_name, final_name=table_name, tag="tombstone"
+        ) + self.ledger.entries(tag="tombstone", older_than=max_age):
+            entries[(e.schema_name, e.table_name)] = e
+
+        cutoff = time.time() - max_age.total_seconds()
+        working = self.ledger.entries(tag="working")
+        running = self._running_tasks(set(e.tid for e in working if e.tid))
+        for e in working:
+            if e.tid is not None and running is not None:
+                collect = e.tid not in running
+            else:
+                collect = e.created_at < cutoff
+            if collect:
+                entries[(e.schema_name, e.table_name)] = e
+
+        by_schema = {}
+        for e in entries.values():
+            by_schema.setdefault(e.schema_name, []).append(e)
+
+        dropped = dict(working=[], tombstone=[])
+        reclaimed_bytes = 0
+        for schema, schema_entries in by_schema.items():
+            names = [e.table_name for e in schema_entries]
+            reclaimed_bytes += self.drop_tables(schema, names)
+            self.ledger.forget(schema, names)
+            for e in schema_entries:
+                dropped[e.tag].append(e.table_name)
+
+        return dict(tables_dropped=dropped, reclaimed_bytes=reclaimed_bytes)
+
+    def _running_tasks(self, tids):
+        """The ones of tids which are still running, None when there's
+        no orchestrator to ask."""
+        orchestrator = getattr(self.data_stack, "data_orchestrator", None)
+        if orchestrator is None:
+            return None
+        return orchestrator.running_tasks(tids)
+
     def _cleanup_tables(self, p, schema_name, table_name):
-        working = self.drop_tables_by_tag(schema_name, table_name, "working")
-        p.display(f"Cleaned up working tables: {working}")
-        tombstone = self.drop_tables_by_tag(schema_name, table_name, "tombstone")
-        p.display(f"Cleaned up tombstone tables: {tombstone}")
+        def cleanup():
+            res = self.cleanup_tables(schema_name, table_name)
+            p.display(
+                f"Cleaned up tables: {res['tables_dropped']}, reclaimed {res['reclaimed_bytes']} bytes"
+            )
+
+        if self.cleanup_in_background:
+            # NOTE not a daemon thread, the interpreter waits for it
+            # before exiting, but the task itself is already done.
+            thread = threading.Thread(
+                target=cleanup, name=f"cleanup {schema_name}.{table_name}"
+            )
+            thread.start()
+            self._cleanup_threads.append(thread)
+            p.display(f"Cleaning up tables of {schema_name}.{table_name}")
+        else:
+            cleanup()
+
+    def wait_for_cleanup(self):
+        """Waits for the cleanups started in the background, for whoever
+        exits without the interpreter waiting for them, eg os._exit."""
+        while self._cleanup_threads:
+            self._cleanup_threads.pop().join()
 
 
 def to_sample_value(value):
@@ -105,8 +274,11 @@ class BaseTable:
         self.table_name = table_name
 
     def sample(self, limit=None, order_by=None, where=None):
+        # NOTE order_by is either one of "random", "new" and "old",
+        # which each store implements without sorting the whole table,
+        # or a plain sql expression.
         if limit is None:
-            limit = 23
+            limit = PREVIEW_SIZE
         return self._sample(limit, order_by, where)
 
 
@@ -1,18 +1,17 @@
+import dataclasses
+import re
 from pprint import pformat
 
 import clickhouse_driver.errors
 from clickhouse_driver import Client
 
+from libds.data_node import record_task_io
 from libds.model import data_type
-from libds.store import (
-    BaseStore,
-    BaseTable,
-    random_suffix_regexp,
-    to_sample_value,
-    with_random_suffix,
-)
+from libds.store import BaseStore, BaseTable, to_sample_value
 from libds.store.clickhouse_error_codes import ERROR_CODES
-from libds.utils import DSException, GaugeProgress, InsertProgress
+from libds.store.preview import Reservoir
+from libds.trace import span, statement_attr
+from libds.utils import DSException, GaugeProgress, InsertProgress, chunked
 
 
 def _data_type_to_clickhouse_type(t):
@@ -56,6 +55,129 @@ def _data_type_to_clickhouse_type(t):
     return type_string
 
 
+def _clickhouse_type_to_arrow_type(pa, type_string):
+    """The pyarrow type for a clickhouse column type, None for those
+    (arrays, tuples, Int128, ...) left to pyarrow to infer."""
+    m = re.fullmatch(r"(?:Nullable|LowCardinality)\((.*)\)", type_string)
+    if m:
+        return _clickhouse_type_to_arrow_type(pa, m.group(1))
+    simple = {
+        "Int8": pa.int8(),
+        "Int16": pa.int16(),
+        "Int32": pa.int32(),
+        "Int64": pa.int64(),
+        "UInt8": pa.uint8(),
+        "UInt16": pa.uint16(),
+        "UInt32": pa.uint32(),
+        "UInt64": pa.uint64(),
+        "Float32": pa.float32(),
+        "Float64": pa.float64(),
+        "Bool": pa.bool_(),
+        "String": pa.string(),
+        "Date": pa.date32(),
+        "Date32": pa.date32(),
+    }
+    if type_string in simple:
+        return simple[type_string]
+    if type_string.startswith("FixedString("):
+        return pa.string()
+    m = re.fullmatch(r"Decimal\((\d+), (\d+)\)", type_string)
+    if m:
+        precision, scale = int(m.group(1)), int(m.group(2))
+        if precision <= 38:
+            return pa.decimal128(precision, scale)
+        return pa.decimal256(precision, scale)
+    if type_string == "DateTime" or type_string.startswith("DateTime("):
+        return pa.timestamp("s")
+    m = re.fullmatch(r"DateTime64\((\d)(?:, .*)?\)", type_string)
+    if m:
+        precision = int(m.group(1))
+        return pa.timestamp("s" if precision == 0 else "ms" if precision <= 3 else "us")
+    return None
+
+
+EXTRACTED_AT = "DateTime64 DEFAULT toDateTime64(now(), 3, 'UTC')"
+TABLE_ENGINE_KEYS = [
+    "engine",
+    "order_by",
+    "primary_key",
+    "partition_by",
+    "ttl",
+    "codecs",
+]
+
+
+def _quote(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _key(value):
+    if isinstance(value, (list, tuple)):
+        return "(" + ", ".join(value) + ")"
+    return value
+
+
+class TableEngine:
+    """How a table is stored: its engine, sorting, primary and partition
+    keys, ttl and the compression codec of some of its columns, as
+    declared by a model's table_engine() or a source's table_engine."""
+
+    def __init__(
+        self,
+        engine="MergeTree",
+        order_by="tuple()",
+        primary_key=None,
+        partition_by=None,
+        ttl=None,
+        codecs=None,
+    ):
+        if "(" not in engine:
+            engine += "()"
+        self.engine = engine
+        self.order_by = _key(order_by)
+        self.primary_key = _key(primary_key)
+        self.partition_by = _key(partition_by)
+        self.ttl = ttl
+        self.codecs = codecs or {}
+
+    @classmethod
+    def from_config(cls, config, order_by="tuple()"):
+        config = dict(config or {})
+        unknown = sorted(set(config.keys()) - set(TABLE_ENGINE_KEYS))
+        if unknown:
+            raise ValueError(
+                f"Unknown table_engine settings {unknown}, not any of {TABLE_ENGINE_KEYS}"
+            )
+        config.setdefault("order_by", order_by)
+        return cls(**config)
+
+    def columns_sql(self, columns):
+        """The column list of a CREATE TABLE for `columns`, a list of
+        (name, type and default) pairs."""
+        unknown = sorted(set(self.codecs.keys()) - set(name for name, _ in columns))
+        if unknown:
+            raise ValueError(
+                f"Codecs for columns {unknown} which the table doesn't have"
+            )
+        cols = []
+        for name, type in columns:
+            col = f"`{name}` {type}"
+            if name in self.codecs:
+                col += f" CODEC({self.codecs[name]})"
+            cols.append(col)
+        return "(" + ", ".join(cols) + ")"
+
+    def sql(self):
+        sql = f"ENGINE = {self.engine} ORDER BY {self.order_by}"
+        if self.partition_by is not None:
+            sql += f" PARTITION BY {self.partition_by}"
+        if self.primary_key is not None:
+            sql += f" PRIMARY KEY {self.primary_key}"
+        if self.ttl is not None:
+            sql += f" TTL {self.ttl}"
+        return sql
+
+
 class ClickHouseServerException(DSException):
     def __init__(self, se=None, source=None):
         self.se = se
@@ -106,7 +228,8 @@ class ClickHouseClient:
     def execute(self, query, params=None, **kwargs):
         # print(f"Executing `{stmt}`")
         try:
-            return self.client.execute(query, params=params, **kwargs)
+            with span("store.execute", statement=statement_attr(query)):
+                return self.client.execute(query, params=params, **kwargs)
         except clickhouse_driver.errors.ServerException as se:
             raise _clickhouse_server_exception(se, query, params)
 
@@ -157,25 +280,208 @@ class ClickHouse(BaseStore):
         default = self.client(schema_name="default")
         default.execute(f"CREATE DATABASE IF NOT EXISTS {schema_name} ENGINE = Atomic;")
 
-    def drop_tables_by_tag(self, schema_name, table_name, tag):
+    def swap_in(self, schema_name, working_name, table_name):
         client = self.client()
+        working = schema_name + "." + working_name
+        final = schema_name + "." + table_name
+        try:
+            # NOTE on an Atomic database this is a single atomic
+            # operation, readers see either the old or the new table and
+            # never a missing one. The old contents end up under the
+            # working name and are dropped, later, as a tombstone.
+            client.execute(f"EXCHANGE TABLES {working} AND {final};")
+        except ClickHouseServerException as e:
+            error = ERROR_CODES.get(e.se.code) if e.se is not None else None
+            if error == "UNKNOWN_TABLE":
+                client.execute(f"RENAME TABLE {working} to {final};")
+            elif error in ("NOT_IMPLEMENTED", "UNSUPPORTED_METHOD"):
+                # Ordinary database, no EXCHANGE, fall back to renaming.
+                tombstone_name = self.tombstone_table_name(schema_name, table_name)
+                tombstone = schema_name + "." + tombstone_name
+                client.execute(
+                    f"RENAME TABLE {final} to {tombstone}, {working} to {final};"
+                )
+            else:
+                raise e
+            self.ledger.forget(schema_name, [working_name])
+        else:
+            self.ledger.retag(schema_name, working_name, "tombstone")
+
+    def _record_task_io(self, client, schema_name, working_name, rows_read=None):
+        rows_written, bytes_written = client.execute(
+            "select total_rows, total_bytes from system.tables where database = %(schema_name)s and name = %(table_name)s",
+            dict(schema_name=schema_name, table_name=working_name),
+        )[0]
+        record_task_io(
+            rows_read=rows_read, rows_written=rows_written, bytes_written=bytes_written
+        )
 
-        res = client.execute(
+    def _structure(self, client, schema_name, table_name):
+        params = dict(schema_name=schema_name, table_name=table_name)
+        columns = client.execute(
+            "select name, type from system.columns where database = %(schema_name)s and table = %(table_name)s order by position",
+            params,
+        )
+        keys = client.execute(
+            "select engine, partition_key, sorting_key, primary_key from system.tables where database = %(schema_name)s and name = %(table_name)s",
+            params,
+        )
+        return columns, keys
+
+    def _partitioned(
+        self, client, schema_name, working_name, table_name, refresh_partitions
+    ):
+        """Whether working_name is to be swapped in partition by
+        partition, decided once, before anything is loaded into it."""
+        # NOTE REPLACE PARTITION needs both tables to have the same
+        # columns and keys, after a change to either it's a full swap.
+        return bool(
+            refresh_partitions
+            and client.table_exists(schema_name, table_name)
+            and self._structure(client, schema_name, working_name)
+            == self._structure(client, schema_name, table_name)
+        )
+
+    def _partition_ids(self, client, schema_name, table_name):
+        return [
+            row[0]
+            for row in client.execute(
+                "select distinct partition_id from system.parts where database = %(schema_name)s and table = %(table_name)s and active",
+                dict(schema_name=schema_name, table_name=table_name),
+            )
+        ]
+
+    def _copy_unrefreshed_rows(
+        self, client, schema_name, working_name, table_name, where
+    ):
+        """Copies the rows of table_name which don't match `where` into
+        working_name, from the partitions working_name has rows in, so
+        swapping those partitions in keeps them."""
+        partition_ids = self._partition_ids(client, schema_name, working_name)
+        if not partition_ids:
+            return
+        working = schema_name + "." + working_name
+        final = schema_name + "." + table_name
+        client.execute(
+            f"INSERT INTO {working} SELECT * FROM {final} WHERE _partition_id IN %(partition_ids)s AND NOT ifNull(({where}), 0)",
+            dict(partition_ids=tuple(sorted(partition_ids))),
+        )
+
+    def swap_in_partitions(self, schema_name, working_name, table_name, where=None):
+        """Replaces the partitions of table_name which working_name has
+        rows in, and drops those which have rows matching `where` in
+        table_name but none in working_name. Each partition is swapped
+        atomically, the table as a whole isn't."""
+        client = self.client()
+        working = schema_name + "." + working_name
+        final = schema_name + "." + table_name
+        replaced = self._partition_ids(client, schema_name, working_name)
+        dropped = []
+        if where is not None:
+            matching = client.execute(
+                f"SELECT DISTINCT _partition_id FROM {final} WHERE {where}"
+            )
+            dropped = sorted(set(row[0] for row in matching) - set(replaced))
+        for partition_id in sorted(replaced):
+            client.execute(
+                f"ALTER TABLE {final} REPLACE PARTITION ID {_quote(partition_id)} FROM {working}"
+            )
+        for partition_id in dropped:
+            client.execute(
+                f"ALTER TABLE {final} DROP PARTITION ID {_quote(partition_id)}"
+            )
+        self.ledger.retag(schema_name, working_name, "tombstone")
+        return dict(replaced=sorted(replaced), dropped=dropped)
+
+    def _swap_in(
+        self,
+        p,
+        schema_name,
+        working_name,
+        table_name,
+        partitioned,
+        refresh_partitions,
+        reservoir,
+    ):
+        if partitioned:
+            where = refresh_partitions if isinstance(refresh_partitions, str) else None
+            partitions = self.swap_in_partitions(
+                schema_name, working_name, table_name, where
+            )
+            # NOTE the reservoir only saw the new partitions
+            self.save_preview(schema_name, table_name)
+            p.display(f"Swapped partitions {partitions} into {table_name}")
+        else:
+            self.swap_in(schema_name, working_name, table_name)
+            self.save_preview(schema_name, table_name, reservoir)
+            p.display(f"Swapped {working_name} into {table_name}")
+
+    def table_exists(self, schema_name, table_name):
+        return self.client().table_exists(schema_name, table_name)
+
+    def list_tables(self, schema_name):
+        res = self.client().execute(
             "select name from system.tables where database = %(schema_name)s",
             dict(schema_name=schema_name),
         )
-        dropped = []
-        re = random_suffix_regexp(table_name, tag)
-        for table_name in [row[0] for row in res]:
-            if re.match(table_name):
-                client.execute(f'drop table "{schema_name}"."{table_name}";')
-                dropped.append(table_name)
-        return dropped
-
-    def load_unpacked_from_records(self, schema_name, table_name, columns, records):
-        final = schema_name + "." + table_name
-        working = with_random_suffix(final, "working")
-        tombstone = with_random_suffix(final, "tombstone")
+        return [row[0] for row in res]
+
+    def fingerprint(self, schema_name, table_name, columns=None):
+        if columns is None:
+            hashed = "*"
+        else:
+            hashed = ", ".join(columns)
+        # NOTE sum, and not groupBitXor, so duplicate rows don't cancel out
+        num_rows, checksum = self.client().execute(
+            f"select count(), sum(cityHash64({hashed})) from {schema_name}.{table_name}"
+        )[0]
+        return dict(num_rows=num_rows, checksum=f"{checksum:016x}")
+
+    def arrow_types(self, pa, schema_name, table_name):
+        res = self.client().execute(
+            "select name, type from system.columns where database = %(schema_name)s and table = %(table_name)s order by position",
+            dict(schema_name=schema_name, table_name=table_name),
+        )
+        return {name: _clickhouse_type_to_arrow_type(pa, type) for name, type in res}
+
+    def iter_batches(self, schema_name, table_name, batch_size):
+        # NOTE execute_iter reads the native blocks as they arrive,
+        # max_block_size keeps them about the size of our batches.
+        res = self.client().execute_iter(
+            f"SELECT * FROM {schema_name}.{table_name}",
+            with_column_types=True,
+            settings=dict(max_block_size=batch_size),
+        )
+        with span("store.execute", table_name=table_name):
+            columns = [name for name, _ in next(res)]
+        return columns, chunked(res, batch_size)
+
+    def drop_tables(self, schema_name, table_names):
+        if len(table_names) == 0:
+            return 0
+        client = self.client()
+        res = client.execute(
+            "select sum(total_bytes) from system.tables where database = %(schema_name)s and name in %(table_names)s",
+            dict(schema_name=schema_name, table_names=tuple(table_names)),
+        )
+        # NOTE the servers we run (up to 22.x) take a single table per
+        # DROP, so it's a statement per table, only the size is batched.
+        for table_name in table_names:
+            client.execute(f'drop table if exists "{schema_name}"."{table_name}";')
+        return res[0][0] or 0
+
+    def load_unpacked_from_records(
+        self,
+        schema_name,
+        table_name,
+        columns,
+        records,
+        table_engine=None,
+        refresh_partitions=None,
+    ):
+        table_engine = TableEngine.from_config(table_engine, order_by="_extracted_at")
+        working_name = self.working_table_name(schema_name, table_name)
+        working = schema_name + "." + working_name
         self._ensure_schema(schema_name)
 
         p = InsertProgress(
@@ -184,25 +490,26 @@ class ClickHouse(BaseStore):
 
         column_names = [c[0] for c in columns]
         column_types = [_data_type_to_clickhouse_type(c[1]) for c in columns]
-        cols = [name + " " + type for name, type in zip(column_names, column_types)]
+        cols = [("_extracted_at", EXTRACTED_AT)] + list(zip(column_names, column_types))
 
         client = self.client()
-        query = f"""
-            CREATE TABLE {working} (
-                _extracted_at DateTime64 DEFAULT toDateTime64(now(), 3, 'UTC'),
-        {", ".join(cols)}
-            )
-            ENGINE MergeTree()
-            ORDER BY (_extracted_at);"""
+        query = f"CREATE TABLE {working} {table_engine.columns_sql(cols)} {table_engine.sql()};"
         client.execute(query)
         p.display(f"Created {query}")
+        partitioned = self._partitioned(
+            client, schema_name, working_name, table_name, refresh_partitions
+        )
 
         insert = f"""INSERT INTO {working} ({', '.join(column_names)}) VALUES"""
         p.display(f"Insert query: {insert}")
 
+        reservoir = Reservoir()
+
         def record_for_clickhouse(record):
-            row = [record.data[column] for column in column_names]
+            data = record.data
+            row = [data[column] for column in column_names]
             p.update(row)
+            reservoir.add(data)
             return row
 
         client.execute(
@@ -211,19 +518,31 @@ class ClickHouse(BaseStore):
 
         p.display()
 
-        if client.table_exists(schema_name, table_name):
-            client.execute(f"RENAME TABLE {final} to {tombstone};")
-            client.execute(f"RENAME TABLE {working} to {final};")
-            client.execute(f"DROP TABLE {tombstone};")
-        else:
-            client.execute(f"RENAME TABLE {working} to {final};")
+        self._record_task_io(client, schema_name, working_name, reservoir.count)
+
+        self._swap_in(
+            p,
+            schema_name,
+            working_name,
+            table_name,
+            partitioned,
+            refresh_partitions,
+            reservoir,
+        )
 
         self._cleanup_tables(p, schema_name, table_name)
 
-    def load_raw_from_records(self, schema_name, table_name, records):
-        final = schema_name + "." + table_name
-        working = with_random_suffix(final, "working")
-        tombstone = with_random_suffix(final, "tombstone")
+    def load_raw_from_records(
+        self,
+        schema_name,
+        table_name,
+        records,
+        table_engine=None,
+        refresh_partitions=None,
+    ):
+        table_engine = TableEngine.from_config(table_engine, order_by="_extracted_at")
+        working_name = self.working_table_name(schema_name, table_name)
+        working = schema_name + "." + working_name
         self._ensure_schema(schema_name)
 
         client = self.client()
@@ -232,17 +551,20 @@ class ClickHouse(BaseStore):
             make_message=lambda count, last_row: f"Processed {count} records to {working}, last was {last_row}"
         )
 
+        reservoir = Reservoir()
+
         def record_for_clickhouse(record):
             row = [record.data_str, record.extracted_at]
             p.update(row)
+            reservoir.add(dict(data=row[0], _extracted_at=row[1]))
             return row
 
+        cols = [("data", "String"), ("_extracted_at", EXTRACTED_AT)]
         client.execute(
-            f"""CREATE TABLE IF NOT EXISTS {working} (
-                    data String,
-                    _extracted_at DateTime64 DEFAULT toDateTime64(now(), 3, 'UTC'))
-                ENGINE MergeTree()
-                ORDER BY (_extracted_at);"""
+            f"CREATE TABLE IF NOT EXISTS {working} {table_engine.columns_sql(cols)} {table_engine.sql()};"
+        )
+        partitioned = self._partitioned(
+            client, schema_name, working_name, table_name, refresh_partitions
         )
         insert = f"""INSERT INTO {working} (data, _extracted_at) VALUES"""
         num_rows = client.execute(
@@ -251,31 +573,81 @@ class ClickHouse(BaseStore):
 
         p.display()
 
-        if client.table_exists(schema_name, table_name):
-            client.execute(f"RENAME TABLE {final} to {tombstone};")
-            client.execute(f"RENAME TABLE {working} to {final};")
-            client.execute(f"DROP TABLE {tombstone};")
-        else:
-            client.execute(f"RENAME TABLE {working} to {final};")
-        p.display(f"Renamed {working} to {final}")
+        self._record_task_io(client, schema_name, working_name, num_rows)
 
-        table = Table(store=self, schema_name=schema_name, table_name=table_name)
+        self._swap_in(
+            p,
+            schema_name,
+            working_name,
+            table_name,
+            partitioned,
+            refresh_partitions,
+            reservoir,
+        )
 
         self._cleanup_tables(p, schema_name, table_name)
 
         return {
             "count": num_rows,
-            "rows": table.sample(
-                limit=max(23, num_rows),
-                order_by="rand()",
-                where=f"inserted_at = (select max(inserted_at) FROM {final})",
-            ),
+            "rows": self.preview(schema_name, table_name),
         }
 
-    def create_or_replace_model(self, table_name, schema_name, select):
-        final = schema_name + "." + table_name
-        working = with_random_suffix(final, "working")
-        tombstone = with_random_suffix(final, "tombstone")
+    def create_or_replace_typed(
+        self,
+        schema_name,
+        table_name,
+        raw_table_name,
+        columns,
+        table_engine=None,
+        refresh_partitions=None,
+    ):
+        selects = ["_extracted_at"]
+        for column in columns:
+            key = _quote(column.key)
+            type = _data_type_to_clickhouse_type(column.type)
+            if isinstance(column.type, data_type.Text):
+                # NOTE strings unquoted, anything else (objects, arrays,
+                # ...) as its json text
+                value = f"""if(JSONType(data, {key}) = 'String',
+                              JSONExtractString(data, {key}),
+                              nullIf(nullIf(JSONExtractRaw(data, {key}), ''), 'null'))"""
+            elif column.from_string:
+                # NOTE accurateCastOrNull makes the Nullable itself
+                not_null = _data_type_to_clickhouse_type(
+                    dataclasses.replace(column.type, is_nullable=False)
+                )
+                value = (
+                    f"accurateCastOrNull(JSONExtractString(data, {key}), '{not_null}')"
+                )
+            else:
+                value = f"JSONExtract(data, {key}, '{type}')"
+            selects.append(f"{value} AS `{column.name}`")
+        select = f"SELECT {', '.join(selects)} FROM {schema_name}.{raw_table_name}"
+        return self.create_or_replace_model(
+            table_name,
+            schema_name,
+            select,
+            table_engine=TableEngine.from_config(
+                table_engine, order_by="_extracted_at"
+            ),
+            refresh_partitions=refresh_partitions,
+        )
+
+    def create_or_replace_model(
+        self,
+        table_name,
+        schema_name,
+        select,
+        indexes=None,
+        json_columns=None,
+        table_engine=None,
+        refresh_partitions=None,
+        partial_select=None,
+    ):
+        if not isinstance(table_engine, TableEngine):
+            table_engine = TableEngine.from_config(table_engine)
+        working_name = self.working_table_name(schema_name, table_name)
+        working = schema_name + "." + working_name
 
         client = self.client()
 
@@ -291,21 +663,60 @@ class ClickHouse(BaseStore):
         self._ensure_schema(schema_name)
         p.display(f"Schema {schema_name} exists.")
 
-        query = client.execute_with_progress(
-            f"CREATE TABLE {working} ENGINE = MergeTree() ORDER BY order_by AS {select};"
+        if indexes or json_columns:
+            # NOTE the MergeTree's ORDER BY is clickhouse's index, and
+            # json is extracted in the select itself.
+            p.display(f"Ignoring index() and json_column() for {working}.")
+
+        # NOTE instead of CREATE TABLE ... AS SELECT so the columns can
+        # have codecs, the select's columns come back with no rows read.
+        select = select.strip().rstrip(";")
+        _, cols = client.execute(
+            f"SELECT * FROM ({select}\n) LIMIT 0", with_column_types=True
         )
-        for num_rows, total_rows in query:
-            p.update([num_rows, total_rows])
+        client.execute(
+            f"CREATE TABLE {working} {table_engine.columns_sql(cols)} {table_engine.sql()};"
+        )
+        p.display(f"Table {working} created.")
+
+        partitioned = self._partitioned(
+            client, schema_name, working_name, table_name, refresh_partitions
+        )
+        refresh_some = partitioned and isinstance(refresh_partitions, str)
+        if refresh_some:
+            # NOTE partial_select is the model rendered with its
+            # partition_filter(), so only the rows being refreshed are
+            # computed, the outer WHERE is for models without one.
+            select = (partial_select or select).strip().rstrip(";")
+            select = f"SELECT * FROM ({select}\n) WHERE {refresh_partitions}"
+
+        query = client.execute_with_progress(f"INSERT INTO {working} {select}")
+        num_rows = None
+        with span("store.execute", statement=statement_attr(select)):
+            for num_rows, total_rows in query:
+                p.update([num_rows, total_rows])
 
         res = query.get_result()
-        p.display(f"Table {working} created: {res}")
+        p.display(f"Table {working} filled: {res}")
 
-        if client.table_exists(schema_name, table_name):
-            client.execute(f"RENAME TABLE {final} to {tombstone};")
-            client.execute(f"RENAME TABLE {working} to {final};")
-            client.execute(f"DROP TABLE {tombstone};")
-        else:
-            client.execute(f"RENAME TABLE {working} to {final};")
+        # NOTE the progress packets count the rows the select read.
+        self._record_task_io(client, schema_name, working_name, num_rows)
+
+        if refresh_some:
+            # NOTE only whole partitions can be swapped in
+            self._copy_unrefreshed_rows(
+                client, schema_name, working_name, table_name, refresh_partitions
+            )
+
+        self._swap_in(
+            p,
+            schema_name,
+            working_name,
+            table_name,
+            partitioned,
+            refresh_partitions,
+            None,
+        )
 
         self._cleanup_tables(p, schema_name, table_name)
 
@@ -317,8 +728,11 @@ class ClickHouse(BaseStore):
 
 
 def _execute(client, statement, limit):
-    res = client.execute_iter(statement, with_column_types=True)
-    cols = next(res)
+    # NOTE execute_iter streams, the span covers getting the first
+    # block (and so the column types) back.
+    with span("store.execute", statement=statement_attr(statement)):
+        res = client.execute_iter(statement, with_column_types=True)
+        cols = next(res)
 
     count = 0
     for data in res:
@@ -333,12 +747,30 @@ def _execute(client, statement, limit):
 
 
 class Table(BaseTable):
+    def sampling_key(self, client):
+        res = client.execute(
+            "select sampling_key from system.tables where database = %(schema_name)s and name = %(table_name)s",
+            dict(schema_name=self.schema_name, table_name=self.table_name),
+        )
+        return res[0][0] if res else ""
+
     def _sample(self, limit, order_by, where):
+        client = self.store.client()
         stmt = f"SELECT * FROM {self.schema_name}.{self.table_name}"
+        if order_by == "random":
+            # NOTE without a sampling key we settle for whatever the
+            # first granules hold, which is still better than sorting
+            # the whole table by rand().
+            if self.sampling_key(client):
+                stmt += " SAMPLE 0.1"
+            order_by = None
+        elif order_by == "new":
+            order_by = "_extracted_at DESC"
+        elif order_by == "old":
+            order_by = "_extracted_at ASC"
         if where is not None:
             stmt += f" WHERE {where} "
         if order_by is not None:
             stmt += f" ORDER BY {order_by} "
-        if limit is None:
-            limit = 23
-        return _execute(self.store.client(), stmt, limit)
+        stmt += f" LIMIT {int(limit)}"
+        return _execute(client, stmt, limit)
@@ -0,0 +1,151 @@
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class LedgerEntry:
+    schema_name: str
+    table_name: str
+    final_name: str
+    tag: str
+    created_at: float
+    # NOTE the task whose refresh created the table, if any
+    tid: Optional[str] = None
+
+
+class TableLedger:
+    """Records the working and tombstone tables a store creates so that
+    cleanup can drop exactly those, instead of listing (and regexp
+    matching) every table in the schema.
+    """
+
+    def __init__(self, path, store_id):
+        self.path = path
+        self.store_id = store_id
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute(
+            """create table if not exists tables (
+                 store text not null,
+                 schema_name text not null,
+                 table_name text not null,
+                 final_name text not null,
+                 tag text not null,
+                 created_at real not null,
+                 tid text,
+                 primary key (store, schema_name, table_name))"""
+        )
+        columns = [row[1] for row in conn.execute("pragma table_info(tables)")]
+        if "tid" not in columns:
+            # NOTE a ledger from before tables knew their task
+            conn.execute("alter table tables add column tid text")
+        conn.execute(
+            """create table if not exists previews (
+                 store text not null,
+                 schema_name text not null,
+                 table_name text not null,
+                 num_rows integer,
+                 rows text not null,
+                 captured_at real not null,
+                 primary key (store, schema_name, table_name))"""
+        )
+        return conn
+
+    @contextmanager
+    def cursor(self):
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute("begin;")
+
+        try:
+            yield cur
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+
+    def record(self, schema_name, table_name, final_name, tag, tid=None):
+        with self.cursor() as cur:
+            cur.execute(
+                "insert or replace into tables (store, schema_name, table_name, final_name, tag, created_at, tid) values (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    self.store_id,
+                    schema_name,
+                    table_name,
+                    final_name,
+                    tag,
+                    time.time(),
+                    tid,
+                ],
+            )
+
+    def retag(self, schema_name, table_name, tag):
+        with self.cursor() as cur:
+            cur.execute(
+                "update tables set tag = ? where store = ? and schema_name = ? and table_name = ?",
+                [tag, self.store_id, schema_name, table_name],
+            )
+
+    def forget(self, schema_name, table_names):
+        with self.cursor() as cur:
+            cur.executemany(
+                "delete from tables where store = ? and schema_name = ? and table_name = ?",
+                [[self.store_id, schema_name, name] for name in table_names],
+            )
+
+    def entries(self, schema_name=None, final_name=None, tag=None, older_than=None):
+        query = "select schema_name, table_name, final_name, tag, created_at, tid from tables where store = ?"
+        args = [self.store_id]
+        if schema_name is not None:
+            query += " and schema_name = ?"
+            args.append(schema_name)
+        if final_name is not None:
+            query += " and final_name = ?"
+            args.append(final_name)
+        if tag is not None:
+            query += " and tag = ?"
+            args.append(tag)
+        if older_than is not None:
+            query += " and created_at < ?"
+            args.append(time.time() - older_than.total_seconds())
+        with self.cursor() as cur:
+            return [LedgerEntry(*row) for row in cur.execute(query, args).fetchall()]
+
+    def save_preview(self, schema_name, table_name, rows, num_rows):
+        with self.cursor() as cur:
+            cur.execute(
+                "insert or replace into previews (store, schema_name, table_name, num_rows, rows, captured_at) values (?, ?, ?, ?, ?, ?)",
+                [
+                    self.store_id,
+                    schema_name,
+                    table_name,
+                    num_rows,
+                    json.dumps(rows),
+                    time.time(),
+                ],
+            )
+
+    def forget_preview(self, schema_name, table_name):
+        with self.cursor() as cur:
+            cur.execute(
+                "delete from previews where store = ? and schema_name = ? and table_name = ?",
+                [self.store_id, schema_name, table_name],
+            )
+
+    def load_preview(self, schema_name, table_name):
+        with self.cursor() as cur:
+            row = cur.execute(
+                "select num_rows, rows, captured_at from previews where store = ? and schema_name = ? and table_name = ?",
+                [self.store_id, schema_name, table_name],
+            ).fetchone()
+        if row is None:
+            return None
+        num_rows, rows, captured_at = row
+        return dict(num_rows=num_rows, rows=json.loads(rows), captured_at=captured_at)
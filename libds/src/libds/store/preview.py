@@ -0,0 +1,26 @@
+from random import Random
+
+PREVIEW_SIZE = 23
+
+
+class Reservoir:
+    """Keeps a uniform random sample of `size` of the rows passed to
+    `add` (Vitter's algorithm R), so a loader can capture a preview of
+    a table while streaming it without a second pass over the data.
+    """
+
+    def __init__(self, size=PREVIEW_SIZE, random=None):
+        self.size = size
+        self.count = 0
+        self.rows = []
+        self.random = random or Random()
+
+    def add(self, row):
+        self.count += 1
+        if len(self.rows) < self.size:
+            self.rows.append(row)
+        else:
+            i = self.random.randrange(self.count)
+            if i < self.size:
+                self.rows[i] = row
+        return row
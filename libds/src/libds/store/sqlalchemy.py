@@ -1,18 +1,38 @@
 import datetime
 from decimal import Decimal
 
-import sqlalchemy as sa
-
 from libds.store import BaseStore, BaseTable
 
 
 class SQLAlchemyStore(BaseStore):
+    # NOTE sqlalchemy takes longer to import than the rest of ds put
+    # together, only pay for it once the store is actually used.
     def __init__(self, url=None, **kwargs):
         super().__init__(**kwargs)
         self.url = url
-        self.metadata = sa.MetaData()
-        if self.url is not None:
-            self.engine = sa.create_engine(self.url, echo=False)
+        self._metadata = None
+        self._engine = None
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            import sqlalchemy as sa
+
+            self._metadata = sa.MetaData()
+        return self._metadata
+
+    @property
+    def engine(self):
+        if self._engine is None and self.url is not None:
+            import sqlalchemy as sa
+
+            self._engine = sa.create_engine(self.url, echo=False)
+            sa.event.listen(self._engine, "connect", self.on_connect)
+        return self._engine
+
+    def on_connect(self, dbapi_connection, connection_record):
+        """Called with every new dbapi connection the engine opens."""
+        pass
 
 
 class Table(BaseTable):
@@ -23,6 +43,8 @@ class Table(BaseTable):
             order_by = f"ORDER BY {order_by}"
         else:
             order_by = ""
+        import sqlalchemy as sa
+
         with self.store.engine.connect() as conn:
             table_name = self.store.make_table_name(self.schema_name, self.table_name)
             res = conn.execute(
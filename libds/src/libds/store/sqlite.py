@@ -1,21 +1,143 @@
-import json
+import hashlib
 from pathlib import Path
 from pprint import pprint  # noqa: F401
 
-import sqlalchemy as sa
-
-from libds.store import (
-    BaseTable,
-    random_suffix_regexp,
-    to_sample_value,
-    with_random_suffix,
-)
+from libds.data_node import record_task_io
+from libds.model import data_type
+from libds.store import BaseTable, to_sample_value
+from libds.store.preview import Reservoir
 from libds.store.sqlalchemy import SQLAlchemyStore
-from libds.utils import InsertProgress
+from libds.trace import span, statement_attr
+from libds.utils import InsertProgress, chunked
+
+INSERT_BATCH_SIZE = 1000
+
+JOURNAL_MODES = ["delete", "truncate", "persist", "memory", "wal", "off"]
+SYNCHRONOUS_LEVELS = ["off", "normal", "full", "extra"]
+
+
+def _data_type_to_sqlite_type(t):
+    if isinstance(t, data_type.Integer):
+        type_string = "INTEGER"
+    elif isinstance(t, data_type.Float):
+        type_string = "REAL"
+    elif isinstance(t, data_type.Decimal):
+        type_string = "NUMERIC"
+    else:
+        type_string = "TEXT"
+    if not t.is_nullable:
+        type_string += " NOT NULL"
+    return type_string
+
+
+def _affinity(declared_type):
+    # NOTE sqlite's own rules, https://www.sqlite.org/datatype3.html
+    declared_type = declared_type.upper()
+    if "INT" in declared_type:
+        return "integer"
+    if any(t in declared_type for t in ["CHAR", "CLOB", "TEXT"]):
+        return "text"
+    if declared_type == "" or "BLOB" in declared_type:
+        return None
+    if any(t in declared_type for t in ["REAL", "FLOA", "DOUB"]):
+        return "real"
+    return None
+
+
+def _arrow_type(pa, value_types):
+    """The pyarrow type for a column holding values of sqlite's
+    value_types (as typeof() has them)."""
+    value_types = set(value_types) - {"null"}
+    if not value_types:
+        return pa.null()
+    if value_types == {"integer"}:
+        return pa.int64()
+    if value_types <= {"integer", "real"}:
+        return pa.float64()
+    if value_types == {"blob"}:
+        return pa.binary()
+    if "blob" not in value_types:
+        return pa.string()
+    return None
+
+
+def _pragmas(journal_mode, cache_size, mmap_size, synchronous):
+    pragmas = {}
+    if journal_mode is not None:
+        journal_mode = str(journal_mode).lower()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(
+                f"Unknown journal_mode {journal_mode}, not one of {JOURNAL_MODES}"
+            )
+        pragmas["journal_mode"] = journal_mode
+    if cache_size is not None:
+        # NOTE as sqlite has it, negative is in KiB, positive in pages
+        pragmas["cache_size"] = int(cache_size)
+    if mmap_size is not None:
+        pragmas["mmap_size"] = int(mmap_size)
+    if synchronous is not None:
+        # NOTE yaml reads a bare off as False
+        if synchronous is False:
+            synchronous = "off"
+        synchronous = str(synchronous).lower()
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError(
+                f"Unknown synchronous {synchronous}, not one of {SYNCHRONOUS_LEVELS}"
+            )
+        pragmas["synchronous"] = synchronous
+    return pragmas
+
+
+def _index_sql(table_name, index_name, index):
+    unique = "UNIQUE " if index["unique"] else ""
+    columns = ", ".join(f'"{c}"' for c in index["columns"])
+    return f'CREATE {unique}INDEX "{index_name}" ON "{table_name}" ({columns})'
+
+
+def _json_column_sql(table_name, column):
+    path = column["path"]
+    if not path.startswith("$"):
+        path = '$."' + path + '"'
+    value = f"""json_extract("{column['source']}", '{path.replace("'", "''")}')"""
+    type = column["type"] or ""
+    # NOTE only VIRTUAL columns can be added to an existing table, the
+    # value is computed on read, or read from an index on the column.
+    return f'ALTER TABLE "{table_name}" ADD COLUMN "{column["name"]}" {type} GENERATED ALWAYS AS ({value}) VIRTUAL'
+
+
+class RowChecksum:
+    """Sums (mod 2**64) a hash of every row, so it doesn't depend on
+    their order. sqlite has no hash function, this is both fed by the
+    loaders as they stream rows in and registered as the ds_checksum
+    aggregate for tables built inside sqlite."""
+
+    def __init__(self):
+        self.num_rows = 0
+        self.checksum = 0
+
+    def step(self, *values):
+        digest = hashlib.blake2b(repr(values).encode("utf-8"), digest_size=8)
+        self.checksum = (self.checksum + int.from_bytes(digest.digest(), "big")) % (
+            2**64
+        )
+        self.num_rows += 1
+
+    def finalize(self):
+        return f"{self.checksum:016x}"
+
+    def fingerprint(self):
+        return dict(num_rows=self.num_rows, checksum=self.finalize())
 
 
 class SQLite(SQLAlchemyStore):
-    def __init__(self, path):
+    def __init__(
+        self,
+        path,
+        journal_mode=None,
+        cache_size=None,
+        mmap_size=None,
+        synchronous=None,
+    ):
         if path == ":memory:":
             url = "sqlite+pysqlite://"
         else:
@@ -25,37 +147,247 @@ class SQLite(SQLAlchemyStore):
             joined = dir.joinpath(Path(path))
             resolved = joined.resolve()
             url = f"sqlite+pysqlite:///{resolved}"
-        self.parameters = dict(path=path, url=url)
+        self.pragmas = _pragmas(journal_mode, cache_size, mmap_size, synchronous)
+        self.parameters = dict(path=path, url=url, **self.pragmas)
         super().__init__(url=url)
+        # NOTE (schema, table, columns) => fingerprint of the rows just
+        # streamed into it, so fingerprint doesn't read them back.
+        self.streamed_fingerprints = {}
+        # NOTE each thread gets its own in memory database, cleaning
+        # up from another thread would drop nothing.
+        self.cleanup_in_background = path != ":memory:"
 
     @classmethod
     def from_yaml(cls, yaml):
-        return cls(path=yaml["path"])
+        return cls(
+            path=yaml["path"],
+            journal_mode=yaml.get("journal_mode"),
+            cache_size=yaml.get("cache_size"),
+            mmap_size=yaml.get("mmap_size"),
+            synchronous=yaml.get("synchronous"),
+        )
 
     def info(self):
         return self._info(parameters=self.parameters)
 
-    def table_exists(self, conn, schema_name, table_name):
-        res = conn.execute(
-            "select count(*) as count from sqlite_master where name = :name",
-            dict(name=table_name),
-        )
-        return res.one()["count"]
+    def on_connect(self, dbapi_connection, connection_record):
+        dbapi_connection.create_aggregate("ds_checksum", -1, RowChecksum)
+        cur = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragmas.items():
+                cur.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cur.close()
 
-    def drop_tables_by_tag(self, schema_name, table_name, tag):
+    def table_exists(self, schema_name, table_name):
+        with self.engine.connect() as conn:
+            res = conn.execute(
+                "select count(*) as count from sqlite_master where type = 'table' and name = :name",
+                dict(name=table_name),
+            )
+            return res.one()["count"] > 0
+
+    def swap_in(self, schema_name, working_name, table_name):
+        # NOTE we go to the dbapi connection since pysqlite only opens
+        # transactions for dml, a drop/rename would be autocommitted
+        # statement by statement and readers could see no table at
+        # all. legacy_alter_table stops the rename from rewriting (or
+        # choking on) views which refer to the table.
+        conn = self.engine.raw_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("PRAGMA legacy_alter_table = ON")
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            cur.execute(f'ALTER TABLE "{working_name}" RENAME TO "{table_name}"')
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            cur.execute("PRAGMA legacy_alter_table = OFF")
+            conn.close()
+        self.ledger.forget(schema_name, [working_name])
+
+    def _used_bytes(self, conn):
+        page_size = conn.execute("pragma page_size").scalar()
+        page_count = conn.execute("pragma page_count").scalar()
+        freelist_count = conn.execute("pragma freelist_count").scalar()
+        return (page_count - freelist_count) * page_size
+
+    def _used_bytes_dbapi(self, conn):
+        def pragma(name):
+            return conn.execute(f"pragma {name}").fetchone()[0]
+
+        return (pragma("page_count") - pragma("freelist_count")) * pragma("page_size")
+
+    def list_tables(self, schema_name):
         with self.engine.connect() as conn:
-            re = random_suffix_regexp(table_name, tag)
             res = conn.execute("select name from sqlite_schema where type = 'table'")
-            table_names = [row["name"] for row in res.all() if re.match(row["name"])]
+            return [row["name"] for row in res.all()]
+
+    def arrow_types(self, pa, schema_name, table_name):
+        with self.engine.connect() as conn:
+            declared = {
+                row["name"]: _affinity(row["type"])
+                for row in conn.execute(f'PRAGMA table_info("{table_name}")')
+            }
+            # NOTE most model columns have no declared type, for those
+            # it's the types of the values they hold, in one pass
+            untyped = [name for name, affinity in declared.items() if affinity is None]
+            found = {}
+            if untyped:
+                value_types = ["integer", "real", "text", "blob"]
+                selects = [
+                    f"max(typeof(\"{name}\") = '{t}')"
+                    for name in untyped
+                    for t in value_types
+                ]
+                row = conn.execute(
+                    f'SELECT {", ".join(selects)} FROM "{table_name}"'
+                ).fetchone()
+                # NOTE a flag per value type, for each column in turn
+                flags = iter(row)
+                for name in untyped:
+                    found[name] = [t for t in value_types if next(flags)]
+        return {
+            name: _arrow_type(pa, [affinity] if affinity else found[name])
+            for name, affinity in declared.items()
+        }
+
+    def fingerprint(self, schema_name, table_name, columns=None):
+        key = (schema_name, table_name, tuple(columns or ()))
+        if key in self.streamed_fingerprints:
+            return self.streamed_fingerprints.pop(key)
+        conn = self.engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            if columns is None:
+                cur.execute(f'PRAGMA table_info("{table_name}")')
+                columns = [row[1] for row in cur.fetchall()]
+            hashed = ", ".join(f'"{c}"' for c in columns)
+            with span("store.fingerprint", table_name=table_name):
+                cur.execute(
+                    f'SELECT count(*), ds_checksum({hashed}) FROM "{table_name}"'
+                )
+                num_rows, checksum = cur.fetchone()
+        finally:
+            conn.close()
+        return dict(num_rows=num_rows, checksum=checksum)
+
+    def iter_batches(self, schema_name, table_name, batch_size):
+        conn = self.engine.raw_connection()
+        cur = conn.cursor()
+        with span("store.execute", table_name=table_name):
+            cur.execute(f'SELECT * FROM "{table_name}"')
+        columns = [d[0] for d in cur.description]
+
+        def batches():
+            try:
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        return
+                    yield rows
+            finally:
+                conn.close()
+
+        return columns, batches()
+
+    def drop_tables(self, schema_name, table_names):
+        if len(table_names) == 0:
+            return 0
+        # NOTE one transaction, so one commit, for all of them
+        with self.engine.begin() as conn:
+            page_size = conn.execute("pragma page_size").scalar()
+            before = conn.execute("pragma freelist_count").scalar()
             for table in table_names:
-                conn.execute(f'drop table "{table}";')
+                conn.execute(f'drop table if exists "{table}";')
+            after = conn.execute("pragma freelist_count").scalar()
+
+        return (after - before) * page_size
+
+    # NOTE table_engine, refresh_partitions and a model's partial_select
+    # are how clickhouse stores and refreshes a table, sqlite has no
+    # partitions and ignores them, every refresh is a full one.
+    def load_unpacked_from_records(
+        self,
+        schema_name,
+        table_name,
+        columns,
+        records,
+        table_engine=None,
+        refresh_partitions=None,
+    ):
+        working_name = self.working_table_name(schema_name, table_name)
+
+        p = InsertProgress(
+            make_message=lambda count, last_row: f"Processed {count} records to {working_name}, last was {last_row}"
+        )
+
+        column_names = [c[0] for c in columns]
+        cols = [f'"{name}" {_data_type_to_sqlite_type(type)}' for name, type in columns]
+        query = f"""CREATE TABLE "{working_name}" (
+                       _extracted_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+                       {", ".join(cols)})"""
+        insert = f"""INSERT INTO "{working_name}" ({", ".join(f'"{c}"' for c in column_names)})
+                      VALUES ({", ".join(["?"] * len(column_names))})"""
 
-        return table_names
+        reservoir = Reservoir()
+        checksum = RowChecksum()
 
-    def load_raw_from_records(self, schema_name, table_name, records):
+        def record_for_sqlite(record):
+            data = record.data
+            row = [data[column] for column in column_names]
+            p.update(row)
+            reservoir.add(data)
+            checksum.step(*row)
+            return row
+
+        # NOTE executemany on the dbapi connection, in batches, so
+        # memory stays flat however many records there are.
+        conn = self.engine.raw_connection()
+        try:
+            used_bytes = self._used_bytes_dbapi(conn)
+            cur = conn.cursor()
+            cur.execute(query)
+            p.display(f"Created {query}")
+            with span("store.execute", statement=statement_attr(insert)):
+                for batch in chunked(records, INSERT_BATCH_SIZE):
+                    cur.executemany(insert, [record_for_sqlite(r) for r in batch])
+            conn.commit()
+            p.display()
+            record_task_io(
+                rows_read=reservoir.count,
+                rows_written=reservoir.count,
+                bytes_written=self._used_bytes_dbapi(conn) - used_bytes,
+            )
+        finally:
+            conn.close()
+
+        self.swap_in(schema_name, working_name, table_name)
+        self.save_preview(schema_name, table_name, reservoir)
+        self.streamed_fingerprints[
+            (schema_name, table_name, tuple(column_names))
+        ] = checksum.fingerprint()
+
+        self._cleanup_tables(p, schema_name, table_name)
+
+    def load_raw_from_records(
+        self,
+        schema_name,
+        table_name,
+        records,
+        table_engine=None,
+        refresh_partitions=None,
+    ):
         final_name = table_name
-        working_name = with_random_suffix(final_name, "working")
-        tombstone_name = with_random_suffix(final_name, "tombstone")
+        working_name = self.working_table_name(schema_name, final_name)
+
+        with self.engine.connect() as conn:
+            used_bytes = self._used_bytes(conn)
+
+        import sqlalchemy as sa
 
         sa.Table(
             working_name,
@@ -65,79 +397,125 @@ class SQLite(SQLAlchemyStore):
         )
         self.metadata.create_all(self.engine)
 
-        def make_message(num_rows):
-            return f"Processed {num_rows} to {working_name}"
-
         p = InsertProgress(
             make_message=lambda count, last_row: f"Processed {count} records to {working_name}, last was {last_row}"
         )
+        insert = f'INSERT INTO "{working_name}" (data, extracted_at) VALUES (?, ?)'
+
+        reservoir = Reservoir()
+        checksum = RowChecksum()
 
         def record_for_sqlite(record):
+            # NOTE data_str is the source's own json, when it has it
             row = [record.data_str, record.extracted_at]
             p.update(row)
+            reservoir.add(dict(data=row[0], extracted_at=row[1]))
+            checksum.step(row[0])
             return row
 
-        with self.engine.connect() as conn:
-            for rec in records:
-                conn.execute(
-                    f"insert into {working_name} (data, extracted_at) values (:data, :extracted_at)",
-                    dict(data=json.dumps(rec.data), extracted_at=rec.extracted_at),
-                )
-
+        # NOTE as in load_unpacked_from_records
+        conn = self.engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            with span("store.execute", statement=statement_attr(insert)):
+                for batch in chunked(records, INSERT_BATCH_SIZE):
+                    cur.executemany(insert, [record_for_sqlite(r) for r in batch])
+            conn.commit()
             p.display()
+            record_task_io(
+                rows_read=reservoir.count,
+                rows_written=reservoir.count,
+                bytes_written=self._used_bytes_dbapi(conn) - used_bytes,
+            )
+        finally:
+            conn.close()
 
-            if self.table_exists(conn, schema_name, table_name):
-                conn.execute(f"ALTER TABLE {final_name} RENAME TO {tombstone_name};")
-                conn.execute(f"ALTER TABLE {working_name} RENAME TO {final_name};")
-                conn.execute(f"DROP TABLE {tombstone_name};")
-            else:
-                conn.execute(f"ALTER TABLE {working_name} RENAME TO {final_name};")
+        self.swap_in(schema_name, working_name, final_name)
+        self.save_preview(schema_name, final_name, reservoir)
+        self.streamed_fingerprints[
+            (schema_name, final_name, ("data",))
+        ] = checksum.fingerprint()
 
-            p.display(f"Renamed {working_name} to {final_name}")
+        p.display(f"Swapped {working_name} into {final_name}")
 
-            self._cleanup_tables(p, schema_name, final_name)
-
-        table = Table(store=self, schema_name=schema_name, table_name=table_name)
+        self._cleanup_tables(p, schema_name, final_name)
 
         return {
-            "count": None,
-            "rows": table.sample(
-                limit=23,
-                order_by="rand()",
-                where=f"inserted_at = (select max(inserted_at) FROM {final_name})",
-            ),
+            "count": reservoir.count,
+            "rows": self.preview(schema_name, final_name),
         }
 
-    def create_or_replace_model(self, schema_name, table_name, select):
+    def create_or_replace_model(
+        self,
+        schema_name,
+        table_name,
+        select,
+        indexes=None,
+        json_columns=None,
+        table_engine=None,
+        refresh_partitions=None,
+        partial_select=None,
+    ):
         final_name = table_name
-        working_name = with_random_suffix(final_name, "working")
-        tombstone_name = with_random_suffix(final_name, "tombstone")
+        working_name = self.working_table_name(schema_name, final_name)
 
         p = InsertProgress(
             make_message=lambda count: f"Processed {count} records to {working_name}"
         )
 
-        def record_for_sqlite(record):
-            row = [record.data_str, record.extracted_at]
-            p.update(row)
-            return row
-
         with self.engine.connect() as conn:
+            used_bytes = self._used_bytes(conn)
             conn.execute(f"create table {working_name} as {select}")
 
             p.display(f"Created {working_name}")
 
-            if self.table_exists(conn, schema_name, table_name):
-                conn.execute(f"ALTER TABLE {final_name} RENAME TO {tombstone_name};")
-                conn.execute(f"ALTER TABLE {working_name} RENAME TO {final_name};")
-                conn.execute(f"DROP TABLE {tombstone_name};")
-            else:
-                conn.execute(f"ALTER TABLE {working_name} RENAME TO {final_name};")
+            # NOTE on the working table, so readers of the current one
+            # never see a half indexed table and the swap stays cheap.
+            for column in json_columns or []:
+                conn.execute(_json_column_sql(working_name, column))
+                p.display(f"Added json column {column['name']} to {working_name}")
+            for i, index in enumerate(indexes or []):
+                conn.execute(_index_sql(working_name, f"{working_name}_{i}", index))
+                p.display(f"Indexed {working_name} on {index['columns']}")
+
+            record_task_io(
+                rows_written=conn.execute(
+                    f'select count(*) from "{working_name}"'
+                ).scalar(),
+                bytes_written=self._used_bytes(conn) - used_bytes,
+            )
 
-            p.display(f"Renamed {working_name} to {final_name}")
+            self.swap_in(schema_name, working_name, final_name)
+            self.save_preview(schema_name, final_name)
+
+            p.display(f"Swapped {working_name} into {final_name}")
 
             self._cleanup_tables(p, schema_name, final_name)
 
+    def create_or_replace_typed(
+        self,
+        schema_name,
+        table_name,
+        raw_table_name,
+        columns,
+        table_engine=None,
+        refresh_partitions=None,
+    ):
+        selects = ["extracted_at AS _extracted_at"]
+        for column in columns:
+            path = '$."' + column.key + '"'
+            value = "json_extract(data, '" + path.replace("'", "''") + "')"
+            if isinstance(column.type, data_type.Integer):
+                value = f"CAST({value} AS INTEGER)"
+            elif isinstance(column.type, data_type.Float):
+                value = f"CAST({value} AS REAL)"
+            selects.append(f'{value} AS "{column.name}"')
+        select = f'SELECT {", ".join(selects)} FROM "{raw_table_name}"'
+        return self.create_or_replace_model(schema_name, table_name, select)
+
+    def get_table(self, schema_name, table_name):
+        return Table(store=self, schema_name=schema_name, table_name=table_name)
+
     def execute_sql(self, stmt, limit=None):
         return _execute(self, stmt, limit)
 
@@ -151,9 +529,10 @@ class SQLite(SQLAlchemyStore):
 
 def _execute(store, statement, limit):
     with store.engine.connect() as conn:
-        res = conn.execute(statement, with_column_types=True)
+        with span("store.execute", statement=statement_attr(statement)):
+            rows = conn.execute(statement, with_column_types=True).all()
         count = 0
-        for row in res.all():
+        for row in rows:
             if limit is not None and count >= limit:
                 return
             count += 1
@@ -163,11 +542,28 @@ def _execute(store, statement, limit):
 
 class Table(BaseTable):
     def _sample(self, limit, order_by, where):
-        stmt = f"SELECT * FROM {self.table_name}"
+        table = f'"{self.table_name}"'
+        stmt = f"SELECT * FROM {table}"
+        conditions = []
         if where is not None:
-            stmt += f" WHERE {where} "
+            conditions.append(where)
+        if order_by == "random":
+            # NOTE a random run of consecutive rows, found by seeking
+            # on rowid, instead of sorting the whole table by random().
+            conditions.append(
+                f"""rowid >= (SELECT (SELECT min(rowid) FROM {table})
+                                     + abs(random()) % max(1, (SELECT max(rowid) FROM {table})
+                                                              - (SELECT min(rowid) FROM {table})
+                                                              - {limit} + 2))"""
+            )
+            order_by = None
+        elif order_by == "new":
+            order_by = "rowid DESC"
+        elif order_by == "old":
+            order_by = "rowid ASC"
+        if conditions:
+            stmt += " WHERE " + " AND ".join(f"({c})" for c in conditions)
         if order_by is not None:
             stmt += f" ORDER BY {order_by} "
-        if limit is None:
-            limit = 23
+        stmt += f" LIMIT {int(limit)}"
         return _execute(self.store, stmt, limit)
@@ -0,0 +1,162 @@
+import json
+import os
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from libds.utils import ThreadLocalValue
+
+TRACE_ID_ENV = "DS_TRACE_ID"
+TRACE_PARENT_ENV = "DS_TRACE_PARENT_ID"
+TRACE_FILE_ENV = "DS_TRACE_FILE"
+TRACE_FILENAME = "traces.jsonl"
+
+
+class Tracer:
+    def __init__(self):
+        self.trace_id = None
+        self.path = None
+        self.root_parent_id = None
+        self.current = ThreadLocalValue()
+
+    @property
+    def enabled(self):
+        return self.trace_id is not None
+
+    def configure(self, directory, trace_id=None):
+        trace_id = trace_id or os.environ.get(TRACE_ID_ENV)
+        if trace_id is None:
+            return self
+        self.trace_id = trace_id
+        self.root_parent_id = os.environ.get(TRACE_PARENT_ENV)
+        self.path = Path(
+            os.environ.get(TRACE_FILE_ENV) or Path(directory) / TRACE_FILENAME
+        )
+        return self
+
+    def write(self, span):
+        # NOTE one O_APPEND write per span, so forked refreshes can
+        # share the file without interleaving their lines.
+        line = (json.dumps(span) + "\n").encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        if not self.enabled:
+            yield None
+            return
+
+        parent = self.current.value
+        span = dict(
+            trace_id=self.trace_id,
+            span_id=uuid.uuid4().hex[:16],
+            parent_id=parent["span_id"] if parent is not None else self.root_parent_id,
+            name=name,
+            pid=os.getpid(),
+            start=time.time(),
+        )
+        if attrs:
+            span["attrs"] = attrs
+        self.current.value = span
+        started_at = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span["error"] = str(e)
+            raise e
+        finally:
+            span["duration_s"] = time.perf_counter() - started_at
+            self.current.value = parent
+            # NOTE forked children unwind their copy of the span too,
+            # only the process which opened it records it.
+            if span["pid"] == os.getpid():
+                self.write(span)
+
+
+TRACER = Tracer()
+
+
+def span(name, **attrs):
+    return TRACER.span(name, **attrs)
+
+
+def statement_attr(statement, length=200):
+    statement = " ".join(str(statement).split())
+    if len(statement) > length:
+        statement = statement[: length - 3] + "..."
+    return statement
+
+
+def read_spans(path):
+    path = Path(path)
+    if not path.exists():
+        return []
+    spans = []
+    with path.open("r") as file:
+        for line in file:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                # NOTE a process killed mid write leaves a partial line
+                continue
+    return spans
+
+
+def trace_ids(spans):
+    first_seen = {}
+    for span in spans:
+        first_seen.setdefault(span["trace_id"], span["start"])
+    return sorted(first_seen, key=lambda trace_id: first_seen[trace_id])
+
+
+def summarize_trace(spans, trace_id):
+    spans = [s for s in spans if s["trace_id"] == trace_id]
+    by_id = {s["span_id"]: s for s in spans}
+    children = defaultdict(list)
+    roots = []
+    for s in spans:
+        if s.get("parent_id") in by_id:
+            children[s["parent_id"]].append(s)
+        else:
+            roots.append(s)
+
+    # NOTE folded stacks, `a;b;c self_time`, the input format of
+    # flamegraph.pl and speedscope.
+    stacks = defaultdict(lambda: dict(count=0, total_s=0.0, self_s=0.0))
+
+    def walk(span, path):
+        path = path + [span["name"]]
+        key = ";".join(path)
+        child_s = sum(c["duration_s"] for c in children[span["span_id"]])
+        stacks[key]["count"] += 1
+        stacks[key]["total_s"] += span["duration_s"]
+        stacks[key]["self_s"] += max(0.0, span["duration_s"] - child_s)
+        for child in children[span["span_id"]]:
+            walk(child, path)
+
+    for root in sorted(roots, key=lambda s: s["start"]):
+        walk(root, [])
+
+    if spans:
+        started_at = min(s["start"] for s in spans)
+        ended_at = max(s["start"] + s["duration_s"] for s in spans)
+    else:
+        started_at = ended_at = None
+
+    breakdown = [dict(stack=stack, **values) for stack, values in stacks.items()]
+    breakdown.sort(key=lambda b: b["self_s"], reverse=True)
+    return dict(
+        trace_id=trace_id,
+        started_at=started_at,
+        duration_s=(ended_at - started_at) if spans else None,
+        num_spans=len(spans),
+        pids=sorted(set(s["pid"] for s in spans)),
+        breakdown=breakdown,
+        folded=[f"{b['stack']} {int(b['self_s'] * 1e6)}" for b in breakdown],
+    )
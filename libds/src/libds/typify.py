@@ -0,0 +1,122 @@
+import json
+import re
+
+from libds.model import data_type
+from libds.utils import column_name
+
+SAMPLE_SIZE = 1000
+
+
+class JSONColumn:
+    """A key of the raw table's json `data`, the type its values are
+    cast to, and whether they're json strings (eg "42") rather than
+    json numbers."""
+
+    def __init__(self, key, name, type, from_string=False):
+        self.key = key
+        self.name = name
+        self.type = type
+        self.from_string = from_string
+
+    def info(self):
+        return dict(
+            key=self.key,
+            name=self.name,
+            type=type(self.type).__name__,
+            from_string=self.from_string,
+        )
+
+
+def _is_int_string(value):
+    return re.fullmatch(r"[+-]?(0|[1-9][0-9]*)", value.strip()) is not None
+
+
+def _is_float_string(value):
+    if re.match(r"\s*[+-]?0[0-9]", value):
+        return False
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def infer_type(values):
+    # NOTE every column is nullable, rows past the sample can miss the key
+    if len(values) == 0:
+        return data_type.Text(is_nullable=True), False
+    if all(isinstance(v, bool) for v in values):
+        return data_type.Integer(is_nullable=True, width=8), False
+    if any(isinstance(v, bool) for v in values):
+        return data_type.Text(is_nullable=True), False
+    if all(isinstance(v, int) for v in values):
+        return data_type.Integer(is_nullable=True, width=64), False
+    if all(isinstance(v, (int, float)) for v in values):
+        return data_type.Float(is_nullable=True, width=64), False
+    if all(isinstance(v, str) for v in values):
+        if all(_is_int_string(v) for v in values):
+            return data_type.Integer(is_nullable=True, width=64), True
+        if all(_is_float_string(v) for v in values):
+            return data_type.Float(is_nullable=True, width=64), True
+    return data_type.Text(is_nullable=True), False
+
+
+def infer_columns(datas):
+    """The columns for a sample of parsed json objects, keys in the
+    order they're first seen."""
+    values = {}
+    for data in datas:
+        if not isinstance(data, dict):
+            continue
+        for key, value in data.items():
+            values.setdefault(key, [])
+            if value is not None:
+                values[key].append(value)
+
+    columns = []
+    names = set(["_extracted_at"])
+    for i, (key, key_values) in enumerate(values.items()):
+        name = column_name(key, i)
+        while name in names:
+            name = name + "_"
+        names.add(name)
+        type, from_string = infer_type(key_values)
+        columns.append(JSONColumn(key, name, type, from_string))
+    return columns
+
+
+def sample_raw_table(store, schema_name, raw_table_name, limit=SAMPLE_SIZE):
+    rows = store.get_table(schema_name, raw_table_name).sample(limit, "random")
+    datas = []
+    for row in rows:
+        try:
+            datas.append(json.loads(row["data"]))
+        except (TypeError, ValueError):
+            continue
+    return datas
+
+
+def typify(
+    store,
+    schema_name,
+    raw_table_name,
+    table_name,
+    sample_size=SAMPLE_SIZE,
+    table_engine=None,
+    refresh_partitions=None,
+):
+    columns = infer_columns(
+        sample_raw_table(store, schema_name, raw_table_name, sample_size)
+    )
+    store.create_or_replace_typed(
+        schema_name,
+        table_name,
+        raw_table_name,
+        columns,
+        table_engine=table_engine,
+        refresh_partitions=refresh_partitions,
+    )
+    fingerprint = store.fingerprint(
+        schema_name, table_name, columns=[c.name for c in columns] or None
+    )
+    return dict(columns=[c.info() for c in columns], fingerprint=fingerprint)
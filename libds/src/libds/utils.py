@@ -9,8 +9,6 @@ from datetime import timedelta
 from pathlib import Path
 from pprint import pformat
 
-from ruamel.yaml import YAML
-
 
 class ThreadLocalList(threading.local):
     def __init__(self):
@@ -147,6 +145,25 @@ class DSException(Exception):
         return dict(code=self.code(), details=str(self))
 
 
+def column_name(name, i):
+    """A plain lower case identifier for the i-th column (or key) `name`."""
+    name = re.sub(r"\W+", "_", name.strip()).strip("_").lower()
+    if name == "" or name[0].isdigit():
+        name = f"c{i + 1}" if name == "" else f"c_{name}"
+    return name
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def is_iterable(thing):
     try:
         _ = (e for e in thing)
@@ -160,6 +177,8 @@ def yaml_dump(object, file):
         file = Path(str)
     if isinstance(file, Path):
         file = file.open("w")
+    from ruamel.yaml import YAML
+
     yaml = YAML(typ="rt")
     yaml.default_flow_style = False
     yaml.indent(sequence=2, mapping=2, offset=2)
@@ -168,6 +187,8 @@ def yaml_dump(object, file):
 
 
 def yaml_load(file=None, string=None):
+    from ruamel.yaml import YAML
+
     if string is not None:
         return YAML(typ="rt").load(io.StringIO(string))
     else:
@@ -0,0 +1,138 @@
+import os
+import socket
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from libds.data_node import (
+    DataNodeState,
+    TaskHeartbeat,
+    TaskMetrics,
+    TaskOutputStream,
+    _record_task_failed,
+    claim_refresh,
+    fork,
+    run_refresh,
+)
+from libds.data_stack import DataStack
+
+
+def _describe_status(status):
+    if os.WIFSIGNALED(status):
+        return f"refresh process killed by signal {os.WTERMSIG(status)}"
+    return f"refresh process exited with {os.WEXITSTATUS(status)}"
+
+
+class Worker:
+    """Claims ready data nodes, from the orchestrator's state db, and
+    refreshes them, one at a time, each in a child process. Any number of
+    workers, on any number of hosts sharing the state db, can run
+    against the same data stack, a node's lease makes sure only one of
+    them refreshes it."""
+
+    def __init__(
+        self, directory, poll_interval=1.0, exit_when_idle=False, max_tasks=None
+    ):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.exit_when_idle = exit_when_idle
+        self.max_tasks = max_tasks
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.tasks = []
+        # NOTE the nodes whose refresh failed in this worker, their retry
+        # waits for the backoff in the state db.
+        self.failed = []
+
+    def refresh(self, orchestrator, node):
+        ts = datetime.utcnow().isoformat() + "Z"
+        log_dir = self.directory / "logs" / f"{ts}-{uuid.uuid4()}"
+        stdout_file = log_dir / (node.id + ".stdout")
+        stderr_file = log_dir / (node.id + ".stderr")
+        info = dict(
+            stdout=str(stdout_file.resolve()), stderr=str(stderr_file.resolve())
+        )
+        tid = claim_refresh(orchestrator, node, info, owner=self.owner)
+        if tid is None:
+            return None
+
+        # NOTE the refresh runs in a child, so its metrics are its own and
+        # a leaking or crashing source can't take the worker down. The
+        # worker keeps the task's heartbeat going, its thread starts after
+        # the fork so the child doesn't get a copy of it (or of any lock
+        # it holds).
+        child_pid = fork()
+        if child_pid == 0:
+            os._exit(self._run_child(orchestrator, node, tid, stdout_file, stderr_file))
+        with TaskHeartbeat(orchestrator, node.id, tid):
+            _, status = os.waitpid(child_pid, 0)
+
+        if status != 0:
+            if orchestrator.load_task(tid).state == "RUNNING":
+                # NOTE it died before it could record anything
+                _record_task_failed(
+                    orchestrator,
+                    node.id,
+                    tid,
+                    _describe_status(status),
+                    "",
+                    TaskMetrics(),
+                )
+            print(f"Refreshing {node.id} failed, see {stderr_file}", file=sys.stderr)
+            self.failed.append(node.id)
+        return tid
+
+    def _run_child(self, orchestrator, node, tid, stdout_file, stderr_file):
+        import setproctitle
+
+        setproctitle.setproctitle(sys.argv[0] + " data-node-refresh " + node.id)
+        sys.stdout = TaskOutputStream(stdout_file)
+        sys.stderr = TaskOutputStream(stderr_file)
+        try:
+            run_refresh(orchestrator, node, tid, isolated=True)
+            return 0
+        except Exception:
+            return 1
+        finally:
+            # NOTE the task is recorded done already, but os._exit would
+            # kill the store's cleanup halfway through.
+            orchestrator.data_stack.store.wait_for_cleanup()
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+    def step(self, orchestrator):
+        """Refreshes the first ready node it can claim, returns its
+        task's id or None when there was none."""
+        orchestrator.reap_zombies()
+        orchestrator.load_node_states()
+        orchestrator.set_due_nodes_stale()
+        orchestrator.load_node_states()
+        for node in orchestrator.ready_nodes():
+            tid = self.refresh(orchestrator, node)
+            if tid is not None:
+                self.tasks.append(tid)
+                return tid
+        return None
+
+    def idle(self, orchestrator):
+        orchestrator.load_node_states()
+        if orchestrator.ready_nodes():
+            return False
+        # NOTE nodes being refreshed, by any worker, can make others ready
+        return not any(
+            node.state in (DataNodeState.REFRESHING, DataNodeState.REFRESHING_STALE)
+            for node in orchestrator.data_nodes.values()
+        )
+
+    def run(self):
+        print(f"Worker {self.owner} started on {self.directory}", file=sys.stderr)
+        orchestrator = DataStack.from_dir(self.directory).data_orchestrator
+        while self.max_tasks is None or len(self.tasks) < self.max_tasks:
+            if self.step(orchestrator) is not None:
+                continue
+            if self.exit_when_idle and self.idle(orchestrator):
+                break
+            time.sleep(self.poll_interval)
+            # NOTE pick up changes to the sources and models
+            orchestrator = DataStack.from_dir(self.directory).data_orchestrator
+        return dict(owner=self.owner, tasks=self.tasks, failed=self.failed)
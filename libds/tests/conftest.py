@@ -0,0 +1,14 @@
+import pytest
+
+from libds.data_stack import DataStack
+
+
+@pytest.fixture()
+def data_stack(tmp_path):
+    (tmp_path / "data_stack.yaml").write_text("created_at: test\n")
+    stores = tmp_path / "stores"
+    stores.mkdir()
+    (stores / "store.yaml").write_text(
+        "type: libds.store.sqlite.SQLite\npath: ./store.sqlite3\n"
+    )
+    return DataStack.from_dir(tmp_path)
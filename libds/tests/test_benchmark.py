@@ -0,0 +1,53 @@
+import pytest
+
+from libds.benchmark import (
+    benchmark_data_stack,
+    benchmark_ingestion,
+    benchmark_model_queries,
+    dag_dependencies,
+    record_size,
+)
+
+
+def test_dag_shapes():
+    assert dag_dependencies("wide", 2, 3) == [
+        ["public.s_0_raw"],
+        ["public.s_1_raw"],
+        ["public.s_0_raw"],
+    ]
+    assert dag_dependencies("deep", 1, 3) == [
+        ["public.s_0_raw"],
+        ["public.m_0"],
+        ["public.m_1"],
+    ]
+    assert dag_dependencies("diamond", 1, 4) == [
+        ["public.s_0_raw"],
+        ["public.m_0"],
+        ["public.m_0"],
+        ["public.m_1", "public.m_2"],
+    ]
+
+
+@pytest.mark.parametrize("shape", ["wide", "deep", "diamond"])
+def test_benchmark_data_stack(tmp_path, shape):
+    result = benchmark_data_stack(tmp_path, 3, 7, shape, repeat=1, tick=False)
+    assert result["nodes"] == 10
+    assert result["from_dir_s"]["min"] > 0
+
+
+def test_benchmark_ingestion(tmp_path):
+    result = benchmark_ingestion(
+        tmp_path, "sqlite-file", "raw", 100, 4, tracemalloc_rows=10
+    )
+    assert result["rows_per_s"] > 0
+    assert result["bytes_per_s"] == pytest.approx(result["rows_per_s"] * record_size(4))
+    assert result["peak_rss"] >= result["rss_before"]
+
+    result = benchmark_ingestion(tmp_path, "sqlite-memory", "unpacked", 100, 4)
+    assert result["rows_per_s"] > 0
+
+
+@pytest.mark.parametrize("tuned", [False, True])
+def test_benchmark_model_queries(tmp_path, tuned):
+    result = benchmark_model_queries(tmp_path, 100, tuned, num_queries=5)
+    assert result["queries_per_s"] > 0
@@ -0,0 +1,190 @@
+import pytest
+
+from libds.data_stack import DataStack
+from libds.store.clickhouse import (
+    EXTRACTED_AT,
+    ClickHouse,
+    TableEngine,
+    _clickhouse_type_to_arrow_type,
+)
+
+
+def test_default_table_engine():
+    assert (
+        TableEngine.from_config(None).sql() == "ENGINE = MergeTree() ORDER BY tuple()"
+    )
+    assert (
+        TableEngine.from_config({}, order_by="_extracted_at").columns_sql(
+            [("data", "String")]
+        )
+        == "(`data` String)"
+    )
+
+
+def test_table_engine_from_source_yaml(data_stack):
+    (data_stack.directory / "sources" / "events.yaml").write_text(
+        "type: libds.source.static.StaticTable\n"
+        "data: |\n  id value\n  1 a\n"
+        "table_engine:\n"
+        "  engine: ReplacingMergeTree\n"
+        "  order_by: [toDate(_extracted_at), data]\n"
+        "  primary_key: toDate(_extracted_at)\n"
+        "  partition_by: toYYYYMM(_extracted_at)\n"
+        "  ttl: toDateTime(_extracted_at) + INTERVAL 30 DAY\n"
+        "  codecs: {data: ZSTD(3)}\n"
+    )
+    source = DataStack.from_dir(data_stack.directory).get_source("events")
+    engine = TableEngine.from_config(source.table_engine, order_by="_extracted_at")
+    assert engine.sql() == (
+        "ENGINE = ReplacingMergeTree() ORDER BY (toDate(_extracted_at), data)"
+        " PARTITION BY toYYYYMM(_extracted_at) PRIMARY KEY toDate(_extracted_at)"
+        " TTL toDateTime(_extracted_at) + INTERVAL 30 DAY"
+    )
+    assert engine.columns_sql(
+        [("data", "String"), ("_extracted_at", EXTRACTED_AT)]
+    ) == (f"(`data` String CODEC(ZSTD(3)), `_extracted_at` {EXTRACTED_AT})")
+
+
+def test_table_engine_from_model(data_stack):
+    (data_stack.directory / "models" / "m.sql").write_text(
+        '{{ table_engine(order_by="id", codecs={"id": "Delta, LZ4"}) }}\nselect 1 as id\n'
+    )
+    model = DataStack.from_dir(data_stack.directory).get_model("m")
+    engine = TableEngine.from_config(model.table_engine)
+    assert engine.sql() == "ENGINE = MergeTree() ORDER BY id"
+    assert engine.columns_sql([("id", "UInt8")]) == "(`id` UInt8 CODEC(Delta, LZ4))"
+    with pytest.raises(ValueError):
+        engine.columns_sql([("other", "UInt8")])
+    with pytest.raises(ValueError):
+        TableEngine.from_config(dict(order=["id"]))
+
+    # NOTE sqlite has no use for it, but the model still builds
+    model.load_data()
+
+
+class FakeClient:
+    def __init__(self, results):
+        self.results = results
+        self.statements = []
+
+    def execute(self, query, params=None, **kwargs):
+        self.statements.append(query)
+        for prefix, result in self.results.items():
+            if query.startswith(prefix):
+                return result
+        return []
+
+    def execute_with_progress(self, query, params=None, **kwargs):
+        self.statements.append(query)
+        return FakeProgress()
+
+    def table_exists(self, schema_name, table_name):
+        return True
+
+
+class FakeProgress:
+    def __iter__(self):
+        return iter([(10, 10)])
+
+    def get_result(self):
+        return []
+
+
+def _fake_store(data_stack, client):
+    store = ClickHouse(host="localhost", port=9000)
+    store.data_stack = data_stack
+    store.client = lambda schema_name="public": client
+    store.cleanup_in_background = False
+    return store
+
+
+def test_swap_in_partitions(data_stack):
+    client = FakeClient(
+        {
+            "select distinct partition_id from system.parts": [
+                ("202203",),
+                ("202204",),
+            ],
+            "SELECT DISTINCT _partition_id": [("202202",), ("202203",)],
+        }
+    )
+    store = _fake_store(data_stack, client)
+    store.ledger.record("public", "facts_working", "facts", "working")
+
+    partitions = store.swap_in_partitions(
+        "public", "facts_working", "facts", where="day >= '2022-02-20'"
+    )
+
+    assert partitions == dict(replaced=["202203", "202204"], dropped=["202202"])
+    assert client.statements[1:] == [
+        "SELECT DISTINCT _partition_id FROM public.facts WHERE day >= '2022-02-20'",
+        "ALTER TABLE public.facts REPLACE PARTITION ID '202203' FROM public.facts_working",
+        "ALTER TABLE public.facts REPLACE PARTITION ID '202204' FROM public.facts_working",
+        "ALTER TABLE public.facts DROP PARTITION ID '202202'",
+    ]
+    assert [e.table_name for e in store.ledger.entries(tag="tombstone")] == [
+        "facts_working"
+    ]
+
+
+def test_refresh_partitions_from_model(data_stack):
+    (data_stack.directory / "models" / "m.sql").write_text(
+        '{{ refresh_partitions("day >= today() - 7") }}\n'
+        "select date('now') as day where {{ partition_filter() }}\n"
+    )
+    model = DataStack.from_dir(data_stack.directory).get_model("m")
+    assert model.refresh_partitions == "day >= today() - 7"
+    assert model.sql.endswith("where 1 = 1")
+    assert model.partial_sql.endswith("where (day >= today() - 7)")
+    # NOTE sqlite has no partitions, it's always a full refresh
+    model.load_data()
+    model.load_data()
+
+
+def test_partial_model_refresh_runs_the_model_once(data_stack):
+    client = FakeClient(
+        {
+            "select distinct partition_id from system.parts": [("20220301",)],
+            "SELECT * FROM (": ([], [("day", "Date"), ("n", "UInt64")]),
+            "select total_rows": [(10, 100)],
+            "select sum(total_bytes)": [(0,)],
+        }
+    )
+    store = _fake_store(data_stack, client)
+
+    store.create_or_replace_model(
+        "facts",
+        "public",
+        "select day, count() as n from events group by day",
+        table_engine=dict(partition_by="day"),
+        refresh_partitions="day >= '2022-03-01'",
+        partial_select="select day, count() as n from events where (day >= '2022-03-01') group by day",
+    )
+
+    (create,) = [s for s in client.statements if s.startswith("CREATE TABLE")]
+    working = create.split()[2].split(".")[1]
+    inserts = [s for s in client.statements if s.startswith(("INSERT", "ALTER"))]
+    assert inserts == [
+        f"INSERT INTO public.{working} SELECT * FROM (select day, count() as n from events"
+        " where (day >= '2022-03-01') group by day\n) WHERE day >= '2022-03-01'",
+        f"INSERT INTO public.{working} SELECT * FROM public.facts"
+        " WHERE _partition_id IN %(partition_ids)s AND NOT ifNull((day >= '2022-03-01'), 0)",
+        f"ALTER TABLE public.facts REPLACE PARTITION ID '20220301' FROM public.{working}",
+    ]
+
+
+def test_arrow_types():
+    pa = pytest.importorskip("pyarrow")
+    types = {
+        "Nullable(Int32)": pa.int32(),
+        "LowCardinality(Nullable(String))": pa.string(),
+        "UInt64": pa.uint64(),
+        "Decimal(10, 2)": pa.decimal128(10, 2),
+        "Decimal(76, 10)": pa.decimal256(76, 10),
+        "DateTime('UTC')": pa.timestamp("s"),
+        "DateTime64(3, 'UTC')": pa.timestamp("ms"),
+        "Date": pa.date32(),
+        "Array(String)": None,
+        "Int128": None,
+    }
+    assert {t: _clickhouse_type_to_arrow_type(pa, t) for t in types} == types
@@ -1,4 +1,19 @@
-from datetime import timedelta
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from libds.data_node import (
+    DataNode,
+    DataNodeState,
+    IsBackingOff,
+    PoolIsFull,
+    RetryPolicy,
+    TaskMeter,
+    trigger_refresh,
+)
+from libds.data_stack import DataStack
 from libds.utils import parse_timedelta
 
 
@@ -11,3 +26,247 @@ def test_parse_timedelta():
     assert parse_timedelta("86400s") == timedelta(days=1)
     assert parse_timedelta("86401s") == timedelta(seconds=86401)
     assert parse_timedelta("24h") == timedelta(days=1)
+
+
+def test_refresh_records_task_metrics(data_stack):
+    (data_stack.directory / "sources").mkdir(exist_ok=True)
+    (data_stack.directory / "sources" / "foo.yaml").write_text(
+        "type: libds.source.static.StaticTable\ndata: |\n  a b\n  1 2\n  3 4\n"
+    )
+    ds = DataStack.from_dir(data_stack.directory)
+    node, task = ds.data_orchestrator.refresh_node(
+        "public.foo_raw", info=dict(stdout=None, stderr=None)
+    )
+
+    metrics = task.info()["metrics"]
+    assert metrics["rows_read"] == 2
+    assert metrics["rows_written"] == 2
+    assert metrics["bytes_written"] > 0
+    assert metrics["wall_s"] > 0
+    # NOTE refreshed in this process, its peak rss isn't the task's
+    assert metrics["peak_rss"] is None
+    assert node.info()["last_task"]["metrics"] == metrics
+
+
+def test_task_meter_only_measures_the_task():
+    def spin():
+        started_at = time.perf_counter()
+        while time.perf_counter() - started_at < 0.3:
+            pass
+
+    thread = threading.Thread(target=spin)
+    with TaskMeter(isolated=True) as metrics:
+        thread.start()
+        thread.join()
+    assert metrics.wall_s >= 0.3
+    assert metrics.cpu_s < 0.1
+    assert metrics.peak_rss > 0
+
+
+def test_unchanged_output_keeps_downstream_fresh(data_stack):
+    (data_stack.directory / "sources").mkdir(exist_ok=True)
+    source = data_stack.directory / "sources" / "foo.yaml"
+    source.write_text("type: libds.source.static.StaticTable\ndata: |\n  a b\n  1 2\n")
+    (data_stack.directory / "models").mkdir(exist_ok=True)
+    (data_stack.directory / "models" / "bar.sql").write_text(
+        'select * from {{ depends_on("public.foo_raw") }}\n'
+    )
+
+    def refresh(nid):
+        ds = DataStack.from_dir(data_stack.directory)
+        node, task = ds.data_orchestrator.refresh_node(
+            nid, info=dict(stdout=None, stderr=None)
+        )
+        ds.data_orchestrator.load_node_states()
+        return ds.data_orchestrator.data_nodes, task.info()["info"]["result"]
+
+    nodes, result = refresh("public.foo_raw")
+    assert result["unchanged"] is False
+    assert result["fingerprint"]["num_rows"] == 1
+    nodes, result = refresh("public.bar")
+    assert nodes["public.bar"].state == DataNodeState.FRESH
+
+    nodes, result = refresh("public.foo_raw")
+    assert result["unchanged"] is True
+    assert nodes["public.bar"].state == DataNodeState.FRESH
+
+    source.write_text("type: libds.source.static.StaticTable\ndata: |\n  a b\n  1 3\n")
+    nodes, result = refresh("public.foo_raw")
+    assert result["unchanged"] is False
+    assert nodes["public.bar"].state == DataNodeState.STALE
+
+
+def test_unchanged_output_stops_the_cascade_where_it_is(data_stack):
+    source = data_stack.directory / "sources" / "a.yaml"
+    source.write_text("type: libds.source.static.StaticTable\ndata: |\n  x\n  1\n")
+    models = data_stack.directory / "models"
+    (models / "b.sql").write_text(
+        'select count(*) as n from {{ depends_on("public.a_raw") }}\n'
+    )
+    (models / "c.sql").write_text('select * from {{ depends_on("public.b") }}\n')
+    info = dict(stdout=None, stderr=None)
+
+    def refresh(nid):
+        orchestrator = DataStack.from_dir(data_stack.directory).data_orchestrator
+        orchestrator.refresh_node(nid, info=dict(info))
+        orchestrator.load_node_states()
+        return {n: node.state for n, node in orchestrator.data_nodes.items()}
+
+    for nid in ["public.a_raw", "public.b", "public.c"]:
+        refresh(nid)
+
+    # NOTE a changes, b (its row count) doesn't, so c stays fresh
+    source.write_text("type: libds.source.static.StaticTable\ndata: |\n  x\n  2\n")
+    states = refresh("public.a_raw")
+    assert states["public.b"] == DataNodeState.STALE
+    assert states["public.c"] == DataNodeState.FRESH
+    states = refresh("public.b")
+    assert states["public.c"] == DataNodeState.FRESH
+
+
+def test_only_a_completed_refresh_stales_downstream(data_stack):
+    source = data_stack.directory / "sources" / "foo.yaml"
+    source.write_text("type: libds.source.static.StaticTable\ndata: |\n  a\n  1\n")
+    (data_stack.directory / "models" / "bar.sql").write_text(
+        'select * from {{ depends_on("public.foo_raw") }}\n'
+    )
+    info = dict(stdout=None, stderr=None)
+
+    def states(orchestrator):
+        orchestrator.load_node_states()
+        return {nid: n.state for nid, n in orchestrator.data_nodes.items()}
+
+    orchestrator = DataStack.from_dir(data_stack.directory).data_orchestrator
+    orchestrator.refresh_node("public.foo_raw", info=dict(info))
+    orchestrator.refresh_node("public.bar", info=dict(info))
+
+    # NOTE a due node waits for its refresh to stale anything downstream
+    orchestrator.data_nodes["public.foo_raw"].stale_after = "0s"
+    states(orchestrator)
+    orchestrator.set_due_nodes_stale()
+    assert states(orchestrator) == {
+        "public.foo_raw": DataNodeState.STALE,
+        "public.bar": DataNodeState.FRESH,
+    }
+
+    source.write_text("type: libds.source.static.StaticTable\ndata: |\n  a\n  2\n")
+    orchestrator = DataStack.from_dir(data_stack.directory).data_orchestrator
+    orchestrator.refresh_node("public.foo_raw", info=dict(info))
+    assert states(orchestrator)["public.bar"] == DataNodeState.STALE
+
+    # NOTE asking for a refresh, eg after an edit, still cascades at once
+    orchestrator.refresh_node("public.bar", info=dict(info))
+    orchestrator.set_node_stale("public.foo_raw")
+    assert states(orchestrator)["public.bar"] == DataNodeState.STALE
+
+
+def test_ready_nodes_by_priority_and_critical_path(data_stack):
+    models = data_stack.directory / "models"
+    (models / "a.sql").write_text("{{ priority(10) }}\nselect 1 as x\n")
+    (models / "b.sql").write_text("select 1 as x\n")
+    (models / "c.sql").write_text('select * from {{ depends_on("public.b") }}\n')
+    (models / "d.sql").write_text('select * from {{ depends_on("public.c") }}\n')
+    (models / "e.sql").write_text("select 1 as x\n")
+    orchestrator = DataStack.from_dir(data_stack.directory).data_orchestrator
+
+    assert orchestrator.critical_paths()["public.b"] == 3
+    assert [n.id for n in orchestrator.ready_nodes()] == [
+        "public.a",
+        "public.b",
+        "public.e",
+    ]
+
+
+def test_critical_paths_of_a_deep_graph(data_stack):
+    orchestrator = DataStack.from_dir(data_stack.directory).data_orchestrator
+    orchestrator.data_nodes = {}
+    # NOTE a chain deeper than the recursion limit, and a diamond
+    nodes = [DataNode(id="n0", upstream=[])]
+    for i in range(1, 5000):
+        nodes.append(DataNode(id=f"n{i}", upstream=[f"n{i - 1}"]))
+    nodes.append(DataNode(id="side", upstream=["n0"]))
+    nodes.append(DataNode(id="end", upstream=["n4999", "side"]))
+    orchestrator.collect_nodes(nodes)
+    orchestrator.post_load_backpatch()
+
+    lengths = orchestrator.critical_paths()
+    assert lengths["n0"] == 5001
+    assert lengths["n4998"] == 3
+    assert lengths["side"] == 2
+    assert lengths["end"] == 1
+
+    orchestrator.data_nodes["n0"].upstream = [orchestrator.data_nodes["n10"]]
+    with pytest.raises(Exception, match="Dependency cycle"):
+        orchestrator.critical_paths()
+
+
+def test_pools_limit_concurrent_refreshes(data_stack):
+    (data_stack.directory / "data_stack.yaml").write_text(
+        "created_at: test\norchestrator:\n  pools:\n    replica: 2\n"
+    )
+    (data_stack.directory / "sources" / "s.yaml").write_text(
+        "type: libds.source.static.StaticTable\ndata: |\n  a\n  1\npool: replica\npriority: 5\n"
+    )
+    for name in ["m1", "m2"]:
+        (data_stack.directory / "models" / f"{name}.sql").write_text(
+            '{{ pool("replica") }}\nselect 1 as x\n'
+        )
+    (data_stack.directory / "models" / "other.sql").write_text("select 1 as x\n")
+    orchestrator = DataStack.from_dir(data_stack.directory).data_orchestrator
+
+    assert [n.id for n in orchestrator.ready_nodes()] == [
+        "public.s_raw",
+        "public.m1",
+        "public.other",
+    ]
+
+    orchestrator.claim_node("public.s_raw", "t1", {}, "a")
+    orchestrator.claim_node("public.m1", "t2", {}, "a")
+    with pytest.raises(PoolIsFull):
+        orchestrator.claim_node("public.m2", "t3", {}, "a")
+    orchestrator.load_node_states()
+    assert [n.id for n in orchestrator.ready_nodes()] == ["public.other"]
+    # NOTE a forced refresh doesn't wait for a slot
+    orchestrator.claim_node("public.m2", "t3", {}, "a", force=True)
+
+
+def test_failing_node_backs_off_then_fails(data_stack):
+    (data_stack.directory / "data_stack.yaml").write_text(
+        "created_at: test\norchestrator:\n  retry:\n    max_attempts: 2\n    backoff: 1h\n"
+    )
+    (data_stack.directory / "models" / "bad.sql").write_text(
+        '{{ retry(backoff="10s") }}\nselect * from missing\n'
+    )
+    orchestrator = DataStack.from_dir(data_stack.directory).data_orchestrator
+    node = orchestrator.data_nodes["public.bad"]
+
+    with pytest.raises(Exception):
+        trigger_refresh(orchestrator, node, {})
+    orchestrator.load_node_states()
+    assert node.state == DataNodeState.STALE
+    assert (
+        4
+        < (datetime.fromisoformat(node.retry_after) - datetime.utcnow()).total_seconds()
+        <= 10
+    )
+    assert orchestrator.ready_nodes() == []
+    with pytest.raises(IsBackingOff):
+        orchestrator.claim_node("public.bad", "t1", {}, "a")
+
+    # NOTE skip the wait
+    with orchestrator.cursor() as cur:
+        cur.execute("update data_nodes set retry_after = null")
+    with pytest.raises(Exception):
+        trigger_refresh(orchestrator, node, {})
+    orchestrator.load_node_states()
+    assert node.state == DataNodeState.FAILED
+    assert orchestrator.ready_nodes() == []
+
+    orchestrator.set_node_stale("public.bad")
+    orchestrator.load_node_states()
+    assert node.state == DataNodeState.STALE
+    assert node.retry_after is None
+    assert [n.id for n in orchestrator.ready_nodes()] == ["public.bad"]
+
+    with pytest.raises(ValueError):
+        RetryPolicy.from_config(dict(attempts=3))
@@ -0,0 +1,76 @@
+import csv
+
+import pytest
+
+from libds.utils import DoesNotExist
+
+
+@pytest.fixture()
+def numbers(data_stack):
+    data_stack.store.create_or_replace_model(
+        "public",
+        "numbers",
+        "with recursive n(i) as (select 1 union all select i + 1 from n where i < 250) select i, 'n' || i as name, i * 0.5 as half from n",
+    )
+    return data_stack
+
+
+def test_export_csv(numbers, tmp_path):
+    result = numbers.export_table(
+        "numbers", "csv", tmp_path / "numbers.csv", row_group_size=100
+    )
+    assert (result["num_rows"], result["num_row_groups"]) == (250, 3)
+    with (tmp_path / "numbers.csv").open() as file:
+        rows = list(csv.reader(file))
+    assert rows[0] == ["i", "name", "half"]
+    assert rows[-1] == ["250", "n250", "125.0"]
+
+    with pytest.raises(DoesNotExist):
+        numbers.export_table("nope", "csv", tmp_path / "nope.csv")
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_export_columnar(numbers, tmp_path, format):
+    pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    out = tmp_path / f"numbers.{format}"
+    numbers.export_table("numbers", format, out, row_group_size=100)
+    if format == "parquet":
+        assert pyarrow.parquet.ParquetFile(out).num_row_groups == 3
+        table = pyarrow.parquet.read_table(out)
+    else:
+        reader = pyarrow.ipc.open_file(out)
+        assert reader.num_record_batches == 3
+        table = reader.read_all()
+    assert table.num_rows == 250
+    assert table.column_names == ["i", "name", "half"]
+    assert table.slice(249).to_pylist() == [dict(i=250, name="n250", half=125.0)]
+
+
+def test_export_types_from_the_store(data_stack, tmp_path):
+    pytest.importorskip("pyarrow")
+    import pyarrow
+    import pyarrow.parquet
+
+    # NOTE the first row group has no value for late, ints for num and
+    # only text in mixed
+    data_stack.store.create_or_replace_model(
+        "public",
+        "changing",
+        "with recursive n(i) as (select 1 union all select i + 1 from n where i < 20)"
+        " select i, case when i > 10 then 'x' || i end as late,"
+        " case when i > 10 then i * 0.5 else i end as num,"
+        " case when i > 10 then i else 'm' || i end as mixed from n",
+    )
+    out = tmp_path / "changing.parquet"
+    data_stack.export_table("changing", "parquet", out, row_group_size=10)
+    table = pyarrow.parquet.read_table(out)
+    assert table.schema.types == [
+        pyarrow.int64(),
+        pyarrow.string(),
+        pyarrow.float64(),
+        pyarrow.string(),
+    ]
+    assert table.slice(19).to_pylist() == [dict(i=20, late="x20", num=10.0, mixed="20")]
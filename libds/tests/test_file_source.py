@@ -0,0 +1,108 @@
+import tracemalloc
+
+import pytest
+
+from libds.data_stack import DataStack
+from libds.model import data_type
+from libds.source.file import read_chunks, read_lines
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_read_lines_across_chunks(tmp_path, use_mmap):
+    path = tmp_path / "t.csv"
+    path.write_bytes('a,b\r\n"x\ny",\xc3\xa9t\xc3\xa9\r\n\x0c,3'.encode("latin-1"))
+    lines = list(read_lines(read_chunks(path, chunk_size=3, use_mmap=use_mmap)))
+    assert lines == ["a,b\r\n", '"x\n', 'y",été\r\n', "\x0c,3"]
+
+
+def _source(data_stack, yaml):
+    (data_stack.directory / "sources").mkdir(exist_ok=True)
+    (data_stack.directory / "sources" / "people.yaml").write_text(
+        "type: libds.source.file.CSVFile\n" + yaml
+    )
+    return DataStack.from_dir(data_stack.directory)
+
+
+def test_csv_file_is_unpacked_with_inferred_types(data_stack):
+    (data_stack.directory / "people.tsv").write_text(
+        "Name\tAge\tZip Code\tScore\n"
+        'ann\t31\t01234\t1.5\n"bob\tthe builder"\t\t90210\t2\n'
+    )
+    ds = _source(data_stack, "path: people.tsv\nchunk_size: 5\nmmap: true\n")
+    source = ds.get_source("people")
+    columns = dict(source.infer_columns())
+    assert columns["name"] == data_type.Text(is_nullable=True)
+    assert columns["age"] == data_type.Integer(is_nullable=True, width=64)
+    assert isinstance(columns["zip_code"], data_type.Text)
+    assert isinstance(columns["score"], data_type.Float)
+
+    node, task = ds.data_orchestrator.refresh_node(
+        "public.people_raw", info=dict(stdout=None, stderr=None)
+    )
+    rows = list(
+        ds.store.execute_sql(
+            "select name, age, zip_code, score from people_raw order by name"
+        )
+    )
+    assert rows == [
+        dict(name="ann", age=31, zip_code="01234", score=1.5),
+        dict(name="bob\tthe builder", age=None, zip_code="90210", score=2.0),
+    ]
+    assert task.info()["info"]["result"]["fingerprint"]["num_rows"] == 2
+
+
+def test_csv_file_loads_in_constant_memory(data_stack):
+    with (data_stack.directory / "big.csv").open("w") as file:
+        file.write("id,name,amount\n")
+        for i in range(50_000):
+            file.write(f"{i},name {i},{i * 0.25}\n")
+    ds = _source(data_stack, "path: big.csv\nchunk_size: 65536\n")
+    # NOTE sqlalchemy is imported on first use, that's not the loader's memory
+    ds.store.list_tables("public")
+
+    tracemalloc.start()
+    ds.data_orchestrator.refresh_node(
+        "public.people_raw", info=dict(stdout=None, stderr=None)
+    )
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert list(ds.store.execute_sql("select count(*) as n from people_raw")) == [
+        dict(n=50_000)
+    ]
+    # NOTE the file is ~1MB, its rows as python objects would be ~30MB
+    assert peak < 4 * 1024 * 1024
+
+
+def test_blank_past_the_sample_loads(data_stack):
+    (data_stack.directory / "people.csv").write_text("id,score\n1,1.5\n2,2.5\n,\n")
+    ds = _source(data_stack, "path: people.csv\nsample_rows: 2\n")
+    columns = dict(ds.get_source("people").infer_columns())
+    assert columns["id"] == data_type.Integer(is_nullable=True, width=64)
+    assert columns["score"] == data_type.Float(is_nullable=True, width=64)
+
+    ds.data_orchestrator.refresh_node(
+        "public.people_raw", info=dict(stdout=None, stderr=None)
+    )
+    rows = list(ds.store.execute_sql("select id, score from people_raw order by id"))
+    assert rows == [
+        dict(id=None, score=None),
+        dict(id=1, score=1.5),
+        dict(id=2, score=2.5),
+    ]
+
+
+def test_csv_columns_are_distinct_and_blank_ones_text(data_stack):
+    (data_stack.directory / "people.csv").write_text("a b,a-b,note\n1,2,\n3,4,\n")
+    ds = _source(data_stack, "path: people.csv\n")
+    assert ds.get_source("people").infer_columns() == [
+        ["a_b", data_type.Integer(is_nullable=True, width=64)],
+        ["a_b_", data_type.Integer(is_nullable=True, width=64)],
+        ["note", data_type.Text(is_nullable=True)],
+    ]
+
+    ds.data_orchestrator.refresh_node(
+        "public.people_raw", info=dict(stdout=None, stderr=None)
+    )
+    rows = list(ds.store.execute_sql("select a_b, a_b_, note from people_raw"))
+    assert rows == [dict(a_b=1, a_b_=2, note=None), dict(a_b=3, a_b_=4, note=None)]
@@ -0,0 +1,111 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from googleapiclient.discovery_cache import get_static_doc
+
+from libds.data_node import DataNodeState
+from libds.data_stack import DataStack
+
+
+class StubSheets(BaseHTTPRequestHandler):
+    values = {}
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.requests.append(url.path)
+        if url.path == "/$discovery/rest":
+            body = get_static_doc("sheets", "v4")
+        else:
+            ranges = parse_qs(url.query)["ranges"]
+            body = json.dumps(
+                dict(valueRanges=[dict(range=r, values=self.values[r]) for r in ranges])
+            )
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def stub_sheets():
+    server = HTTPServer(("127.0.0.1", 0), StubSheets)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+
+
+def test_unchanged_sheet_keeps_downstream_fresh(data_stack, stub_sheets):
+    StubSheets.values = {"A1:B3": [["a", "b"], [1, 2], [3, 4]], "D1:D2": [["c"], [5]]}
+    (data_stack.directory / "sources").mkdir(exist_ok=True)
+    (data_stack.directory / "sources" / "sheet.yaml").write_text(
+        "type: libds.source.google.GoogleSheet\n"
+        "spreadsheet: stub\n"
+        "range: [A1:B3, D1:D2]\n"
+        "header_row: true\n"
+        "target_table: sheet\n"
+        f"api_endpoint: {stub_sheets}\n"
+    )
+    (data_stack.directory / "models").mkdir(exist_ok=True)
+    (data_stack.directory / "models" / "bar.sql").write_text(
+        'select * from {{ depends_on("public.sheet_raw") }}\n'
+    )
+
+    def refresh(nid):
+        ds = DataStack.from_dir(data_stack.directory)
+        node, task = ds.data_orchestrator.refresh_node(
+            nid, info=dict(stdout=None, stderr=None)
+        )
+        ds.data_orchestrator.load_node_states()
+        return ds, task.info()["info"]["result"] if nid == "public.sheet_raw" else None
+
+    ds, result = refresh("public.sheet_raw")
+    assert result["unchanged"] is False
+    assert len(list(ds.store.execute_sql("select * from sheet_raw"))) == 3
+    refresh("public.bar")
+
+    ds, result = refresh("public.sheet_raw")
+    assert result["unchanged"] is True
+    assert ds.data_orchestrator.data_nodes["public.bar"].state == DataNodeState.FRESH
+    assert len(list(ds.store.execute_sql("select * from sheet_raw"))) == 3
+
+    StubSheets.values["D1:D2"] = [["c"], [6]]
+    ds, result = refresh("public.sheet_raw")
+    assert result["unchanged"] is False
+    assert ds.data_orchestrator.data_nodes["public.bar"].state == DataNodeState.STALE
+
+    assert StubSheets.requests.count("/$discovery/rest") == 1
+
+
+def test_typified_sheet(data_stack, stub_sheets):
+    StubSheets.values = {"A1:B3": [["a", "b"], [1, "x"], [3, "y"]]}
+    (data_stack.directory / "sources" / "sheet.yaml").write_text(
+        "type: libds.source.google.GoogleSheet\n"
+        "spreadsheet: stub\n"
+        "range: A1:B3\n"
+        "header_row: true\n"
+        "target_table: sheet\n"
+        "typify: true\n"
+        f"api_endpoint: {stub_sheets}\n"
+    )
+    ds = DataStack.from_dir(data_stack.directory)
+    assert sorted(ds.data_orchestrator.data_nodes) == [
+        "public.sheet",
+        "public.sheet_raw",
+    ]
+    for nid in ["public.sheet_raw", "public.sheet_raw", "public.sheet"]:
+        node, task = ds.data_orchestrator.refresh_node(
+            nid, info=dict(stdout=None, stderr=None)
+        )
+        assert task.state == "DONE"
+    assert list(ds.store.execute_sql("select a, b from sheet order by a")) == [
+        dict(a=1, b="x"),
+        dict(a=3, b="y"),
+    ]
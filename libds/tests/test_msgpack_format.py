@@ -0,0 +1,50 @@
+import datetime
+import io
+from decimal import Decimal
+
+import msgpack
+
+from libds import msgpack_format
+from libds.msgpack_format import (
+    EXT_DATETIME,
+    EXT_DECIMAL,
+    EXT_STREAM,
+    StreamingPacker,
+)
+
+
+def _frames(result):
+    out = io.BytesIO()
+    StreamingPacker(out).dump(result)
+    return list(msgpack.Unpacker(io.BytesIO(out.getvalue()), raw=False))
+
+
+def test_streams_follow_the_response(monkeypatch):
+    monkeypatch.setattr(msgpack_format, "STREAM_CHUNK_SIZE", 2)
+    when = datetime.datetime(2021, 6, 1, 12, 30)
+    rows = ({"i": i, "at": when, "amount": Decimal("1.10")} for i in range(3))
+    frames = _frames({"data": {"rows": rows, "tags": (t for t in "ab")}})
+
+    assert frames[0] == {
+        "data": {
+            "rows": msgpack.ExtType(EXT_STREAM, b"0"),
+            "tags": msgpack.ExtType(EXT_STREAM, b"1"),
+        }
+    }
+    assert [len(f) for f in frames[1:]] == [2, 1, 0, 2, 0]
+    assert frames[1][0]["at"] == msgpack.ExtType(
+        EXT_DATETIME, when.isoformat().encode()
+    )
+    assert frames[1][0]["amount"] == msgpack.ExtType(EXT_DECIMAL, b"1.10")
+    assert frames[4] == ["a", "b"]
+
+
+def test_error_mid_stream():
+    def rows():
+        yield [1]
+        raise RuntimeError("connection lost")
+
+    frames = _frames({"data": {"rows": rows()}})
+    assert frames[1] == [[1]]
+    assert frames[2]["error"]["code"] == "RuntimeError"
+    assert len(frames) == 3
@@ -0,0 +1,34 @@
+from datetime import datetime
+from random import Random
+
+from libds.source import Record
+from libds.store.preview import Reservoir
+
+
+def test_reservoir():
+    reservoir = Reservoir(size=10, random=Random(0))
+    for i in range(1000):
+        reservoir.add(i)
+    assert reservoir.count == 1000
+    assert len(reservoir.rows) == 10
+    assert len(set(reservoir.rows)) == 10
+    assert max(reservoir.rows) >= 10
+
+
+def test_preview_is_captured_on_load(data_stack):
+    store = data_stack.store
+    records = (
+        Record(data=dict(i=i), extracted_at=datetime.utcnow()) for i in range(100)
+    )
+    res = store.load_raw_from_records("public", "t_raw", records)
+    assert res["count"] == 100
+    assert len(res["rows"]) == 23
+
+    preview = store.ledger.load_preview("public", "t_raw")
+    assert preview["num_rows"] == 100
+    assert store.preview("public", "t_raw", limit=5) == preview["rows"][:5]
+
+    assert len(store.preview("public", "t_raw", limit=5, order_by="random")) == 5
+    assert store.preview("public", "t_raw", limit=1, order_by="old")[0]["data"] == (
+        '{"i": 0}'
+    )
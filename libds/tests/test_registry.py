@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+import pytest
+
+from libds.registry import STORES_GROUP, Registry, UnknownType
+
+
+def test_resolve_builtin_and_installed(monkeypatch):
+    registry = Registry(
+        STORES_GROUP, {"libds.store.sqlite.SQLite": "libds.store.sqlite:SQLite"}
+    )
+    monkeypatch.setattr(
+        registry, "_installed", {"acme.Parquet": "libds.store.preview:Reservoir"}
+    )
+
+    from libds.store.preview import Reservoir
+    from libds.store.sqlite import SQLite
+
+    assert registry.resolve("libds.store.sqlite.SQLite") is SQLite
+    assert registry.resolve("acme.Parquet") is Reservoir
+    with pytest.raises(UnknownType):
+        registry.resolve("acme.DuckDB")
+
+    types = [c["type"] for c in registry.connectors()]
+    assert types == ["acme.Parquet", "libds.store.sqlite.SQLite"]
+
+
+def test_listing_connectors_imports_no_drivers():
+    code = "\n".join(
+        [
+            "import sys",
+            "from libds.registry import connectors",
+            "connectors()",
+            "print(','.join(m for m in ['sqlalchemy', 'clickhouse_driver', 'googleapiclient', 'MySQLdb'] if m in sys.modules))",
+        ]
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", code], stdout=subprocess.PIPE, text=True, check=True
+    )
+    assert proc.stdout.strip() == ""
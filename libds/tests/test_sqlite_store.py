@@ -0,0 +1,100 @@
+import sqlite3
+import threading
+
+from libds.data_stack import DataStack
+from libds.model import data_type
+from libds.source import Record
+from libds.store.sqlite import INSERT_BATCH_SIZE
+
+
+def test_swap_in_never_hides_the_table(data_stack):
+    store = data_stack.store
+    store.create_or_replace_model("public", "t", "select 1 as a")
+
+    stop = threading.Event()
+    queries = []
+    errors = []
+
+    def read():
+        conn = sqlite3.connect(data_stack.directory / "stores" / "store.sqlite3")
+        while not stop.is_set():
+            try:
+                queries.append(conn.execute("select count(*) from t").fetchone())
+            except sqlite3.OperationalError as oe:
+                errors.append(str(oe))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for i in range(20):
+        store.create_or_replace_model("public", "t", f"select {i} as a")
+    stop.set()
+    reader.join()
+
+    assert errors == []
+    assert len(queries) > 0
+    assert store.ledger.entries(tag="working") == []
+
+
+def test_pragmas_from_store_yaml(data_stack):
+    (data_stack.directory / "stores" / "store.yaml").write_text(
+        "type: libds.store.sqlite.SQLite\npath: ./store.sqlite3\n"
+        "journal_mode: WAL\nsynchronous: off\ncache_size: -4096\nmmap_size: 1048576\n"
+    )
+    store = DataStack.from_dir(data_stack.directory).store
+    with store.engine.connect() as conn:
+        assert conn.execute("pragma journal_mode").scalar() == "wal"
+        assert conn.execute("pragma synchronous").scalar() == 0
+        assert conn.execute("pragma cache_size").scalar() == -4096
+        assert conn.execute("pragma mmap_size").scalar() == 1048576
+
+
+def test_model_indexes_and_json_columns(data_stack):
+    (data_stack.directory / "models").mkdir(exist_ok=True)
+    (data_stack.directory / "models" / "people.sql").write_text(
+        '{{ json_column("age", type="INTEGER") }}\n'
+        '{{ json_column("city", "$.address.city") }}\n'
+        '{{ index("city", "age") }}\n'
+        "select json_object('age', 31, 'address', json_object('city', 'Rome')) as data\n"
+    )
+    ds = DataStack.from_dir(data_stack.directory)
+    ds.get_model("people").load_data()
+
+    assert list(ds.store.execute_sql("select age, city from people")) == [
+        dict(age=31, city="Rome")
+    ]
+    plan = list(
+        ds.store.execute_sql(
+            "explain query plan select * from people where city = 'Rome' and age > 3"
+        )
+    )
+    assert "USING INDEX" in plan[0]["detail"]
+
+
+def test_streamed_fingerprint_matches_the_table(data_stack):
+    store = data_stack.store
+    # NOTE more than a batch of them, and some with their own json
+    num_rows = INSERT_BATCH_SIZE + 5
+    records = [Record(data=dict(a=i, b=f"x{i}")) for i in range(num_rows - 1)]
+    records.append(Record(data_str='{"a": -1}'))
+    store.load_raw_from_records("public", "r_raw", iter(records))
+    streamed = store.fingerprint("public", "r_raw", columns=["data"])
+    assert streamed == store.fingerprint("public", "r_raw", columns=["data"])
+    assert streamed["num_rows"] == num_rows
+    rows = store.execute_sql("select data from r_raw where data like '%-1%'")
+    assert list(rows) == [dict(data='{"a": -1}')]
+
+    columns = [("a", data_type.Integer(width=64)), ("b", data_type.Float(width=64))]
+    records = [Record(data=dict(a=i, b=i / 4)) for i in range(5)]
+    store.load_unpacked_from_records("public", "u_raw", columns, iter(records))
+    streamed = store.fingerprint("public", "u_raw", columns=["a", "b"])
+    assert streamed == store.fingerprint("public", "u_raw", columns=["a", "b"])
+
+    store.create_or_replace_model("public", "m", "select a, b from u_raw")
+    assert store.fingerprint("public", "m") == streamed
+
+
+def test_table_exists(data_stack):
+    store = data_stack.store
+    store.create_or_replace_model("public", "t", "select 1 as x")
+    assert store.table_exists("public", "t")
+    assert not store.table_exists("public", "nope")
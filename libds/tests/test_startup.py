@@ -0,0 +1,44 @@
+import subprocess
+import sys
+
+import pytest
+
+from libds.cli import parse_importtime
+
+HEAVY_MODULES = [
+    "arrow",
+    "clickhouse_driver",
+    "googleapiclient",
+    "jinja2",
+    "MySQLdb",
+    "psutil",
+    "pygit2",
+    "ruamel.yaml",
+    "setproctitle",
+    "sqlalchemy",
+]
+
+# NOTE about three times what these commands take today, this is here to catch
+# a heavy import sneaking back in at module level, not to benchmark the machine.
+IMPORT_BUDGET_US = 150_000
+
+
+@pytest.mark.parametrize("args", [["version"], ["help"], ["trace"]])
+def test_lightweight_commands_import_budget(tmp_path, args):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "libds.cli", "-d", str(tmp_path)]
+        + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    modules = parse_importtime(proc.stderr)
+    names = {m["module"] for m in modules}
+    assert [m for m in HEAVY_MODULES if m in names] == []
+
+    # NOTE site (and whatever .pth files it runs) is the interpreter's, not ours
+    site_us = sum(
+        m["cumulative_us"] for m in modules if m["module"] == "site" and m["depth"] == 0
+    )
+    assert sum(m["self_us"] for m in modules) - site_us < IMPORT_BUDGET_US
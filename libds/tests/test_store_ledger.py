@@ -0,0 +1,60 @@
+import sqlite3
+import time
+from datetime import timedelta
+
+from libds.data_stack import DataStack
+from libds.store.ledger import TableLedger
+
+
+def test_ledger_entries(tmp_path):
+    ledger = TableLedger(tmp_path / "ledger.sqlite3", "store")
+    ledger.record("public", "t_working_1", "t", "working")
+    ledger.record("public", "t_tombstone_1", "t", "tombstone")
+    ledger.record("public", "u_tombstone_1", "u", "tombstone")
+
+    tombstones = ledger.entries(final_name="t", tag="tombstone")
+    assert [e.table_name for e in tombstones] == ["t_tombstone_1"]
+    assert ledger.entries(older_than=timedelta(hours=1)) == []
+
+    ledger.forget("public", ["t_working_1", "t_tombstone_1"])
+    assert [e.table_name for e in ledger.entries()] == ["u_tombstone_1"]
+    assert TableLedger(tmp_path / "ledger.sqlite3", "other").entries() == []
+
+
+def test_ledger_from_before_tids(tmp_path):
+    path = tmp_path / "ledger.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "create table tables (store text, schema_name text, table_name text,"
+        " final_name text, tag text, created_at real,"
+        " primary key (store, schema_name, table_name))"
+    )
+    conn.execute("insert into tables values ('s', 'public', 't_w', 't', 'working', 0)")
+    conn.commit()
+    conn.close()
+
+    ledger = TableLedger(path, "s")
+    ledger.record("public", "u_w", "u", "working", "t1")
+    assert [(e.table_name, e.tid) for e in ledger.entries()] == [
+        ("t_w", None),
+        ("u_w", "t1"),
+    ]
+
+
+def test_cleanup_keeps_working_tables_of_running_tasks(data_stack):
+    (data_stack.directory / "models" / "m.sql").write_text("select 1 as x\n")
+    ds = DataStack.from_dir(data_stack.directory)
+    orchestrator = ds.data_orchestrator
+    orchestrator.lease_s = 0.1
+    orchestrator.claim_node("public.m", "t1", {}, "a")
+    ds.store.ledger.record("public", "m_working_1", "m", "working", "t1")
+    ds.store.ledger.record("public", "m_working_2", "m", "working")
+
+    # NOTE however old, a running task's working table is still in use
+    res = ds.store.cleanup_tables(max_age=timedelta(0))
+    assert res["tables_dropped"]["working"] == ["m_working_2"]
+
+    time.sleep(0.3)
+    assert orchestrator.reap_zombies() == ["public.m"]
+    res = ds.store.cleanup_tables()
+    assert res["tables_dropped"]["working"] == ["m_working_1"]
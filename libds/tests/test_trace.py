@@ -0,0 +1,36 @@
+from libds.trace import Tracer, read_spans, summarize_trace
+
+
+def test_spans_nest_and_summarize(tmp_path, monkeypatch):
+    monkeypatch.setenv("DS_TRACE_PARENT_ID", "from-be")
+    tracer = Tracer().configure(tmp_path, trace_id="t1")
+    with tracer.span("ds info"):
+        with tracer.span("DataStack.load"):
+            with tracer.span("store.execute", statement="select 1"):
+                pass
+        with tracer.span("store.execute", statement="select 2"):
+            pass
+
+    spans = read_spans(tmp_path / "traces.jsonl")
+    assert len(spans) == 4
+    root = [s for s in spans if s["name"] == "ds info"][0]
+    assert root["parent_id"] == "from-be"
+
+    summary = summarize_trace(spans, "t1")
+    stacks = {b["stack"]: b for b in summary["breakdown"]}
+    assert set(stacks) == {
+        "ds info",
+        "ds info;DataStack.load",
+        "ds info;DataStack.load;store.execute",
+        "ds info;store.execute",
+    }
+    assert stacks["ds info"]["total_s"] >= stacks["ds info;DataStack.load"]["total_s"]
+    assert len(summary["folded"]) == 4
+
+
+def test_disabled_tracer_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.delenv("DS_TRACE_ID", raising=False)
+    tracer = Tracer().configure(tmp_path)
+    with tracer.span("ds info") as span:
+        assert span is None
+    assert not (tmp_path / "traces.jsonl").exists()
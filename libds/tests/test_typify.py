@@ -0,0 +1,83 @@
+from datetime import datetime
+
+from libds.data_stack import DataStack
+from libds.model import data_type
+from libds.source import Record
+from libds.typify import infer_columns, typify
+
+
+def test_infer_columns():
+    columns = infer_columns(
+        [
+            {
+                "id": 1,
+                "Price ($)": 1.5,
+                "ok": True,
+                "zip": "01234",
+                "n": "7",
+                "tags": ["a"],
+            },
+            {
+                "id": 2,
+                "Price ($)": 2,
+                "ok": False,
+                "zip": "90210",
+                "n": "-8",
+                "extra": None,
+            },
+        ]
+    )
+    types = {c.name: (type(c.type), c.from_string) for c in columns}
+    assert types == {
+        "id": (data_type.Integer, False),
+        "price": (data_type.Float, False),
+        "ok": (data_type.Integer, False),
+        "zip": (data_type.Text, False),
+        "n": (data_type.Integer, True),
+        "tags": (data_type.Text, False),
+        "extra": (data_type.Text, False),
+    }
+
+
+def test_typify_raw_json(data_stack):
+    store = data_stack.store
+    records = [
+        Record(
+            data={"id": 1, "name": "a", "score": "1.5", "meta": {"k": 1}},
+            extracted_at=datetime.utcnow(),
+        ),
+        Record(data={"id": 2, "score": "2"}, extracted_at=datetime.utcnow()),
+    ]
+    store.load_raw_from_records("public", "things_raw", records)
+
+    result = typify(store, "public", "things_raw", "things")
+    assert [c["type"] for c in result["columns"]] == [
+        "Integer",
+        "Text",
+        "Float",
+        "Text",
+    ]
+    rows = list(
+        store.execute_sql("select id, name, score, meta from things order by id")
+    )
+    assert rows == [
+        dict(id=1, name="a", score=1.5, meta='{"k":1}'),
+        dict(id=2, name=None, score=2.0, meta=None),
+    ]
+
+
+def test_typified_source_is_a_downstream_node(data_stack):
+    (data_stack.directory / "sources").mkdir(exist_ok=True)
+    (data_stack.directory / "sources" / "foo.yaml").write_text(
+        "type: libds.source.static.StaticTable\ntypify: true\ndata: |\n  a b\n  1 x\n  3 y\n"
+    )
+    ds = DataStack.from_dir(data_stack.directory)
+    nodes = ds.data_orchestrator.data_nodes
+    assert [n.id for n in nodes["public.foo"].upstream_nodes()] == ["public.foo_raw"]
+
+    for nid in ["public.foo_raw", "public.foo"]:
+        ds.data_orchestrator.refresh_node(nid, info=dict(stdout=None, stderr=None))
+    assert list(ds.store.execute_sql("select a, b from foo order by a")) == [
+        dict(a=1, b="x"),
+        dict(a=3, b="y"),
+    ]
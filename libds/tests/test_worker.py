@@ -0,0 +1,185 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from libds.data_node import DataNodeState, IsNotStale, TaskHeartbeat
+from libds.data_stack import DataStack
+from libds.state_db import state_db
+from libds.worker import Worker
+
+
+def _data_stack(data_stack, orchestrator=""):
+    (data_stack.directory / "data_stack.yaml").write_text(
+        "created_at: test\n" + orchestrator
+    )
+    (data_stack.directory / "sources" / "s.yaml").write_text(
+        "type: libds.source.static.StaticTable\ndata: |\n  id value\n  1 a\n"
+    )
+    for i in range(6):
+        (data_stack.directory / "models" / f"m{i}.sql").write_text(
+            'select * from {{ depends_on("public.s_raw") }}\n'
+        )
+    (data_stack.directory / "models" / "top.sql").write_text(
+        'select * from {{ depends_on("public.m0", "public.m5") }}\n'
+    )
+    return DataStack.from_dir(data_stack.directory)
+
+
+def _run_workers(directory, num_workers):
+    workers = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "libds.cli",
+                "-d",
+                str(directory),
+                "worker",
+                "--exit-when-idle",
+                "--poll-interval=0.1",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        for _ in range(num_workers)
+    ]
+    assert [w.wait(timeout=120) for w in workers] == [0] * num_workers
+
+
+def _check_each_node_refreshed_once(ds):
+    orchestrator = ds.data_orchestrator
+    orchestrator.load_node_states()
+    assert {n.id: n.state for n in orchestrator.data_nodes.values()} == {
+        nid: DataNodeState.FRESH for nid in orchestrator.data_nodes
+    }
+    tasks = orchestrator.tasks()
+    assert sorted(t.nid for t in tasks) == sorted(orchestrator.data_nodes)
+    assert set(t.state for t in tasks) == {"DONE"}
+
+
+def test_workers_never_double_run(data_stack):
+    ds = _data_stack(data_stack)
+    _run_workers(ds.directory, 4)
+    _check_each_node_refreshed_once(ds)
+
+
+needs_postgres = pytest.mark.skipif(
+    "DS_TEST_POSTGRES_DSN" not in os.environ,
+    reason="needs a postgres, set DS_TEST_POSTGRES_DSN",
+)
+
+
+@needs_postgres
+def test_workers_on_postgres(data_stack):
+    import psycopg2
+
+    with psycopg2.connect(
+        os.environ["DS_TEST_POSTGRES_DSN"]
+    ) as conn, conn.cursor() as cur:
+        cur.execute("drop table if exists data_nodes, tasks, settings")
+    ds = _data_stack(
+        data_stack, "orchestrator:\n  type: postgres\n  dsn_var: DS_TEST_POSTGRES_DSN\n"
+    )
+    _run_workers(ds.directory, 4)
+    _check_each_node_refreshed_once(ds)
+
+
+@needs_postgres
+def test_a_newer_postgres_schema_is_left_alone(data_stack):
+    import psycopg2
+
+    dsn = os.environ["DS_TEST_POSTGRES_DSN"]
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        cur.execute("drop table if exists data_nodes, tasks, settings")
+        cur.execute("create table settings (key text primary key, value text)")
+        cur.execute("insert into settings (key, value) values ('version', '99')")
+    ds = _data_stack(
+        data_stack, "orchestrator:\n  type: postgres\n  dsn_var: DS_TEST_POSTGRES_DSN\n"
+    )
+    with pytest.raises(Exception, match="Version 99 in orchestrator db"):
+        state_db(ds).connect()
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        cur.execute("select value from settings where key = 'version'")
+        assert cur.fetchone() == ("99",)
+        cur.execute("drop table settings")
+
+
+def test_leases(data_stack):
+    orchestrator = _data_stack(data_stack).data_orchestrator
+    orchestrator.lease_s = 0.3
+
+    orchestrator.claim_node("public.m0", "t1", {}, "a")
+    with pytest.raises(IsNotStale):
+        orchestrator.claim_node("public.m0", "t2", {}, "b")
+
+    with TaskHeartbeat(orchestrator, "public.m0", "t1"):
+        time.sleep(0.6)
+        assert orchestrator.reap_zombies() == []
+    time.sleep(0.4)
+    assert orchestrator.reap_zombies() == ["public.m0"]
+    assert orchestrator.load_task("t1").state == "ZOMBIE"
+
+    orchestrator.claim_node("public.m0", "t3", {}, "b")
+    assert orchestrator.heartbeat("public.m0", "t1") is False
+
+
+def test_reap_tasks_without_heartbeat(data_stack):
+    orchestrator = _data_stack(data_stack).data_orchestrator
+    orchestrator.lease_s = 0.3
+
+    # NOTE a forced refresh takes the node from t1, which keeps running
+    orchestrator.claim_node("public.m0", "t1", {}, "a")
+    orchestrator.claim_node("public.m0", "t2", {}, "b", force=True)
+    with TaskHeartbeat(orchestrator, "public.m0", "t2") as heartbeat:
+        time.sleep(0.6)
+        assert orchestrator.reap_zombies() == []
+    assert not heartbeat.lost
+    assert orchestrator.load_task("t1").state == "ZOMBIE"
+    assert orchestrator.load_task("t2").state == "RUNNING"
+    assert (
+        orchestrator.load_task("t2").heartbeat_at
+        > orchestrator.load_task("t2").started_at
+    )
+
+
+def test_worker_survives_a_crashing_refresh(data_stack):
+    ds = _data_stack(data_stack)
+    (ds.directory / "models" / "crash.py").write_text(
+        "import os\n\n\ndef model(data_stack):\n    os._exit(3)\n"
+    )
+    result = Worker(ds.directory, poll_interval=0.1, exit_when_idle=True).run()
+
+    assert result["failed"] == ["public.crash"]
+    orchestrator = DataStack.from_dir(ds.directory).data_orchestrator
+    tasks = {t.nid: t for t in orchestrator.tasks()}
+    assert tasks["public.crash"].state == "ERRORED"
+    assert tasks["public.crash"]._info["error"] == "refresh process exited with 3"
+    assert orchestrator.data_nodes["public.crash"].state == DataNodeState.STALE
+    # NOTE every task ran in a process of its own
+    assert all(t.metrics.peak_rss > 0 for t in tasks.values() if t.state == "DONE")
+    assert len(tasks) == 9
+
+
+def test_worker_children_finish_their_cleanup(data_stack, monkeypatch):
+    from libds.store.sqlite import SQLite
+
+    ds = _data_stack(data_stack)
+    cleaned = ds.directory / "cleaned"
+    cleanup_tables = SQLite.cleanup_tables
+
+    def slow_cleanup_tables(self, schema_name, table_name):
+        time.sleep(0.2)
+        res = cleanup_tables(self, schema_name, table_name)
+        with cleaned.open("a") as file:
+            file.write(f"{schema_name}.{table_name}\n")
+        return res
+
+    monkeypatch.setattr(SQLite, "cleanup_tables", slow_cleanup_tables)
+    result = Worker(ds.directory, poll_interval=0.1, exit_when_idle=True).run()
+
+    assert result["failed"] == []
+    assert sorted(cleaned.read_text().splitlines()) == sorted(
+        ds.data_orchestrator.data_nodes
+    )
@@ -93,6 +93,7 @@ class Configuration(BaseConfiguration):
             self._set_all(
                 DIAAS_DS_STORE=install_dir / "tmp/lcl-ds-store",
                 DIAAS_WORKBENCH_STORE=install_dir / "tmp/lcl-workbench-store",
+                DIAAS_METRICS_DIR=install_dir / "tmp/lcl-metrics",
                 DIAAS_BE_BIN_DIR=install_dir / "be/bin",
                 DIAAS_LIBDS_DIR=install_dir / "libds",
                 DIAAS_BEDB_MIGRATIONS_DIR=install_dir / "be/migrations",